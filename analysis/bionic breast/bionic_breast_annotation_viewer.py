@@ -28,97 +28,38 @@ Add all Survey3D json files to `annotation_paths`, noting which electrode each d
 annotation_paths = glob.glob('Survey3D*.json')
 electrodes = [1]
 
-"""Iterate through .json files in the `annotation_paths` filepath and sequentially load attributes into the `annotation_record` dictionary.
+"""Load every file in `annotation_paths` in one pass with the `survey3d_analysis` package (found in the analysis folder; on colab, upload the `survey3d_analysis` folder alongside the json files). Files are parsed in parallel, each model's mesh is read once, and each model's projected fields are gathered into a sparse fields x vertices matrix.
 
-At the highest level, `annotation_record` is organized by model name. Each model can be reconstructed using the `'vertices'`, `'faces'`, and/or `'filename'` subfields. The `'electrodes'` subfield enumerates the recorded projected fields (`'fields'`) and projected field centroids (`'hotspots'`) associated with the stimulation of each electrode, along with a `'naturalness'` rating, a `'pain'` rating, and plain text `'qualities'` (descriptors delimited by `'_'`).
+At the highest level, `annotation_record` is organized by model file. Each model can be reconstructed using the `'vertices'`, `'faces'`, and/or `'filename'` subfields. The `'electrodes'` subfield enumerates the recorded projected fields (`'fields'`, one row per field) and projected field centroids (`'hotspots'`) associated with the stimulation of each electrode, along with a `'naturalness'` rating, a `'pain'` rating, and plain text `'qualities'` (descriptors delimited by `'_'`).
 """
 
+import sys
+sys.path.append('..')
+from survey3d_analysis import load_surveys
+
+cohort = load_surveys(annotation_paths[:len(electrodes)])
+
 annotation_record = {}
-for electrode in range(len(electrodes)):
-  annotation_path = annotation_paths[electrode]
-  electrode_num = electrodes[electrode]
-
-  with open(annotation_path) as json_data:
-      data = json.load(json_data)
-
-  participant = data['participant']
-  model_options =  data['config']['models']
-  sensation_types =  data['config']['typeList']
-  hide_scale = data['config']['hideScaleValues']
-
-  date = data['date']
-  start_time = data['startTime']
-  end_time = data['endTime']
-  projected_fields = data['projectedFields']
-
-  for pf in range(len(projected_fields)):
-      projected_field = projected_fields[pf]
-      this_model = projected_field['model']
-
-      with open(model_options[this_model]+'.json') as json_mesh_data:
-        mesh_data = json.load(json_mesh_data)
-
-      # make a separate map for each of the qualities...
-      if this_model not in annotation_record.keys():
-          annotation_record[this_model] = {}
-          mesh = mmnp.meshFromFacesVerts(np.array(mesh_data['faces']),np.array(mesh_data['vertices']))
-          annotation_record[this_model]['vertices'] = mmnp.getNumpyVerts(mesh)
-          numverts = len(annotation_record[this_model]['vertices'])
-          annotation_record[this_model]['faces'] = mmnp.getNumpyFaces(mesh.topology)
-          annotation_record[this_model]['filename'] = np.array(mesh_data['filename'])
-
-          annotation_record[this_model]['electrodes'] = {}
-          annotation_record[this_model]['electrodes'][electrode_num] = {}
-          annotation_record[this_model]['electrodes'][electrode_num]['fields'] = {}
-          annotation_record[this_model]['electrodes'][electrode_num]['hotspots'] = {}
-          annotation_record[this_model]['electrodes'][electrode_num]['naturalness'] = {}
-          annotation_record[this_model]['electrodes'][electrode_num]['pain'] = {}
-          annotation_record[this_model]['electrodes'][electrode_num]['qualities'] = {}
-
-          temp_field = np.zeros(numverts)
-          temp_field[np.array(projected_field['vertices'])] = np.ones(len(projected_field['vertices']))
-          annotation_record[this_model]['electrodes'][electrode_num]['fields'] = np.transpose(temp_field)
-          hotspot = projected_field['hotSpot']
-          annotation_record[this_model]['electrodes'][electrode_num]['hotspots'] = np.transpose(np.array([hotspot['x'],hotspot['y'],hotspot['z']]))
-          annotation_record[this_model]['electrodes'][electrode_num]['naturalness'] = np.array([projected_field['naturalness']])
-          annotation_record[this_model]['electrodes'][electrode_num]['pain'] = np.array([projected_field['pain']])
-
-          all_qualities = ''
-          for qual in range(len(projected_field['qualities'])):
-              all_qualities = all_qualities+'_'+projected_field['qualities'][qual]['type']
-
-          annotation_record[this_model]['electrodes'][electrode_num]['qualities'] = np.array(str(all_qualities))
-      else:
-          if electrode_num not in annotation_record[this_model]['electrodes'].keys():
-              annotation_record[this_model]['electrodes'][electrode_num] = {}
-              annotation_record[this_model]['electrodes'][electrode_num]['fields'] = {}
-              annotation_record[this_model]['electrodes'][electrode_num]['hotspots'] = {}
-              annotation_record[this_model]['electrodes'][electrode_num]['naturalness'] = {}
-              annotation_record[this_model]['electrodes'][electrode_num]['pain'] = {}
-              annotation_record[this_model]['electrodes'][electrode_num]['qualities'] = {}
-
-          all_qualities = ''
-          for qual in range(len(projected_field['qualities'])):
-              all_qualities = all_qualities+'_'+projected_field['qualities'][qual]['type']
-
-          if len(annotation_record[this_model]['electrodes'][electrode_num]['hotspots'])>0:
-            temp_field = np.zeros(numverts)
-            temp_field[np.array(projected_field['vertices'])] = np.ones(len(projected_field['vertices']))
-            annotation_record[this_model]['electrodes'][electrode_num]['fields'] = np.stack((annotation_record[this_model]['electrodes'][electrode_num]['fields'],np.transpose(temp_field)),axis=0)
-            hotspot = projected_field['hotSpot']
-            annotation_record[this_model]['electrodes'][electrode_num]['hotspots'] = np.stack((annotation_record[this_model]['electrodes'][electrode_num]['hotspots'],np.array([hotspot['x'],hotspot['y'],hotspot['z']])),axis=0)
-            annotation_record[this_model]['electrodes'][electrode_num]['naturalness'] = np.stack((annotation_record[this_model]['electrodes'][electrode_num]['naturalness'],np.array([projected_field['naturalness']])),axis=0)
-            annotation_record[this_model]['electrodes'][electrode_num]['pain'] = np.stack((annotation_record[this_model]['electrodes'][electrode_num]['pain'],np.array([projected_field['pain']])),axis=0)
-            annotation_record[this_model]['electrodes'][electrode_num]['qualities'] = np.stack((annotation_record[this_model]['electrodes'][electrode_num]['qualities'],np.array(str(all_qualities))),axis=0)
-          else:
-            temp_field = np.zeros(numverts)
-            temp_field[np.array(projected_field['vertices'])] = np.ones(len(projected_field['vertices']))
-            annotation_record[this_model]['electrodes'][electrode_num]['fields'] = np.transpose(temp_field)
-            hotspot = projected_field['hotSpot']
-            annotation_record[this_model]['electrodes'][electrode_num]['hotspots'] = np.transpose(np.array([hotspot['x'],hotspot['y'],hotspot['z']]))
-            annotation_record[this_model]['electrodes'][electrode_num]['naturalness'] = np.array([projected_field['naturalness']])
-            annotation_record[this_model]['electrodes'][electrode_num]['pain'] = np.array([projected_field['pain']])
-            annotation_record[this_model]['electrodes'][electrode_num]['qualities'] = np.array(str(all_qualities))
+for this_model, model_fields in cohort.models.items():
+  mesh = mmnp.meshFromFacesVerts(np.array(model_fields.mesh.faces),np.array(model_fields.mesh.vertices))
+  annotation_record[this_model] = {
+      'vertices': mmnp.getNumpyVerts(mesh),
+      'faces': mmnp.getNumpyFaces(mesh.topology),
+      'filename': np.array(model_fields.mesh.filename),
+      'electrodes': {}
+  }
+  qualities = model_fields.quality_strings()
+  for survey_index, electrode_num in enumerate(electrodes):
+    rows = model_fields.rows([survey_index])
+    if len(rows) == 0:
+      continue
+    annotation_record[this_model]['electrodes'][electrode_num] = {
+        'fields': model_fields.fields[rows].toarray().astype(float),
+        'hotspots': model_fields.hotspots[rows],
+        'naturalness': model_fields.naturalness[rows],
+        'pain': model_fields.pain[rows],
+        'qualities': qualities[rows]
+    }
 
 """Iterate over the electrodes in `'electrodes'` to plot all documented projected field maps as vertex color maps over the relevant mesh, averaging across multiple maps associated with a single electrode."""
 
@@ -126,10 +67,7 @@ verts_t = np.transpose(annotation_record[this_model]['vertices'])
 faces_t = np.transpose(annotation_record[this_model]['faces'])
 
 for electrode_num in annotation_record[this_model]['electrodes'].keys():
-  if len(np.shape(annotation_record[this_model]['electrodes'][electrode_num]['fields']))>1:
-    which_map = 255*np.mean(annotation_record[this_model]['electrodes'][electrode_num]['fields'],axis=0)
-  else:
-    which_map = 255*annotation_record[this_model]['electrodes'][electrode_num]['fields']
+  which_map = 255*np.mean(annotation_record[this_model]['electrodes'][electrode_num]['fields'],axis=0)
 
   base_map_1 = 0.5*np.ones(np.size(which_map,axis=0))
   base_map_2 = 0.5*np.ones(np.size(which_map,axis=0))
@@ -145,7 +83,7 @@ for electrode_num in annotation_record[this_model]['electrodes'].keys():
                           'xaxis': go.layout.XAxis(color='rgb(255,255,255)')})
   fig.show()
 
-"""Reformat `annotation_record` and export as a .mat struct. (Note: Throws an error if hotspots are of type 'None'.)"""
+"""Reformat `annotation_record` and export as a .mat struct. Missing hotspots are exported as NaN."""
 
 annotations = {'vertices':annotation_record[this_model]['vertices'],'faces':annotation_record[this_model]['faces'],'filename':annotation_record[this_model]['filename']}
 for elec in electrodes:
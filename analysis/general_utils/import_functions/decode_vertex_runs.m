@@ -0,0 +1,23 @@
+function vertices = decode_vertex_runs(encoded)
+    % Decode the vertices of a projected field as saved by Survey 3D. Newer
+    % surveys store them as a struct with a "runs" field: alternating gaps
+    % and lengths of runs of consecutive vertex indices, each gap measured
+    % from the end of the previous run. Older surveys store a plain list.
+    if ~isstruct(encoded)
+        vertices = encoded;
+        return
+    end
+
+    runs = reshape(encoded.runs, 2, []);
+    gaps = runs(1,:);
+    lengths = runs(2,:);
+    stops = cumsum(gaps + lengths);
+    starts = stops - lengths;
+
+    vertices = zeros(sum(lengths), 1);
+    k = 0;
+    for r = 1:numel(starts)
+        vertices(k+1:k+lengths(r)) = starts(r):stops(r)-1;
+        k = k + lengths(r);
+    end
+end
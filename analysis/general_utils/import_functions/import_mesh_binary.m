@@ -0,0 +1,24 @@
+function val = import_mesh_binary(fname)
+    % Read a .s3dmesh file written by the backend (see backend/meshbin.py).
+    % Returns a struct with the same fields as a JSON mesh from import_json:
+    % filename, vertices (N x 3) and faces (M x 3, zero-based).
+    fid = fopen(fname, 'r', 'ieee-le');
+    magic = fread(fid, 8, '*uint8')';
+    header = fread(fid, 6, 'uint32');
+    name = fread(fid, header(6), '*char')';
+    fclose(fid);
+
+    if ~isequal(magic, uint8(['S3DMESH' 0]))
+        error('%s is not a mesh file', fname);
+    end
+
+    num_verts = header(2);
+    num_faces = header(3);
+    m = memmapfile(fname, 'Offset', header(4), 'Repeat', 1, ...
+        'Format', {'single', [3 double(num_verts)], 'vertices'});
+    val.vertices = double(m.Data.vertices');
+    m = memmapfile(fname, 'Offset', header(5), 'Repeat', 1, ...
+        'Format', {'int32', [3 double(num_faces)], 'faces'});
+    val.faces = double(m.Data.faces');
+    val.filename = name;
+end
@@ -0,0 +1,19 @@
+"""
+Vectorized loading of Survey3D files for analysis.
+
+    from survey3d_analysis import load_surveys
+    cohort = load_surveys('data/Survey3D*.json')
+    hand = cohort.models['hand_r_vertical.glb']
+    hand.fields          # sparse fields x vertices matrix
+"""
+from .vertices import decode_vertices
+from .meshes import MeshData, MeshCache, load_mesh
+from .loader import (ModelFields, SurveyCohort, load_surveys,
+                     parse_survey_file, model_file)
+from .export import (read_export_manifest, load_export_table,
+                     load_export_matrix)
+from .overlap import (fields_matrix, overlap_matrix, jaccard, dice,
+                      area_overlap)
+from .mapping import (Landmarks, Similarity, MeshMapping, load_landmarks,
+                      find_landmarks, procrustes, fit_mapping, remap_fields,
+                      remap_cohort)
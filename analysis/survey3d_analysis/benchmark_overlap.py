@@ -0,0 +1,110 @@
+"""
+Benchmark the sparse overlap engine against the pair-by-pair approach of
+general_utils/quantification_functions/compute_jaccard.m.
+
+    python -m survey3d_analysis.benchmark_overlap --fields 4000
+    python -m survey3d_analysis.benchmark_overlap --export ../data/export \\
+        --model hand_r_vertical.glb
+
+The pairwise baseline is a direct port of compute_jaccard.m's dense masks
+(sum(a + b == 2) / sum(a + b > 0), NaN if either map is empty). It is timed
+on a sample of pairs and extrapolated to the full matrix, then checked
+against the engine's results for those pairs.
+"""
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+from scipy import sparse
+from .overlap import overlap_matrix
+from .export import load_export_matrix
+
+def synthetic_fields(num_fields: int, num_vertices: int, mean_size: int,
+                     seed: int = 0) -> sparse.csr_matrix:
+    """
+    Make fields of contiguous vertex runs, roughly like projected fields
+    painted on a mesh, with a few empty fields.
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for _ in range(num_fields):
+        vertices = []
+        if rng.random() > 0.02:
+            for _ in range(rng.integers(1, 6)):
+                length = int(rng.integers(1, 2 * mean_size // 3 + 2))
+                start = int(rng.integers(0, num_vertices - length))
+                vertices.append(np.arange(start, start + length))
+        rows.append(np.unique(np.concatenate(vertices))
+                    if vertices else np.zeros(0, dtype=np.int64))
+    indptr = np.zeros(num_fields + 1, dtype=np.int64)
+    np.cumsum([len(r) for r in rows], out=indptr[1:])
+    indices = np.concatenate(rows).astype(np.int32)
+    return sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.uint8), indices, indptr),
+        shape=(num_fields, num_vertices))
+
+def pairwise_jaccard(a: np.ndarray, b: np.ndarray) -> float:
+    """
+    The Jaccard index of two dense 0/1 maps, as computed by compute_jaccard.m
+    """
+    total = a + b
+    if a.sum() == 0 or b.sum() == 0:
+        return np.nan
+    return np.sum(total == 2) / np.sum(total > 0)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--fields', type=int, default=2000)
+    parser.add_argument('--vertices', type=int, default=50000)
+    parser.add_argument('--mean-size', type=int, default=1500)
+    parser.add_argument('--export', help='benchmark on an export folder')
+    parser.add_argument('--model', help="the export's model file to use")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--block-size', type=int, default=1024)
+    parser.add_argument('--pairs', type=int, default=2000,
+                        help='pairs timed with the pairwise baseline')
+    parser.add_argument('--out-of-core', action='store_true',
+                        help='also time writing the matrix to disk')
+    args = parser.parse_args()
+
+    if args.export:
+        fields = load_export_matrix(args.export, args.model)
+    else:
+        fields = synthetic_fields(args.fields, args.vertices, args.mean_size)
+    n, v = fields.shape
+    print(f'{n} fields on {v} vertices, {fields.nnz / max(n, 1):.0f} '
+          f'vertices per field, {n * (n - 1) // 2} pairs')
+
+    start = time.perf_counter()
+    result = overlap_matrix(fields, workers=args.workers,
+                            block_size=args.block_size)
+    engine = time.perf_counter() - start
+    print(f'sparse engine:      {engine:.3f} s')
+
+    if args.out_of_core:
+        with tempfile.TemporaryDirectory() as folder:
+            start = time.perf_counter()
+            overlap_matrix(fields, workers=args.workers,
+                           block_size=args.block_size,
+                           out=os.path.join(folder, 'jaccard.npy'))
+            print(f'sparse, on disk:    {time.perf_counter() - start:.3f} s')
+
+    rng = np.random.default_rng(1)
+    pairs = rng.integers(0, n, size=(args.pairs, 2))
+    dense = fields.toarray()
+    start = time.perf_counter()
+    expected = np.array([pairwise_jaccard(dense[i], dense[j])
+                         for i, j in pairs])
+    per_pair = (time.perf_counter() - start) / len(pairs)
+    baseline = per_pair * n * (n - 1) / 2
+    print(f'pairwise baseline:  {baseline:.3f} s (extrapolated from '
+          f'{len(pairs)} pairs)')
+    print(f'speedup:            {baseline / engine:.0f}x')
+
+    actual = result[pairs[:, 0], pairs[:, 1]]
+    agree = np.allclose(actual, expected, equal_nan=True, atol=1e-6)
+    print(f'results agree:      {agree}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import os
+import json
+import numpy as np
+from scipy import sparse
+
+def read_export_manifest(path: str) -> dict:
+    """
+    Read the manifest of a columnar export written by backend/export.py.
+    """
+    with open(os.path.join(path, 'manifest.json')) as f:
+        return json.load(f)
+
+def load_export_table(path: str, table: str = 'fields', columns=None):
+    """
+    Read the 'fields' or 'qualities' table of a columnar export, reading only
+    the requested columns of each Parquet part. Needs pyarrow.
+
+    Args:
+        path: the export folder, usually data/export
+        table: 'fields' or 'qualities'
+        columns: the columns to read, or None for all of them
+
+    Returns: a pyarrow Table
+    """
+    import pyarrow.dataset as ds
+    return ds.dataset(os.path.join(path, table), format='parquet').to_table(
+        columns=columns)
+
+def load_export_matrix(path: str, model_file: str,
+                       num_vertices: int | None = None) -> sparse.csr_matrix:
+    """
+    Assemble one model's fields x vertices membership matrix from a columnar
+    export. The parts' index arrays are memory-mapped, so only the rows
+    themselves are read. Row order follows the parts in the manifest, then
+    the fields table's 'row' column within each part.
+
+    Args:
+        path: the export folder, usually data/export
+        model_file: the model's filename, e.g. 'hand_r_vertical.glb'
+        num_vertices: the number of matrix columns, by default the highest
+            vertex index used plus one
+
+    Returns: a CSR matrix with one row per exported field on the model
+    """
+    model = read_export_manifest(path)['models'][model_file]
+    folder = os.path.join(path, 'matrices', model['folder'])
+    columns = max([p['columns'] for p in model['parts']] + [num_vertices or 0])
+    blocks = []
+    for part in model['parts']:
+        indptr = np.load(os.path.join(folder, part['part'] + '.indptr.npy'),
+                         mmap_mode='r')
+        indices = np.load(os.path.join(folder, part['part'] + '.indices.npy'),
+                          mmap_mode='r')
+        blocks.append(sparse.csr_matrix(
+            (np.ones(len(indices), dtype=np.uint8), indices, indptr),
+            shape=(len(indptr) - 1, columns)))
+    if not blocks:
+        return sparse.csr_matrix((0, columns), dtype=np.uint8)
+    return sparse.vstack(blocks, format='csr')
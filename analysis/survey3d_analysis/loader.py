@@ -0,0 +1,203 @@
+import os
+import glob
+import json
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+import numpy as np
+from scipy import sparse
+from .vertices import decode_vertices
+from .meshes import MeshCache, MeshData
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Below this many files, parsing in the calling process beats starting workers
+PARALLEL_THRESHOLD = 8
+
+def _read_json(path: str) -> dict:
+    with open(path, 'rb') as f:
+        if orjson is not None:
+            return orjson.loads(f.read())
+        return json.load(f)
+
+def model_file(config: dict, model: str) -> str:
+    """
+    Return the filename of a model named in a survey's config, which older
+    configs give directly and newer configs give under 'file'.
+    """
+    entry = config.get('models', {}).get(model, model)
+    if isinstance(entry, dict):
+        return entry.get('file', model)
+    return entry
+
+def parse_survey_file(path: str) -> dict:
+    """
+    Parse one Survey3D file into a compact record, decoding every field's
+    vertices into an index array. Runs in worker processes, so it returns
+    only plain data and numpy arrays.
+
+    Args:
+        path: the path of the Survey3D .json file
+
+    Returns: the survey's metadata, and a 'fields' list with each projected
+        field's model, mesh file, vertex indices, hotspot, ratings and
+        quality types
+    """
+    data = _read_json(path)
+    config = data.get('config', {})
+    fields = []
+    for projected_field in data.get('projectedFields', []):
+        hotspot = projected_field.get('hotSpot') or {}
+        fields.append({
+            'model': projected_field['model'],
+            'file': model_file(config, projected_field['model']),
+            'name': projected_field.get('name', ''),
+            'vertices': decode_vertices(projected_field.get('vertices', [])),
+            'hotspot': [np.nan if hotspot.get(axis) is None else hotspot[axis]
+                        for axis in ('x', 'y', 'z')],
+            'naturalness': projected_field.get('naturalness', np.nan),
+            'pain': projected_field.get('pain', np.nan),
+            'intensity': projected_field.get('intensity', np.nan),
+            'qualities': [q['type'] for q in projected_field.get('qualities', [])],
+        })
+    return {
+        'path': path,
+        'participant': data.get('participant', ''),
+        'date': data.get('date', ''),
+        'start_time': data.get('startTime', ''),
+        'end_time': data.get('endTime', ''),
+        'config': config,
+        'meshes': data.get('meshes', {}),
+        'fields': fields,
+    }
+
+@dataclass
+class ModelFields:
+    """
+    Every projected field drawn on one model, as a sparse fields x vertices
+    matrix with one row per field and per-field attribute arrays alongside.
+    """
+    model_file: str
+    model_names: set
+    fields: sparse.csr_matrix
+    survey: np.ndarray
+    names: list
+    hotspots: np.ndarray
+    naturalness: np.ndarray
+    pain: np.ndarray
+    intensity: np.ndarray
+    qualities: list
+    mesh: MeshData | None = None
+
+    @property
+    def num_fields(self) -> int:
+        return self.fields.shape[0]
+
+    def quality_strings(self) -> np.ndarray:
+        """
+        Return each field's quality types joined as '_type1_type2...', the
+        form the bionic breast notebook exports.
+        """
+        return np.array([''.join('_' + q for q in quals)
+                         for quals in self.qualities])
+
+    def rows(self, surveys) -> np.ndarray:
+        """
+        Return the row indices of the fields belonging to the given surveys.
+        """
+        return np.flatnonzero(np.isin(self.survey, list(surveys)))
+
+@dataclass
+class SurveyCohort:
+    """
+    A set of loaded Survey3D files. `surveys` holds each file's metadata in
+    load order, and `models` maps each model file to its ModelFields, whose
+    `survey` array indexes into `surveys`.
+    """
+    surveys: list = field(default_factory=list)
+    models: dict = field(default_factory=dict)
+
+def _assemble(model: str, entries: list, mesh: MeshData | None) -> ModelFields:
+    """
+    Build one model's ModelFields from its (survey index, field) entries in
+    a single pass, filling the CSR arrays directly.
+    """
+    lengths = np.fromiter((len(f['vertices']) for _, f in entries),
+                          dtype=np.int64, count=len(entries))
+    indptr = np.zeros(len(entries) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    indices = (np.concatenate([f['vertices'] for _, f in entries])
+               if entries else np.zeros(0, dtype=np.int32))
+    num_vertices = int(indices.max()) + 1 if len(indices) else 0
+    if mesh is not None:
+        num_vertices = max(num_vertices, mesh.num_vertices)
+    fields = sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.uint8), indices, indptr),
+        shape=(len(entries), num_vertices))
+    return ModelFields(
+        model_file=model,
+        model_names={f['model'] for _, f in entries},
+        fields=fields,
+        survey=np.array([s for s, _ in entries], dtype=np.int32),
+        names=[f['name'] for _, f in entries],
+        hotspots=np.array([f['hotspot'] for _, f in entries],
+                          dtype=float).reshape(-1, 3),
+        naturalness=np.array([f['naturalness'] for _, f in entries], dtype=float),
+        pain=np.array([f['pain'] for _, f in entries], dtype=float),
+        intensity=np.array([f['intensity'] for _, f in entries], dtype=float),
+        qualities=[f['qualities'] for _, f in entries],
+        mesh=mesh,
+    )
+
+def load_surveys(paths, mesh_dirs=None, workers=None,
+                 load_meshes=True) -> SurveyCohort:
+    """
+    Load any number of Survey3D files in one pass. Files are parsed in
+    parallel worker processes, each model's mesh is loaded once, and each
+    model's fields are assembled into a sparse fields x vertices matrix.
+
+    Args:
+        paths: Survey3D .json paths, or a glob pattern
+        mesh_dirs: directories to search for mesh files; defaults to the
+            directories holding the survey files
+        workers: the number of worker processes, by default one per CPU; 0
+            or 1 parses in the calling process
+        load_meshes: whether to load each model's mesh, which also fixes the
+            number of matrix columns to the mesh's vertex count
+
+    Returns: the loaded SurveyCohort
+    """
+    if isinstance(paths, str):
+        paths = sorted(glob.glob(paths))
+    paths = list(paths)
+    if mesh_dirs is None:
+        mesh_dirs = sorted({os.path.dirname(p) or '.' for p in paths})
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers > 1 and len(paths) >= PARALLEL_THRESHOLD:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunksize = max(1, len(paths) // (4 * workers))
+            records = list(pool.map(parse_survey_file, paths,
+                                    chunksize=chunksize))
+    else:
+        records = [parse_survey_file(p) for p in paths]
+
+    cohort = SurveyCohort()
+    by_model = {}
+    mesh_hashes = {}
+    for index, record in enumerate(records):
+        for projected_field in record.pop('fields'):
+            by_model.setdefault(projected_field['file'], []).append(
+                (index, projected_field))
+        for model, mesh_hash in record['meshes'].items():
+            mesh_hashes.setdefault(model, mesh_hash)
+        cohort.surveys.append(record)
+
+    meshes = MeshCache(mesh_dirs)
+    for model, entries in by_model.items():
+        mesh = meshes.get(model, mesh_hashes.get(model)) if load_meshes else None
+        cohort.models[model] = _assemble(model, entries, mesh)
+    return cohort
@@ -0,0 +1,289 @@
+import os
+import glob
+import json
+import hashlib
+import dataclasses
+from dataclasses import dataclass
+import numpy as np
+from scipy.spatial import cKDTree
+from .meshes import MeshData, MeshCache
+
+# Bumped whenever the cached correspondence tables would be computed
+# differently, so stale tables are not reused
+CACHE_VERSION = 1
+
+@dataclass
+class Landmarks:
+    """
+    A set of named landmarks placed on a mesh, as saved by the landmarks view
+    in Survey3DLandmarks_<mesh>_<name>.json.
+    """
+    mesh_filename: str
+    mesh_hash: str | None
+    points: dict
+    mesh: MeshData | None = None
+
+    def common(self, other: 'Landmarks') -> list:
+        """
+        Return the names of the landmarks both sets have placed, sorted.
+        """
+        return sorted(set(self.points) & set(other.points))
+
+    def array(self, names) -> np.ndarray:
+        return np.array([self.points[name] for name in names], dtype=float)
+
+def load_landmarks(path: str) -> Landmarks:
+    """
+    Load a Survey3DLandmarks_*.json file. Files saved before meshes were
+    stored by hash embed their mesh, which is kept as `mesh`.
+    """
+    with open(path) as f:
+        data = json.load(f)
+    mesh = data['mesh']
+    points = {l['name']: (l['x'], l['y'], l['z']) for l in data['landmarks']}
+    embedded = None
+    if 'vertices' in mesh:
+        embedded = MeshData(
+            mesh['filename'],
+            np.asarray(mesh['vertices'], dtype=np.float32).reshape(-1, 3),
+            np.asarray(mesh['faces'], dtype=np.int32).reshape(-1, 3))
+    return Landmarks(mesh['filename'], mesh.get('hash'), points, embedded)
+
+def find_landmarks(directory: str, model_file: str,
+                   name: str | None = None) -> list:
+    """
+    Return the paths of the landmark files saved for a model, newest first.
+
+    Args:
+        directory: the folder holding landmark files, usually the data folder
+        model_file: the model's filename, e.g. 'hand_r_vertical.glb'
+        name: the landmark set's name, or None for every set
+    """
+    stem = f"Survey3DLandmarks_{model_file.replace('/', '-')}_"
+    pattern = stem + (glob.escape(name) if name else '*') + '.json'
+    paths = glob.glob(os.path.join(glob.escape(directory), pattern))
+    return sorted(paths, key=os.path.getmtime, reverse=True)
+
+@dataclass
+class Similarity:
+    """
+    A similarity transform, applied to row vectors as in MATLAB's procrustes:
+    Z = scale * Y @ rotation + translation.
+    """
+    scale: float
+    rotation: np.ndarray
+    translation: np.ndarray
+
+    def apply(self, points: np.ndarray) -> np.ndarray:
+        return (self.scale * np.asarray(points, dtype=float) @ self.rotation
+                + self.translation)
+
+def procrustes(target: np.ndarray, source: np.ndarray, scaling: bool = True,
+               reflection: bool = False) -> Similarity:
+    """
+    Fit the similarity transform taking the source points closest to the
+    target points in the least-squares sense, as MATLAB's procrustes does.
+
+    Args:
+        target: (n, 3) target points
+        source: (n, 3) corresponding source points
+        scaling: whether the transform may scale
+        reflection: whether the rotation may be a reflection
+
+    Returns: the transform, which maps source points onto the target
+    """
+    target = np.asarray(target, dtype=float)
+    source = np.asarray(source, dtype=float)
+    if target.shape != source.shape or len(target) < 3:
+        raise ValueError('procrustes needs at least 3 corresponding points')
+    target_mean = target.mean(axis=0)
+    source_mean = source.mean(axis=0)
+    x = target - target_mean
+    y = source - source_mean
+    u, s, vt = np.linalg.svd(y.T @ x)
+    if not reflection and np.linalg.det(u @ vt) < 0:
+        u[:, -1] *= -1
+        s[-1] *= -1
+    rotation = u @ vt
+    scale = s.sum() / (y ** 2).sum() if scaling else 1.0
+    return Similarity(scale, rotation,
+                      target_mean - scale * source_mean @ rotation)
+
+@dataclass
+class MeshMapping:
+    """
+    A correspondence between a source mesh and a target mesh, fitted once
+    from their landmarks. `correspondence[t]` is the source vertex closest
+    to target vertex t once the source is aligned to the target, so every
+    target vertex takes its value from exactly one source vertex and mapped
+    fields have no holes when the target is the denser mesh.
+    """
+    source_file: str
+    target_file: str
+    transform: Similarity
+    correspondence: np.ndarray
+    distances: np.ndarray
+    target: MeshData | None = None
+
+    def map_fields(self, fields):
+        """
+        Map a fields x source vertices membership matrix onto the target
+        mesh in one sparse column gather.
+
+        Returns: a fields x target vertices CSR matrix
+        """
+        fields = fields.tocsc() if hasattr(fields, 'tocsc') else fields
+        num_columns = fields.shape[1]
+        correspondence = self.correspondence
+        if correspondence.max(initial=-1) >= num_columns:
+            # Source vertices beyond the matrix are covered by no field
+            fields = fields.copy()
+            fields.resize((fields.shape[0], correspondence.max() + 1))
+        return fields[:, correspondence].tocsr()
+
+    def map_points(self, points: np.ndarray, snap: bool = False) -> np.ndarray:
+        """
+        Map source points, such as hotspots, onto the target. NaN points
+        stay NaN.
+
+        Args:
+            points: (n, 3) source points
+            snap: whether to move each point to the nearest target vertex
+
+        Returns: (n, 3) target points
+        """
+        mapped = self.transform.apply(
+            np.asarray(points, dtype=float).reshape(-1, 3))
+        if snap:
+            if self.target is None:
+                raise ValueError('snapping needs the target mesh')
+            valid = ~np.isnan(mapped).any(axis=1)
+            _, nearest = cKDTree(self.target.vertices).query(
+                mapped[valid], workers=-1)
+            mapped[valid] = self.target.vertices[nearest]
+        return mapped
+
+def _mesh_key(mesh: MeshData, mesh_hash: str | None) -> str:
+    if mesh_hash:
+        return mesh_hash
+    return hashlib.sha256(
+        np.ascontiguousarray(mesh.vertices, dtype='<f4').tobytes()).hexdigest()
+
+def _landmarks_mesh(landmarks: Landmarks, meshes: MeshCache | None) -> MeshData:
+    mesh = landmarks.mesh
+    if mesh is None and meshes is not None:
+        mesh = meshes.get(landmarks.mesh_filename, landmarks.mesh_hash)
+    if mesh is None:
+        raise FileNotFoundError(f'No mesh found for {landmarks.mesh_filename}')
+    return mesh
+
+def fit_mapping(source: Landmarks, target: Landmarks,
+                meshes: MeshCache | None = None, cache_dir: str | None = None,
+                landmark_names=None, scaling: bool = True) -> MeshMapping:
+    """
+    Fit the mapping from the mesh of one landmark set to the mesh of another:
+    a Procrustes alignment of their common landmarks, then a KD-tree query
+    of every target vertex against the aligned source vertices.
+
+    The correspondence table is the expensive part, so with `cache_dir` it
+    is saved there as an .npz named for the two meshes' content hashes and
+    the landmarks used, and reused by every later call for the same pair.
+
+    Args:
+        source: the landmarks of the mesh fields are drawn on
+        target: the landmarks of the mesh fields are mapped to
+        meshes: where to find meshes by hash (see MeshCache); not needed for
+            landmark files which embed their mesh
+        cache_dir: the folder correspondence tables are cached in, or None
+        landmark_names: the landmarks to align, by default every landmark
+            both sets have placed
+        scaling: whether the alignment may scale the source
+
+    Returns: the MeshMapping
+    """
+    source_mesh = _landmarks_mesh(source, meshes)
+    target_mesh = _landmarks_mesh(target, meshes)
+    names = sorted(landmark_names) if landmark_names else source.common(target)
+    transform = procrustes(target.array(names), source.array(names),
+                           scaling=scaling)
+
+    cache_path = None
+    if cache_dir is not None:
+        key = json.dumps([CACHE_VERSION,
+                          _mesh_key(source_mesh, source.mesh_hash),
+                          _mesh_key(target_mesh, target.mesh_hash), names,
+                          source.array(names).tolist(),
+                          target.array(names).tolist(), scaling])
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+        cache_path = os.path.join(cache_dir, f'mapping-{digest}.npz')
+        if os.path.isfile(cache_path):
+            with np.load(cache_path) as cached:
+                return MeshMapping(source.mesh_filename, target.mesh_filename,
+                                   transform, cached['correspondence'],
+                                   cached['distances'], target_mesh)
+
+    aligned = transform.apply(source_mesh.vertices)
+    distances, correspondence = cKDTree(aligned).query(
+        np.asarray(target_mesh.vertices, dtype=float), workers=-1)
+    correspondence = correspondence.astype(np.int32)
+    distances = distances.astype(np.float32)
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Written under a temporary name, so a reader never sees half a table
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, correspondence=correspondence, distances=distances)
+        os.replace(tmp_path, cache_path)
+    return MeshMapping(source.mesh_filename, target.mesh_filename, transform,
+                       correspondence, distances, target_mesh)
+
+def remap_fields(model_fields, mapping: MeshMapping,
+                 snap_hotspots: bool = False):
+    """
+    Move every projected field of a model onto another mesh in one pass:
+    the fields matrix by the mapping's correspondence and the hotspots by
+    its transform.
+
+    Args:
+        model_fields: the ModelFields of the mapping's source model
+        mapping: the MeshMapping to apply
+        snap_hotspots: whether to move hotspots onto the nearest target vertex
+
+    Returns: a new ModelFields on the target model
+    """
+    return dataclasses.replace(
+        model_fields,
+        model_file=mapping.target_file,
+        fields=mapping.map_fields(model_fields.fields),
+        hotspots=mapping.map_points(model_fields.hotspots, snap=snap_hotspots),
+        mesh=mapping.target,
+    )
+
+def remap_cohort(cohort, target: Landmarks, landmark_dir: str,
+                 meshes: MeshCache | None = None, cache_dir: str | None = None,
+                 snap_hotspots: bool = False) -> dict:
+    """
+    Move the fields of every model in a cohort onto one target mesh, using
+    the newest landmark set saved for each model in `landmark_dir`. Models
+    without landmarks are skipped.
+
+    Args:
+        cohort: a SurveyCohort, as returned by load_surveys
+        target: the landmarks of the target mesh
+        landmark_dir: the folder holding the models' landmark files
+        meshes: where to find meshes by hash, by default landmark_dir
+        cache_dir: the folder correspondence tables are cached in, or None
+        snap_hotspots: whether to move hotspots onto the nearest target vertex
+
+    Returns: a dict of each source model file to its remapped ModelFields
+    """
+    if meshes is None:
+        meshes = MeshCache([landmark_dir])
+    remapped = {}
+    for model, model_fields in cohort.models.items():
+        paths = find_landmarks(landmark_dir, model)
+        if not paths:
+            continue
+        mapping = fit_mapping(load_landmarks(paths[0]), target, meshes,
+                              cache_dir)
+        remapped[model] = remap_fields(model_fields, mapping, snap_hotspots)
+    return remapped
@@ -0,0 +1,104 @@
+import os
+import json
+import struct
+from dataclasses import dataclass
+import numpy as np
+
+# Header of the backend's binary .s3dmesh files, see backend/meshbin.py
+S3DMESH_MAGIC = b"S3DMESH\0"
+S3DMESH_HEADER = struct.Struct("<8sIIIIII")
+
+@dataclass
+class MeshData:
+    """
+    The geometry of one model, as saved by the Survey3D backend.
+    """
+    filename: str
+    vertices: np.ndarray
+    faces: np.ndarray
+
+    @property
+    def num_vertices(self) -> int:
+        return len(self.vertices)
+
+def load_mesh(path: str) -> MeshData:
+    """
+    Load a mesh saved by the backend, either a .json mesh dump or a binary
+    .s3dmesh file. Binary files are memory-mapped rather than read.
+
+    Args:
+        path: the path of the mesh file
+
+    Returns: the mesh's filename, vertices and faces
+    """
+    if path.endswith('.s3dmesh'):
+        with open(path, 'rb') as f:
+            (magic, version, num_vertices, num_faces, vertex_offset,
+             face_offset, name_length) = S3DMESH_HEADER.unpack(
+                f.read(S3DMESH_HEADER.size))
+            if magic != S3DMESH_MAGIC:
+                raise ValueError(f'{path} is not a .s3dmesh file')
+            filename = f.read(name_length).decode('utf-8')
+        vertices = (np.memmap(path, dtype='<f4', mode='r',
+                              offset=vertex_offset, shape=(num_vertices, 3))
+                    if num_vertices else np.zeros((0, 3), dtype='<f4'))
+        faces = (np.memmap(path, dtype='<i4', mode='r',
+                           offset=face_offset, shape=(num_faces, 3))
+                 if num_faces else np.zeros((0, 3), dtype='<i4'))
+        return MeshData(filename, vertices, faces)
+    with open(path) as f:
+        data = json.load(f)
+    return MeshData(data.get('filename', ''),
+                    np.asarray(data['vertices'], dtype=np.float32).reshape(-1, 3),
+                    np.asarray(data['faces'], dtype=np.int32).reshape(-1, 3))
+
+class MeshCache:
+    """
+    Loads each model's mesh once, however many projected fields refer to it.
+
+    Meshes are looked for in each search directory, first by content hash (as
+    recorded in a survey's 'meshes' entry, under meshes/<hash>.s3dmesh or
+    meshes/<hash>.json) and then by the legacy <model file>.json name.
+    """
+    def __init__(self, search_dirs=('.',)):
+        """
+        Args:
+            search_dirs: directories to search for mesh files, usually the
+            backend's data folder and/or the folders holding survey files
+        """
+        self.search_dirs = list(search_dirs)
+        self._meshes = {}
+
+    def find(self, model_file: str, mesh_hash: str | None = None) -> str | None:
+        """
+        Return the path of the mesh file for a model, or None if it cannot
+        be found.
+        """
+        candidates = []
+        for directory in self.search_dirs:
+            if mesh_hash:
+                for sub in ('meshes', ''):
+                    for ext in ('.s3dmesh', '.json'):
+                        candidates.append(
+                            os.path.join(directory, sub, mesh_hash + ext))
+            candidates.append(os.path.join(directory, model_file + '.json'))
+        for path in candidates:
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def get(self, model_file: str, mesh_hash: str | None = None) -> MeshData | None:
+        """
+        Return the mesh of a model, loading it on first use.
+
+        Args:
+            model_file: the model's filename, e.g. 'hand_r_vertical.glb'
+            mesh_hash: the content hash of the mesh, if the survey recorded one
+
+        Returns: the mesh, or None if no mesh file could be found
+        """
+        key = (model_file, mesh_hash)
+        if key not in self._meshes:
+            path = self.find(model_file, mesh_hash)
+            self._meshes[key] = load_mesh(path) if path else None
+        return self._meshes[key]
@@ -0,0 +1,199 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy import sparse
+from .vertices import decode_vertices
+
+METRICS = ('jaccard', 'dice', 'area')
+
+def fields_matrix(vertex_sets, num_vertices: int | None = None) -> sparse.csr_matrix:
+    """
+    Build a fields x vertices membership matrix from projected field vertices.
+
+    Args:
+        vertex_sets: one entry per field, each a {'runs': [...]} encoding, a
+            list or array of vertex indices, or an object with a ranges()
+            method returning [start, stop) pairs (such as the backend's
+            VertexSet)
+        num_vertices: the number of columns, by default the highest vertex
+            index used plus one
+
+    Returns: a CSR matrix with a 1 wherever a field covers a vertex
+    """
+    rows = []
+    for vertices in vertex_sets:
+        if hasattr(vertices, 'ranges'):
+            ranges = vertices.ranges()
+            rows.append(np.concatenate(
+                [np.arange(a, b, dtype=np.int32) for a, b in ranges]
+                + [np.zeros(0, dtype=np.int32)]))
+        else:
+            rows.append(decode_vertices(vertices))
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(r) for r in rows], out=indptr[1:])
+    indices = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int32)
+    if num_vertices is None:
+        num_vertices = int(indices.max()) + 1 if len(indices) else 0
+    return sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.uint8), indices, indptr),
+        shape=(len(rows), num_vertices))
+
+# State shared with worker processes, set once per worker by _init_worker
+_worker = {}
+
+def _init_worker(left, right, weights, metric, empty, symmetric, out_path):
+    _worker.update(metric=metric, empty=empty, symmetric=symmetric,
+                   out_path=out_path)
+    left_w = left if weights is None else left.multiply(weights).tocsr()
+    _worker['left_weighted'] = left_w.astype(np.float64)
+    _worker['right_t'] = right.T.astype(np.float64).tocsc()
+    _worker['left_sizes'] = np.asarray(left_w.sum(axis=1)).ravel()
+    right_w = right if weights is None else right.multiply(weights)
+    _worker['right_sizes'] = np.asarray(right_w.sum(axis=1)).ravel()
+
+def _similarity(intersection, left_sizes, right_sizes, metric, empty):
+    """
+    Turn a dense block of intersection sizes into similarities.
+    """
+    left_sizes = left_sizes[:, None]
+    right_sizes = right_sizes[None, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if metric == 'dice':
+            result = 2 * intersection / (left_sizes + right_sizes)
+        else:
+            result = intersection / (left_sizes + right_sizes - intersection)
+    # As in compute_jaccard.m, pairs where either field is empty are undefined
+    result[(left_sizes == 0) | (right_sizes == 0)] = empty
+    return result
+
+def _block(start: int, stop: int):
+    """
+    Compute the similarities of left rows start:stop against every right row,
+    or, for a symmetric matrix, against right rows start: onwards. The block
+    is written to the output memmap if there is one, and returned otherwise.
+    """
+    w = _worker
+    column_start = start if w['symmetric'] else 0
+    right_t = w['right_t'][:, column_start:]
+    intersection = (w['left_weighted'][start:stop] @ right_t).toarray()
+    block = _similarity(intersection, w['left_sizes'][start:stop],
+                        w['right_sizes'][column_start:], w['metric'],
+                        w['empty']).astype(np.float32)
+    if w['out_path'] is None:
+        return start, stop, column_start, block
+    out = np.load(w['out_path'], mmap_mode='r+')
+    _write(out, start, stop, column_start, block, w['symmetric'])
+    out.flush()
+    return start, stop, column_start, None
+
+def _write(out, start, stop, column_start, block, symmetric):
+    out[start:stop, column_start:] = block
+    if symmetric:
+        out[column_start:, start:stop] = block.T
+
+def _with_columns(matrix, columns):
+    return sparse.csr_matrix((matrix.data, matrix.indices, matrix.indptr),
+                             shape=(matrix.shape[0], columns))
+
+def overlap_matrix(fields, other=None, metric: str = 'jaccard', weights=None,
+                   block_size: int = 1024, workers: int | None = None,
+                   out: str | None = None, empty: float = np.nan) -> np.ndarray:
+    """
+    Compute the overlap of every pair of projected fields with sparse matrix
+    products, a block of rows at a time.
+
+    The intersection of each pair is one entry of fields @ other.T, and
+    every union follows from the fields' sizes, so the whole matrix costs
+    one sparse product instead of a loop over pairs. Blocks are computed in
+    parallel worker processes. With `out` set, blocks are written straight
+    to a .npy file on disk, so matrices larger than memory can be computed;
+    `fields` may itself be memory-mapped (see load_export_matrix).
+
+    Args:
+        fields: a fields x vertices membership matrix (see fields_matrix)
+        other: a second membership matrix on the same model; by default the
+            fields are compared with themselves, computing only one triangle
+        metric: 'jaccard' (intersection / union), 'dice' (2 * intersection /
+            (|A| + |B|)) or 'area' (Jaccard with each vertex weighted, for
+            example by the mesh area it represents)
+        weights: per-vertex weights, required for 'area'
+        block_size: the number of rows computed per block
+        workers: the number of worker processes, by default one per CPU
+        out: the path of a .npy file to write the matrix to, or None to
+            return it in memory
+        empty: the value for pairs where either field is empty
+
+    Returns: a float32 array of similarities, memory-mapped if `out` is set
+    """
+    if metric not in METRICS:
+        raise ValueError(f'metric must be one of {METRICS}')
+    if metric == 'area' and weights is None:
+        raise ValueError("the 'area' metric needs per-vertex weights")
+    if metric != 'area':
+        weights = None
+    left = sparse.csr_matrix(fields)
+    symmetric = other is None
+    right = left if symmetric else sparse.csr_matrix(other)
+    if left.shape[1] != right.shape[1]:
+        columns = max(left.shape[1], right.shape[1])
+        left = _with_columns(left, columns)
+        right = _with_columns(right, columns)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)
+        if len(weights) < left.shape[1]:
+            raise ValueError('there must be one weight per vertex')
+        weights = weights[:left.shape[1]]
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    shape = (left.shape[0], right.shape[0])
+    if out is not None:
+        result = np.lib.format.open_memmap(out, mode='w+', dtype=np.float32,
+                                           shape=shape)
+        del result
+    else:
+        result = np.empty(shape, dtype=np.float32)
+
+    blocks = [(start, min(start + block_size, shape[0]))
+              for start in range(0, shape[0], block_size)]
+    args = (left, right, weights, metric, empty, symmetric, out)
+    if workers > 1 and len(blocks) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=args) as pool:
+            results = pool.map(_block, *zip(*blocks))
+            for start, stop, column_start, block in results:
+                if block is not None:
+                    _write(result, start, stop, column_start, block, symmetric)
+    else:
+        _init_worker(*args)
+        try:
+            for start, stop in blocks:
+                _, _, column_start, block = _block(start, stop)
+                if block is not None:
+                    _write(result, start, stop, column_start, block, symmetric)
+        finally:
+            _worker.clear()
+
+    if out is not None:
+        return np.load(out, mmap_mode='r')
+    return result
+
+def jaccard(fields, other=None, **kwargs) -> np.ndarray:
+    """
+    All-pairs Jaccard index of projected fields, see overlap_matrix.
+    """
+    return overlap_matrix(fields, other, metric='jaccard', **kwargs)
+
+def dice(fields, other=None, **kwargs) -> np.ndarray:
+    """
+    All-pairs Dice coefficient of projected fields, see overlap_matrix.
+    """
+    return overlap_matrix(fields, other, metric='dice', **kwargs)
+
+def area_overlap(fields, weights, other=None, **kwargs) -> np.ndarray:
+    """
+    All-pairs area-weighted Jaccard index of projected fields, see
+    overlap_matrix.
+    """
+    return overlap_matrix(fields, other, metric='area', weights=weights,
+                          **kwargs)
@@ -0,0 +1,28 @@
+import numpy as np
+
+def decode_vertices(encoded) -> np.ndarray:
+    """
+    Decode the vertices of a projected field into a sorted array of vertex
+    indices, without a Python loop over runs or vertices.
+
+    Args:
+        encoded: the field's 'vertices' entry, either {'runs': [...]} (a flat
+        list of alternating gaps and lengths, each gap counted from the end
+        of the previous run) or a legacy list of vertex indices
+
+    Returns: a sorted int32 array of unique vertex indices
+    """
+    if isinstance(encoded, dict):
+        runs = np.asarray(encoded['runs'], dtype=np.int64).reshape(-1, 2)
+        if len(runs) == 0:
+            return np.zeros(0, dtype=np.int32)
+        lengths = runs[:, 1]
+        stops = np.cumsum(runs.sum(axis=1))
+        starts = stops - lengths
+        # Offset of each output position within its run, plus its run's start
+        run_offsets = np.cumsum(lengths) - lengths
+        positions = np.arange(lengths.sum())
+        indices = (positions - np.repeat(run_offsets, lengths)
+                   + np.repeat(starts, lengths))
+        return indices.astype(np.int32)
+    return np.unique(np.asarray(encoded, dtype=np.int64)).astype(np.int32)
@@ -0,0 +1,101 @@
+"""
+Measure encode and decode throughput of large surveys and meshes, through
+the hand-written toDict/fromDict with the json module and through the
+msgspec codec:
+
+    python benchmark_codec.py --fields 200 --vertices 50000
+"""
+import json
+import time
+import random
+import argparse
+from survey3d import Survey, ProjectedField, Quality, Mesh
+from vertexset import VertexSet
+from codec import encode, decode
+
+def makeSurvey(fields: int, vertices: int, seed: int = 0) -> Survey:
+    """
+    Make a survey whose fields each cover a few thousand vertices in runs,
+    as painted fields do
+    """
+    rng = random.Random(seed)
+    survey = Survey("benchmark", {"models": {"Hand": {"file": "hand.glb"}}},
+                    "2024-01-01", "00-00-00", "00-10-00")
+    for i in range(fields):
+        ranges = []
+        for _ in range(rng.randint(20, 200)):
+            start = rng.randrange(vertices)
+            ranges.append((start, min(vertices, start + rng.randint(1, 60))))
+        survey.projectedFields.append(ProjectedField(
+            "Hand", f"field {i}", VertexSet.fromRanges(ranges),
+            {"x": rng.random(), "y": rng.random(), "z": rng.random()},
+            rng.random() * 10, rng.random() * 10, rng.random() * 10,
+            [Quality(rng.random() * 10, ["atSkin"], quality)
+             for quality in rng.sample(["touch", "tingling", "warm"], 2)]
+        ))
+    return survey
+
+def makeMesh(vertices: int, seed: int = 0) -> Mesh:
+    rng = random.Random(seed)
+    return Mesh(
+        "hand.glb",
+        [[rng.random(), rng.random(), rng.random()] for _ in range(vertices)],
+        [[i, i + 1, i + 2] for i in range(0, vertices - 2, 3)]
+    )
+
+def timeIt(function, repeat: int) -> float:
+    """
+    Return the best time of a number of calls, in seconds
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def report(name: str, size: int, legacy: float, codec: float) -> None:
+    megabytes = size / 1e6
+    print(f"{name:<16}{legacy * 1e3:>10.2f} ms {megabytes / legacy:>8.1f} MB/s"
+          f"{codec * 1e3:>10.2f} ms {megabytes / codec:>8.1f} MB/s"
+          f"{legacy / codec:>8.1f}x")
+
+def legacySurveyDecode(text: str) -> Survey:
+    survey = Survey()
+    survey.fromDict(json.loads(text))
+    return survey
+
+def legacyMeshDecode(text: str) -> Mesh:
+    mesh = Mesh()
+    mesh.fromDict(json.loads(text))
+    return mesh
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__.split("\n\n")[0])
+    parser.add_argument("--fields", type = int, default = 200)
+    parser.add_argument("--vertices", type = int, default = 50000)
+    parser.add_argument("--repeat", type = int, default = 5)
+    args = parser.parse_args()
+
+    survey = makeSurvey(args.fields, args.vertices)
+    mesh = makeMesh(args.vertices)
+    surveyText = json.dumps(survey.toDict())
+    meshText = json.dumps(mesh.toDict())
+    assert decode(encode(survey), Survey) == legacySurveyDecode(surveyText)
+    assert json.loads(encode(survey)) == json.loads(surveyText)
+
+    print(f"Survey of {args.fields} fields, {len(surveyText) / 1e6:.2f} MB; "
+          f"mesh of {args.vertices} vertices, {len(meshText) / 1e6:.2f} MB")
+    print(f"{'':<16}{'toDict/fromDict + json':>30}{'codec':>26}")
+    report("survey encode", len(surveyText),
+           timeIt(lambda: json.dumps(survey.toDict()), args.repeat),
+           timeIt(lambda: encode(survey), args.repeat))
+    report("survey decode", len(surveyText),
+           timeIt(lambda: legacySurveyDecode(surveyText), args.repeat),
+           timeIt(lambda: decode(surveyText, Survey), args.repeat))
+    report("mesh encode", len(meshText),
+           timeIt(lambda: json.dumps(mesh.toDict()), args.repeat),
+           timeIt(lambda: encode(mesh), args.repeat))
+    report("mesh decode", len(meshText),
+           timeIt(lambda: legacyMeshDecode(meshText), args.repeat),
+           timeIt(lambda: decode(meshText, Mesh), args.repeat))
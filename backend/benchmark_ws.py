@@ -0,0 +1,612 @@
+"""
+Drive the backend with synthetic participant and experimenter clients over
+its websockets, and measure how it keeps up:
+
+    python benchmark_ws.py --participants 4 --monitors 2 --output ws.json
+    python benchmark_ws.py --participants 4 --monitors 2 --compare ws.json
+
+The app is served by uvicorn in this process, against a scratch data folder
+and a participant config listing only the synthetic participants, so the
+benchmark never touches ../data. Each participant has its survey started by
+an experimenter client, which then follows it along with any other
+monitoring experimenter clients. The participant paints its survey stroke by
+stroke as the frontend does: one full update, then patches adding vertex
+ranges, with one message in flight at a time. Once every field is painted it
+queries the server's meshes and submits. The model it paints on is served
+from a synthetic mesh, so, as with the frontend, the server produces the
+mesh from its own copy of the model rather than having it uploaded.
+
+With --mode update --pipeline each participant instead sends its updates
+without waiting for their acks, as a client painting faster than the server
+handles updates would. The server replaces an update still waiting when a
+newer one arrives and never acknowledges it, so the report gives how many
+updates were sent, how many the server handled, and how many it dropped.
+
+The report gives the message throughput, the p50/p99 latency and the payload
+sizes of each kind of message, the latency of pushes to the monitors, and the
+peak resident set size. The clients share the process with the server, so
+their CPU time and memory are counted too; they keep them small by encoding
+with the server's own codec. Results are saved as JSON with --output, and
+--compare reports the change from saved results, failing if any latency,
+throughput or memory figure is worse by more than the tolerance.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import contextlib
+from datetime import datetime
+
+# Bumped whenever results are measured differently, so that results which
+# cannot be compared are not
+RESULTS_VERSION = 2
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+class Recorder():
+    """
+    Collects the latencies and payload sizes of each kind of message
+    """
+    def __init__(self):
+        self.latencies = {}
+        self.sizes = {}
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.errors = {}
+        self.updatesSent = 0
+        self.updatesHandled = 0
+
+    def add(self, kind: str, latency: float | None, size: int) -> None:
+        """
+        Record one message
+
+        Args:
+            kind: The kind of message, such as "patch" or "push"
+            latency: The seconds the message took, or None if not timed
+            size: The length of the message's JSON text
+        """
+        if latency is not None:
+            self.latencies.setdefault(kind, []).append(latency)
+        self.sizes.setdefault(kind, []).append(size)
+
+    def error(self, kind: str) -> None:
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def summary(self) -> dict:
+        """
+        Return the count, latency percentiles in milliseconds and payload
+        sizes in bytes of each kind of message
+        """
+        summary = {}
+        for kind, sizes in sorted(self.sizes.items()):
+            latencies = sorted(self.latencies.get(kind, []))
+            summary[kind] = {
+                "count": len(sizes),
+                "bytesMean": sum(sizes) / len(sizes),
+                "bytesMax": max(sizes)
+            }
+            if latencies:
+                summary[kind].update({
+                    "p50": percentile(latencies, 50) * 1e3,
+                    "p99": percentile(latencies, 99) * 1e3,
+                    "max": latencies[-1] * 1e3
+                })
+        return summary
+
+def percentile(values: list[float], q: float) -> float:
+    """
+    Return the nearest-rank percentile of sorted values
+    """
+    rank = max(0, min(len(values) - 1, int(round(q / 100 * len(values))) - 1))
+    return values[rank]
+
+def peakRss() -> int:
+    """
+    Return the peak resident set size of this process so far, in bytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def participantName(index: int) -> str:
+    return f"benchmark{index}"
+
+def makeScratch(participants: int) -> tuple[str, dict]:
+    """
+    Lay out a scratch copy of the folders main.py expects, with a participant
+    config giving every synthetic participant the first configured
+    participant's models
+
+    Returns: The scratch folder and the synthetic participants' config
+    """
+    with open(os.path.join(HERE, "config", "participant_config.json"),
+              'r') as file:
+        template = next(iter(json.load(file).values()))
+    root = tempfile.mkdtemp(prefix = "survey3d-benchmark-")
+    os.makedirs(os.path.join(root, "backend", "config"))
+    os.makedirs(os.path.join(root, "data"))
+    for folder in ("assets", "images", "3dmodels"):
+        os.makedirs(os.path.join(root, "frontend", "dist", folder))
+    config = {participantName(i): template for i in range(participants)}
+    with open(os.path.join(root, "backend", "config",
+                           "participant_config.json"), 'w') as file:
+        json.dump(config, file, indent = 4)
+    return root, template
+
+def makeMesh(filename: str, vertices: int, seed: int = 0):
+    """
+    Make a mesh of the given number of vertices, triangulated as a strip
+    """
+    from survey3d import Mesh
+    rng = random.Random(seed)
+    return Mesh(
+        filename,
+        [[rng.random(), rng.random(), rng.random()] for _ in range(vertices)],
+        [[i, i + 1, i + 2] for i in range(vertices - 2)]
+    )
+
+def serveModel(root: str, filename: str, mesh) -> None:
+    """
+    Serve a mesh as a model file from the scratch folder's models. The
+    server only takes meshes of the models it serves
+    """
+    import numpy as np
+    from gltf import encodeGLB
+    path = os.path.join(root, "frontend", "dist", "3dmodels", filename)
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, 'wb') as file:
+        file.write(encodeGLB(np.array(mesh.vertices), np.array(mesh.faces)))
+
+def stroke(rng: random.Random, center: float, count: int,
+           vertices: int) -> list[list[int]]:
+    """
+    Return the vertex ranges covered by one brush stroke of about count
+    vertices around a center: short runs of consecutive indices, as a brush
+    covers on a mesh whose vertices are ordered along its surface
+    """
+    spread = max(1.0, vertices * 0.005)
+    ranges = []
+    while count > 0:
+        length = min(count, rng.randint(4, 24))
+        start = int(rng.gauss(center, spread))
+        start = max(0, min(vertices - length, start))
+        ranges.append([start, start + length])
+        count -= length
+    return ranges
+
+async def receiveType(connection, kinds: tuple[str, ...],
+                      recorder: Recorder) -> tuple[str, str]:
+    """
+    Receive messages until one of the given types arrives
+
+    Returns: The message's type and text
+    """
+    from codec import decode
+    while True:
+        text = await connection.recv()
+        recorder.bytesReceived += len(text)
+        kind = decode(text)["type"]
+        if kind in kinds:
+            return kind, text
+
+async def monitor(url: str, name: str, sends: list[float],
+                  recorder: Recorder, start: bool = False) -> None:
+    """
+    Follow a participant's survey as an experimenter client, timing each
+    push from the oldest change it had not yet been shown. The first monitor
+    of each participant also starts the participant's survey
+
+    Args:
+        url: The server's websocket URL
+        name: The participant
+        sends: The times at which the participant sent each change
+        recorder: Where pushes are recorded
+        start: Whether to start the participant's survey
+    """
+    from websockets.asyncio.client import connect
+    async with connect(f"{url}/experimenter-ws?session={name}",
+                       max_size = None, proxy = None) as connection:
+        if start:
+            message = json.dumps({"type": "start", "subject": name})
+            await connection.send(message)
+            recorder.bytesSent += len(message)
+        seen = 0
+        started = False
+        async for text in connection:
+            now = time.perf_counter()
+            recorder.bytesReceived += len(text)
+            if text.startswith('{"type":"survey"'):
+                started = True
+                latency = now - sends[seen] if seen < len(sends) else None
+                seen = len(sends)
+                recorder.add("push", latency, len(text))
+            elif text.startswith('{"type":"noSurvey"') and started:
+                return
+
+async def participant(url: str, name: str, args: argparse.Namespace,
+                      modelName: str, mesh, meshHash: str,
+                      sends: list[float], recorder: Recorder) -> None:
+    """
+    Paint and submit a survey as a participant client
+
+    Args:
+        url: The server's websocket URL
+        name: The participant
+        args: The benchmark's parameters
+        modelName: The configured model the fields are painted on
+        mesh: The mesh uploaded with the submit
+        meshHash: The mesh's content hash
+        sends: Where the time each change is sent is appended
+        recorder: Where messages are recorded
+    """
+    from websockets.asyncio.client import connect
+    from codec import encodeText, decode, convert
+    from survey3d import Survey, ProjectedField, Quality
+
+    rng = random.Random(f"{args.seed}-{name}")
+    async with connect(f"{url}/participant-ws?session={name}",
+                       max_size = None, proxy = None) as connection:
+
+        async def request(kind: str, message: dict,
+                          replies: tuple[str, ...]) -> tuple[str, str]:
+            text = encodeText(message)
+            start = time.perf_counter()
+            if kind in ("update", "patch"):
+                sends.append(start)
+            await connection.send(text)
+            recorder.bytesSent += len(text)
+            reply = await receiveType(connection, replies, recorder)
+            recorder.add(kind, time.perf_counter() - start, len(text))
+            return reply
+
+        # The survey exists once the experimenter has started it
+        while True:
+            await connection.send(encodeText({"type": "waiting"}))
+            try:
+                _, text = await asyncio.wait_for(
+                    receiveType(connection, ("survey",), recorder), 0.05
+                )
+                break
+            except asyncio.TimeoutError:
+                continue
+        survey = convert(decode(text)["survey"], Survey)
+        qualityTypes = survey.config.get("qualityTypes", ["touch"])
+
+        version = None
+        pipelined = 0
+        perStroke = max(1, args.field_vertices // args.strokes)
+        for index in range(args.fields):
+            center = rng.uniform(0, args.vertices)
+            projectedField = ProjectedField(
+                modelName, f"field {index}",
+                hotSpot = {"x": rng.random(), "y": rng.random(),
+                           "z": rng.random()},
+                intensity = rng.uniform(0, 10),
+                qualities = [Quality(rng.uniform(0, 10), ["atSkin"], kind)
+                             for kind in rng.sample(qualityTypes, 2)]
+            )
+            survey.projectedFields.append(projectedField)
+            for strokeIndex in range(args.strokes):
+                ranges = stroke(rng, center, perStroke, args.vertices)
+                center += rng.gauss(0, args.vertices * 0.002)
+                projectedField.addVertexRanges(ranges)
+                if version is not None and args.mode == "patch":
+                    if strokeIndex == 0:
+                        op = {"op": "addField", "index": index,
+                              "field": projectedField}
+                    else:
+                        op = {"op": "addVertices", "index": index,
+                              "ranges": ranges}
+                    kind, text = await request("patch", {
+                        "type": "patch",
+                        "startTime": survey.startTime,
+                        "baseVersion": version,
+                        "ops": [op]
+                    }, ("patchAck", "resync"))
+                    if kind == "resync":
+                        recorder.error("resync")
+                        version = None
+                        continue
+                elif args.pipeline:
+                    text = encodeText({"type": "update", "survey": survey})
+                    sends.append(time.perf_counter())
+                    await connection.send(text)
+                    recorder.bytesSent += len(text)
+                    recorder.add("update", None, len(text))
+                    pipelined += 1
+                    if args.interval:
+                        await asyncio.sleep(args.interval)
+                    continue
+                else:
+                    kind, text = await request("update", {
+                        "type": "update",
+                        "survey": survey
+                    }, ("updateAck",))
+                version = decode(text)["version"]
+                if args.interval:
+                    await asyncio.sleep(args.interval)
+
+        if pipelined:
+            # A dropped update is never acknowledged, but messages are
+            # handled in order, so every ack comes before the reply to the
+            # mesh query sent after the updates
+            text = encodeText({"type": "meshQuery",
+                               "meshes": {mesh.filename: meshHash}})
+            start = time.perf_counter()
+            await connection.send(text)
+            recorder.bytesSent += len(text)
+            handled = 0
+            while True:
+                kind, reply = await receiveType(
+                    connection, ("updateAck", "meshQueryResponse"), recorder
+                )
+                if kind == "meshQueryResponse":
+                    break
+                handled += 1
+            recorder.add("meshQuery", time.perf_counter() - start, len(text))
+            recorder.updatesSent += pipelined
+            recorder.updatesHandled += handled
+            text = reply
+        else:
+            _, text = await request("meshQuery", {
+                "type": "meshQuery",
+                "meshes": {mesh.filename: meshHash}
+            }, ("meshQueryResponse",))
+        missing = decode(text)["missing"]
+        # A mesh the server can neither find nor produce is uploaded
+        _, text = await request("submit", {
+            "type": "submit",
+            "survey": survey,
+            "meshes": {mesh.filename: mesh} if missing else {},
+            "meshHashes": {mesh.filename: meshHash}
+        }, ("submitResponse",))
+        if not decode(text)["success"]:
+            recorder.error("submit")
+
+async def runLoad(app, args: argparse.Namespace, modelName: str, mesh,
+                  meshHash: str) -> tuple[Recorder, float]:
+    """
+    Serve the app and run every client against it
+
+    Returns: The recorded messages and the seconds the clients took
+    """
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(
+        app, host = "127.0.0.1", port = 0, log_level = "warning",
+        lifespan = "off"
+    ))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        if serving.done():
+            serving.result()
+        await asyncio.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    url = f"ws://127.0.0.1:{port}"
+
+    recorder = Recorder()
+    start = time.perf_counter()
+    try:
+        clients = []
+        for i in range(args.participants):
+            name = participantName(i)
+            sends = []
+            clients.append(monitor(url, name, sends, recorder, start = True))
+            clients.append(participant(url, name, args, modelName, mesh,
+                                       meshHash, sends, recorder))
+            # The other monitors are shown the survey once it is started
+            for _ in range(args.monitors - 1):
+                clients.append(monitor(url, name, sends, recorder))
+        await asyncio.wait_for(asyncio.gather(*clients), args.timeout)
+    finally:
+        elapsed = time.perf_counter() - start
+        server.should_exit = True
+        await serving
+    return recorder, elapsed
+
+def run(args: argparse.Namespace) -> dict:
+    """
+    Run the benchmark in a scratch copy of the backend's folders
+
+    Returns: The results, as saved by --output
+    """
+    root, template = makeScratch(args.participants)
+    modelName, model = next(iter(template["models"].items()))
+    cwd = os.getcwd()
+    try:
+        os.chdir(os.path.join(root, "backend"))
+        mesh = makeMesh(model["file"], args.vertices, args.seed)
+        meshHash = mesh.contentHash()
+        serveModel(root, model["file"], mesh)
+        output = (contextlib.nullcontext() if args.verbose
+                  else contextlib.redirect_stdout(open(os.devnull, 'w')))
+        with output:
+            import main
+            baseline = peakRss()
+            recorder, elapsed = asyncio.run(
+                runLoad(main.app, args, modelName, mesh, meshHash)
+            )
+            main.manager.catalog.close()
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print(f"Scratch folder kept at {root}")
+        else:
+            shutil.rmtree(root, ignore_errors = True)
+
+    messages = recorder.summary()
+    requests = sum(messages[kind]["count"] for kind in messages
+                   if kind != "push")
+    return {
+        "version": RESULTS_VERSION,
+        "date": datetime.now().isoformat(timespec = "seconds"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "parameters": {
+            key: value for key, value in vars(args).items()
+            if key not in ("output", "compare", "results", "tolerance",
+                           "keep", "verbose", "timeout")
+        },
+        "seconds": elapsed,
+        "throughput": {
+            "messages": requests / elapsed,
+            "pushes": messages.get("push", {}).get("count", 0) / elapsed,
+            "bytesSent": recorder.bytesSent / elapsed,
+            "bytesReceived": recorder.bytesReceived / elapsed
+        },
+        "messages": messages,
+        "rss": {"baseline": baseline, "peak": peakRss()},
+        "pipeline": {
+            "sent": recorder.updatesSent,
+            "handled": recorder.updatesHandled,
+            "dropped": recorder.updatesSent - recorder.updatesHandled
+        },
+        "errors": recorder.errors
+    }
+
+def report(results: dict) -> None:
+    parameters = results["parameters"]
+    print(f"{parameters['participants']} participants, "
+          f"{parameters['monitors']} experimenters each, "
+          f"{parameters['fields']} fields of {parameters['field_vertices']} "
+          f"vertices in {parameters['strokes']} {parameters['mode']} strokes, "
+          f"{parameters['vertices']} vertex mesh")
+    print(f"{'':<12}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+          f"{'mean B':>12}{'max B':>12}")
+    for kind, stats in results["messages"].items():
+        latencies = "".join(
+            f"{stats[key]:>10.2f}" if key in stats else f"{'-':>10}"
+            for key in ("p50", "p99", "max")
+        )
+        print(f"{kind:<12}{stats['count']:>8}{latencies}"
+              f"{stats['bytesMean']:>12.0f}{stats['bytesMax']:>12}")
+    throughput = results["throughput"]
+    print(f"{throughput['messages']:.1f} messages/s and "
+          f"{throughput['pushes']:.1f} pushes/s over "
+          f"{results['seconds']:.2f} s; "
+          f"{throughput['bytesSent'] / 1e6:.2f} MB/s sent, "
+          f"{throughput['bytesReceived'] / 1e6:.2f} MB/s received")
+    rss = results["rss"]
+    print(f"Peak RSS {rss['peak'] / 1e6:.1f} MB "
+          f"({rss['baseline'] / 1e6:.1f} MB before the clients connected)")
+    pipeline = results.get("pipeline", {})
+    if pipeline.get("sent"):
+        print(f"Of {pipeline['sent']} pipelined updates the server handled "
+              f"{pipeline['handled']} and dropped {pipeline['dropped']} as "
+              "superseded")
+    if results["errors"]:
+        print(f"Errors: {results['errors']}")
+
+def metrics(results: dict) -> dict[str, tuple[float, bool]]:
+    """
+    Return the figures compared between runs, each with whether a higher
+    value is better
+    """
+    figures = {
+        "throughput messages/s": (results["throughput"]["messages"], True),
+        "peak RSS MB": (results["rss"]["peak"] / 1e6, False)
+    }
+    for kind, stats in results["messages"].items():
+        for key in ("p50", "p99"):
+            if key in stats:
+                figures[f"{kind} {key} ms"] = (stats[key], False)
+    return figures
+
+def compare(baseline: dict, results: dict, tolerance: float) -> bool:
+    """
+    Print the change of each figure from a baseline
+
+    Returns: True if no figure is worse than the baseline by more than the
+        tolerance, a fraction
+    """
+    if baseline.get("version") != results["version"]:
+        print("Baseline was measured by another version of the benchmark")
+        return False
+    differing = {
+        key: (baseline["parameters"].get(key), value)
+        for key, value in results["parameters"].items()
+        if baseline["parameters"].get(key) != value
+    }
+    if differing:
+        print(f"Warning: parameters differ from the baseline: {differing}")
+    old = metrics(baseline)
+    passed = True
+    print(f"{'':<24}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, (value, higherIsBetter) in metrics(results).items():
+        if name not in old:
+            continue
+        before = old[name][0]
+        change = (value - before) / before if before else 0.0
+        worse = -change if higherIsBetter else change
+        flag = ""
+        if worse > tolerance:
+            flag = "  REGRESSION"
+            passed = False
+        print(f"{name:<24}{before:>12.2f}{value:>12.2f}{change:>+10.1%}{flag}")
+    return passed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__.split("\n\n")[0])
+    parser.add_argument("--participants", type = int, default = 2)
+    parser.add_argument("--monitors", type = int, default = 2,
+                        help = "experimenter clients following each "
+                               "participant, the first of which starts its "
+                               "survey")
+    parser.add_argument("--fields", type = int, default = 8)
+    parser.add_argument("--field-vertices", type = int, default = 20000)
+    parser.add_argument("--strokes", type = int, default = 25,
+                        help = "messages sent while painting each field")
+    parser.add_argument("--vertices", type = int, default = 50000,
+                        help = "vertices of the submitted mesh")
+    parser.add_argument("--mode", choices = ("patch", "update"),
+                        default = "patch",
+                        help = "send patches as the frontend does, or a full "
+                               "update for every stroke")
+    parser.add_argument("--pipeline", action = "store_true",
+                        help = "with --mode update, send updates without "
+                               "waiting for their acks")
+    parser.add_argument("--interval", type = float, default = 0.0,
+                        help = "seconds each participant pauses between "
+                               "strokes")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--timeout", type = float, default = 600.0)
+    parser.add_argument("--output", help = "save the results to this file")
+    parser.add_argument("--compare",
+                        help = "compare the results with those in this file")
+    parser.add_argument("--results",
+                        help = "load the results from this file instead of "
+                               "running the benchmark")
+    parser.add_argument("--tolerance", type = float, default = 0.1,
+                        help = "the fraction by which a figure may be worse "
+                               "than the baseline")
+    parser.add_argument("--keep", action = "store_true",
+                        help = "keep the scratch data folder")
+    parser.add_argument("--verbose", action = "store_true",
+                        help = "show the server's output")
+    args = parser.parse_args()
+    args.monitors = max(1, args.monitors)
+    if args.pipeline and args.mode != "update":
+        parser.error("--pipeline needs --mode update")
+
+    if args.results:
+        with open(args.results, 'r') as file:
+            results = json.load(file)
+    else:
+        results = run(args)
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent = 4)
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            baseline = json.load(file)
+        print()
+        if not compare(baseline, results, args.tolerance):
+            sys.exit(1)
@@ -0,0 +1,298 @@
+"""
+An SQLite catalog of every saved survey, so surveys can be found by
+participant, date, model and quality without reading the survey files.
+
+The catalog holds one row per survey, per projected field and per quality of
+each field, indexed for the queries of SurveyCatalog.query. Surveys are
+added as they are saved; running this module rebuilds the catalog of a data
+folder from its survey files:
+
+    python catalog.py ../data
+"""
+import os
+import sys
+import json
+import glob
+import sqlite3
+import threading
+from survey3d import Survey
+
+CATALOG = "catalog.sqlite3"
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS surveys (
+    filename TEXT PRIMARY KEY,
+    participant TEXT NOT NULL,
+    date TEXT NOT NULL,
+    startTime TEXT NOT NULL,
+    endTime TEXT NOT NULL,
+    fieldCount INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fields (
+    survey TEXT NOT NULL REFERENCES surveys(filename) ON DELETE CASCADE,
+    field INTEGER NOT NULL,
+    model TEXT NOT NULL,
+    modelFile TEXT NOT NULL,
+    name TEXT NOT NULL,
+    vertexCount INTEGER NOT NULL,
+    naturalness REAL,
+    pain REAL,
+    intensity REAL,
+    PRIMARY KEY (survey, field)
+);
+CREATE TABLE IF NOT EXISTS qualities (
+    survey TEXT NOT NULL REFERENCES surveys(filename) ON DELETE CASCADE,
+    field INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    intensity REAL,
+    PRIMARY KEY (survey, field, type)
+);
+CREATE INDEX IF NOT EXISTS surveysByParticipant
+    ON surveys (participant, date, startTime);
+CREATE INDEX IF NOT EXISTS surveysByDate ON surveys (date, startTime);
+CREATE INDEX IF NOT EXISTS fieldsByModelFile ON fields (modelFile, survey);
+CREATE INDEX IF NOT EXISTS fieldsByModel ON fields (model, survey);
+CREATE INDEX IF NOT EXISTS qualitiesByType
+    ON qualities (type, intensity, survey);
+"""
+
+def _number(value) -> float | None:
+    return None if value is None else float(value)
+
+class SurveyCatalog():
+    """
+    Maintains the catalog of the surveys in a data folder. Safe to call from
+    the persistence writer's threads and from request handlers
+    """
+    path: str
+
+    def __init__(self, path: str):
+        """
+        Class initialization function
+
+        Args:
+            path: The catalog's database file, created if missing
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread = False)
+        self._connection.row_factory = sqlite3.Row
+        with self._lock, self._connection as connection:
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA foreign_keys = ON")
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version not in (0, SCHEMA_VERSION):
+                raise ValueError(
+                    f"Catalog {path} has schema version {version}; "
+                    "delete it and rebuild it with catalog.py"
+                )
+            connection.executescript(SCHEMA)
+            connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def has(self, filename: str) -> bool:
+        """
+        Return True if the survey saved under the given filename is in the
+        catalog
+        """
+        with self._lock:
+            return self._connection.execute(
+                "SELECT 1 FROM surveys WHERE filename = ?", (filename,)
+            ).fetchone() is not None
+
+    def add(self, surveys: list[Survey],
+            filenames: list[str] | None = None) -> int:
+        """
+        Add surveys to the catalog, replacing any already catalogued under
+        the same filenames, in one transaction
+
+        Args:
+            surveys: The surveys to be added
+            filenames: The names the surveys were saved under, by default
+            their Survey.filename
+
+        Returns: The number of surveys added
+        """
+        if filenames is None:
+            filenames = [survey.filename for survey in surveys]
+        with self._lock, self._connection as connection:
+            for filename, survey in zip(filenames, surveys):
+                self._insert(connection, filename, survey)
+        return len(filenames)
+
+    def _insert(self, connection: sqlite3.Connection, filename: str,
+                survey: Survey) -> None:
+        connection.execute(
+            "DELETE FROM surveys WHERE filename = ?", (filename,)
+        )
+        connection.execute(
+            "INSERT INTO surveys VALUES (?, ?, ?, ?, ?, ?)",
+            (filename, survey.participant, survey.date, survey.startTime,
+             survey.endTime, len(survey.projectedFields))
+        )
+        models = survey.config.get("models", {})
+        fields = []
+        qualities = []
+        for index, projectedField in enumerate(survey.projectedFields):
+            model = models.get(projectedField.model, {})
+            modelFile = (model.get("file", projectedField.model)
+                         if isinstance(model, dict) else model)
+            fields.append((
+                filename, index, projectedField.model, modelFile,
+                projectedField.name, len(projectedField.vertices),
+                _number(projectedField.naturalness),
+                _number(projectedField.pain),
+                _number(projectedField.intensity)
+            ))
+            for quality in projectedField.qualities:
+                qualities.append((filename, index, quality.type,
+                                  _number(quality.intensity)))
+        connection.executemany(
+            "INSERT INTO fields VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", fields
+        )
+        connection.executemany(
+            "INSERT OR REPLACE INTO qualities VALUES (?, ?, ?, ?)", qualities
+        )
+
+    def rebuild(self, dataPath: str) -> int:
+        """
+        Replace the catalog's contents with the surveys in a data folder
+
+        Args:
+            dataPath: The folder holding Survey3D_*.json files
+
+        Returns: The number of surveys catalogued
+        """
+        added = 0
+        with self._lock, self._connection as connection:
+            connection.execute("DELETE FROM surveys")
+            for path in sorted(glob.glob(os.path.join(dataPath,
+                                                      "Survey3D_*.json"))):
+                try:
+                    with open(path, 'r') as file:
+                        survey = Survey()
+                        survey.fromDict(json.load(file))
+                except (OSError, ValueError, KeyError, TypeError) as e:
+                    print(f"Could not catalog {path}: {e}")
+                    continue
+                self._insert(connection, os.path.basename(path), survey)
+                added += 1
+        return added
+
+    def query(self, participant: str | None = None,
+              model: str | None = None, quality: str | None = None,
+              minIntensity: float | None = None,
+              dateFrom: str | None = None, dateTo: str | None = None,
+              limit: int = 50, offset: int = 0) -> dict:
+        """
+        Find the surveys matching every filter given, newest first
+
+        Args:
+            participant: The participant of the survey
+            model: A model with a field drawn on it, by name or by file
+            quality: A quality reported for a field
+            minIntensity: The lowest quality intensity, or if no quality is
+            given the lowest field intensity, of a matching field
+            dateFrom: The earliest date, as YYYY-MM-DD
+            dateTo: The latest date, as YYYY-MM-DD
+            limit: The most surveys to return
+            offset: The number of matching surveys to skip
+
+        Returns: A dictionary of the matching surveys, each with the models
+            and quality types of its fields, and the offset of the next page
+            or None if this is the last
+        """
+        where = []
+        parameters = []
+        if participant is not None:
+            where.append("s.participant = ?")
+            parameters.append(participant)
+        if dateFrom is not None:
+            where.append("s.date >= ?")
+            parameters.append(dateFrom)
+        if dateTo is not None:
+            where.append("s.date <= ?")
+            parameters.append(dateTo)
+        # Field filters must hold for the same field, so they share one
+        # EXISTS clause
+        fieldWhere = ["f.survey = s.filename"]
+        if model is not None:
+            fieldWhere.append("(f.model = ? OR f.modelFile = ?)")
+            parameters += [model, model]
+        if quality is not None:
+            qualityWhere = "q.survey = f.survey AND q.field = f.field " \
+                           "AND q.type = ?"
+            parameters.append(quality)
+            if minIntensity is not None:
+                qualityWhere += " AND q.intensity >= ?"
+                parameters.append(minIntensity)
+            fieldWhere.append(
+                f"EXISTS (SELECT 1 FROM qualities q WHERE {qualityWhere})"
+            )
+        elif minIntensity is not None:
+            fieldWhere.append("f.intensity >= ?")
+            parameters.append(minIntensity)
+        if len(fieldWhere) > 1:
+            where.append("EXISTS (SELECT 1 FROM fields f WHERE "
+                         + " AND ".join(fieldWhere) + ")")
+
+        sql = "SELECT s.* FROM surveys s"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        # One extra row tells whether there is a next page without counting
+        sql += " ORDER BY s.date DESC, s.startTime DESC, s.filename " \
+               "LIMIT ? OFFSET ?"
+        parameters += [limit + 1, offset]
+        with self._lock:
+            rows = self._connection.execute(sql, parameters).fetchall()
+            surveys = [dict(row) for row in rows[:limit]]
+            for survey in surveys:
+                survey["models"] = [r[0] for r in self._connection.execute(
+                    "SELECT DISTINCT modelFile FROM fields WHERE survey = ? "
+                    "ORDER BY modelFile", (survey["filename"],)
+                )]
+                survey["qualities"] = [r[0] for r in self._connection.execute(
+                    "SELECT DISTINCT type FROM qualities WHERE survey = ? "
+                    "ORDER BY type", (survey["filename"],)
+                )]
+        return {
+            "surveys": surveys,
+            "next": offset + limit if len(rows) > limit else None
+        }
+
+    def get(self, filename: str) -> dict | None:
+        """
+        Return a catalogued survey with its fields and their qualities, or
+        None if there is no such survey
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT * FROM surveys WHERE filename = ?", (filename,)
+            ).fetchone()
+            if row is None:
+                return None
+            survey = dict(row)
+            fields = self._connection.execute(
+                "SELECT field, model, modelFile, name, vertexCount, "
+                "naturalness, pain, intensity FROM fields WHERE survey = ? "
+                "ORDER BY field", (filename,)
+            )
+            survey["fields"] = [dict(r, qualities = []) for r in fields]
+            for r in self._connection.execute(
+                "SELECT field, type, intensity FROM qualities "
+                "WHERE survey = ? ORDER BY field, type", (filename,)
+            ):
+                survey["fields"][r["field"]]["qualities"].append(
+                    {"type": r["type"], "intensity": r["intensity"]}
+                )
+        return survey
+
+if __name__ == "__main__":
+    folder = sys.argv[1] if len(sys.argv) > 1 else "../data/"
+    catalog = SurveyCatalog(os.path.join(folder, CATALOG))
+    print(f"Catalogued {catalog.rebuild(folder)} surveys")
+    catalog.close()
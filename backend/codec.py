@@ -0,0 +1,106 @@
+"""
+JSON encoding and decoding of the survey data model with msgspec.
+
+The dataclasses of survey3d are encoded field by field straight to bytes, in
+the same shape as their toDict methods produce, and JSON is decoded straight
+into them, checking every value against the fields' annotations on the way.
+A VertexSet is encoded as its {"runs": [...]} run encoding and decoded from
+either that or a legacy list of indices.
+"""
+from time import perf_counter
+from typing import Any, Union, get_args, get_origin
+import msgspec
+from vertexset import VertexSet
+from metrics import REGISTRY
+
+CODEC_SECONDS = REGISTRY.histogram(
+    "survey3d_codec_seconds",
+    "Time taken to encode and decode JSON, by operation and type",
+    ("operation", "type")
+)
+
+def _encodeHook(obj):
+    if isinstance(obj, VertexSet):
+        return obj.toJSON()
+    raise NotImplementedError(f"Cannot encode {type(obj).__name__}")
+
+def _decodeHook(type, obj):
+    if type is VertexSet:
+        if not isinstance(obj, (dict, list)):
+            raise ValueError("Vertices must be {\"runs\": [...]} or a list")
+        return VertexSet.fromJSON(obj)
+    raise NotImplementedError(f"Cannot decode {type}")
+
+def _typeName(type) -> str:
+    if get_origin(type) is Union:
+        return "|".join(_typeName(arg) for arg in get_args(type))
+    return getattr(type, "__name__", str(type))
+
+def _label(obj) -> str:
+    # Messages and journal records are dictionaries told apart by their type
+    if isinstance(obj, dict) and isinstance(obj.get("type"), str):
+        return obj["type"]
+    return type(obj).__name__
+
+_encoder = msgspec.json.Encoder(enc_hook = _encodeHook)
+_decoders = {}
+
+# The errors raised for payloads which are not valid JSON, or do not match
+# the type they are decoded as
+DecodeError = msgspec.DecodeError
+
+def encode(obj) -> bytes:
+    """
+    Encode an object, which may contain survey3d dataclasses and VertexSets,
+    as compact JSON
+    """
+    start = perf_counter()
+    data = _encoder.encode(obj)
+    CODEC_SECONDS.observe(perf_counter() - start, "encode", _label(obj))
+    return data
+
+def encodeText(obj) -> str:
+    """
+    Encode an object as compact JSON text, for websocket text frames
+    """
+    return encode(obj).decode("utf-8")
+
+def encodePretty(obj) -> bytes:
+    """
+    Encode an object as JSON indented by four spaces, the layout of saved
+    survey, mesh and landmark files
+    """
+    return msgspec.json.format(encode(obj), indent = 4)
+
+def decode(data: bytes | str, type = Any):
+    """
+    Decode JSON into the given type, such as survey3d.Survey or a message
+    Struct, validating it as it is read
+
+    Args:
+        data: The JSON to be decoded
+        type: The type to decode into; by default plain dicts and lists
+
+    Returns: The decoded object
+
+    Raises: DecodeError if the JSON is invalid or does not match the type
+    """
+    cached = _decoders.get(type)
+    if cached is None:
+        cached = _decoders[type] = (
+            msgspec.json.Decoder(type, dec_hook = _decodeHook),
+            _typeName(type)
+        )
+    decoder, name = cached
+    start = perf_counter()
+    try:
+        return decoder.decode(data)
+    finally:
+        CODEC_SECONDS.observe(perf_counter() - start, "decode", name)
+
+def convert(obj, type):
+    """
+    Convert already-parsed JSON, such as a journal record's survey, into the
+    given type with the same validation as decode
+    """
+    return msgspec.convert(obj, type, dec_hook = _decodeHook)
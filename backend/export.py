@@ -0,0 +1,320 @@
+"""
+A columnar export of every saved survey, for cohort-level analysis.
+
+The export folder holds
+
+    manifest.json                        the surveys exported, and the parts
+    fields/part-NNNNN.parquet            one row per projected field
+    qualities/part-NNNNN.parquet         one row per quality of each field
+    matrices/<model>/part-NNNNN.indptr.npy
+    matrices/<model>/part-NNNNN.indices.npy
+
+Each part holds the surveys exported together. The matrices are the CSR
+vertex-membership rows of that part's fields on each model, one row per
+field in the order given by the fields table's "row" column. They are plain
+.npy files, so they can be opened with np.load(..., mmap_mode="r"), and the
+Parquet tables can be read a few columns at a time.
+
+New surveys are added as they are saved; running this module adds any
+surveys in a data folder which are missing from its export:
+
+    python export.py ../data
+"""
+import os
+import re
+import sys
+import json
+import glob
+import threading
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from persistence import atomicOpen, processLock, fileStamp
+from survey3d import Survey
+
+MANIFEST = "manifest.json"
+# Held by the server process adding to the export, when there are several
+LOCK = "export.lock"
+MANIFEST_VERSION = 1
+
+FIELD_SCHEMA = pa.schema([
+    ("survey", pa.string()),
+    ("participant", pa.string()),
+    ("date", pa.string()),
+    ("startTime", pa.string()),
+    ("endTime", pa.string()),
+    ("field", pa.int32()),
+    ("model", pa.string()),
+    ("modelFile", pa.string()),
+    ("meshHash", pa.string()),
+    ("name", pa.string()),
+    ("hotSpotX", pa.float64()),
+    ("hotSpotY", pa.float64()),
+    ("hotSpotZ", pa.float64()),
+    ("naturalness", pa.float64()),
+    ("pain", pa.float64()),
+    ("intensity", pa.float64()),
+    ("vertexCount", pa.int64()),
+    ("part", pa.string()),
+    ("row", pa.int64())
+])
+
+QUALITY_SCHEMA = pa.schema([
+    ("survey", pa.string()),
+    ("field", pa.int32()),
+    ("type", pa.string()),
+    ("intensity", pa.float64()),
+    ("depth", pa.list_(pa.string()))
+])
+
+def modelFolder(modelFile: str) -> str:
+    """
+    Return the folder name under matrices/ for a model file
+    """
+    return re.sub(r"[^A-Za-z0-9._-]", "_", modelFile)
+
+def _number(value) -> float | None:
+    return None if value is None else float(value)
+
+class SurveyExporter():
+    """
+    Maintains the columnar export of the surveys in a data folder, adding
+    each batch of newly saved surveys as a new part. Safe to call from the
+    persistence writer's threads, and from several server processes, each
+    of which rereads the manifest when another has added to the export
+    """
+    path: str
+
+    def __init__(self, path: str):
+        """
+        Class initialization function
+
+        Args:
+            path: The export folder, created if missing
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        for folder in ("fields", "qualities", "matrices"):
+            os.makedirs(os.path.join(path, folder), exist_ok = True)
+        self.manifest = self._readManifest()
+        self._stamp = fileStamp(os.path.join(path, MANIFEST))
+
+    def _refresh(self) -> None:
+        """
+        Reread the manifest if another process has replaced it
+        """
+        stamp = fileStamp(os.path.join(self.path, MANIFEST))
+        if stamp != self._stamp:
+            self.manifest = self._readManifest()
+            self._stamp = stamp
+
+    def _readManifest(self) -> dict:
+        manifestPath = os.path.join(self.path, MANIFEST)
+        if os.path.isfile(manifestPath):
+            with open(manifestPath, 'r') as file:
+                return json.load(file)
+        return {
+            "version": MANIFEST_VERSION,
+            "surveys": {},
+            "parts": [],
+            "models": {}
+        }
+
+    def has(self, filename: str) -> bool:
+        """
+        Return True if the survey saved under the given filename is exported
+        """
+        return filename in self.manifest["surveys"]
+
+    def add(self, surveys: list[Survey], 
+            filenames: list[str] | None = None) -> str | None:
+        """
+        Export surveys which are not yet in the export as one new part
+
+        Args:
+            surveys: The surveys to be exported
+            filenames: The names the surveys were saved under, by default 
+            their Survey.filename
+
+        Returns: The name of the new part, or None if every survey was
+            already exported
+        """
+        if filenames is None:
+            filenames = [survey.filename for survey in surveys]
+        with self._lock, processLock(os.path.join(self.path, LOCK)):
+            self._refresh()
+            surveys = [
+                (filename, survey) 
+                for filename, survey in zip(filenames, surveys)
+                if not self.has(filename)
+            ]
+            if not surveys:
+                return None
+            part = f"part-{len(self.manifest['parts']):05d}"
+            fields, qualities, matrices = self._columns(surveys, part)
+
+            with atomicOpen(os.path.join(self.path, "fields", 
+                                         part + ".parquet"), 'wb') as file:
+                pq.write_table(
+                    pa.Table.from_pydict(fields, schema = FIELD_SCHEMA), 
+                    file
+                )
+            with atomicOpen(os.path.join(self.path, "qualities", 
+                                         part + ".parquet"), 'wb') as file:
+                pq.write_table(
+                    pa.Table.from_pydict(qualities, schema = QUALITY_SCHEMA),
+                    file
+                )
+            for modelFile, (indptr, indices) in matrices.items():
+                folder = os.path.join(self.path, "matrices",
+                                      modelFolder(modelFile))
+                os.makedirs(folder, exist_ok = True)
+                for suffix, array in ((".indptr.npy", indptr), 
+                                      (".indices.npy", indices)):
+                    with atomicOpen(os.path.join(folder, part + suffix), 
+                                    'wb') as file:
+                        np.save(file, array)
+                model = self.manifest["models"].setdefault(
+                    modelFile,
+                    {"folder": modelFolder(modelFile), "parts": []}
+                )
+                model["parts"].append({
+                    "part": part,
+                    "rows": len(indptr) - 1,
+                    "columns": int(indices.max()) + 1 if len(indices) else 0
+                })
+
+            # The manifest is written last, so a crash part way through an
+            # export leaves only files the manifest does not refer to, which
+            # the next export overwrites
+            self.manifest["parts"].append(part)
+            for filename, survey in surveys:
+                self.manifest["surveys"][filename] = {
+                    "part": part,
+                    "fields": len(survey.projectedFields)
+                }
+            with atomicOpen(os.path.join(self.path, MANIFEST), 'w') as file:
+                json.dump(self.manifest, file, indent = 4)
+            self._stamp = fileStamp(os.path.join(self.path, MANIFEST))
+            return part
+
+    def _columns(self, surveys: list[tuple[str, Survey]], 
+                 part: str) -> tuple:
+        """
+        Flatten (filename, survey) pairs into the columns of the field and 
+        quality tables and the CSR arrays of each model's fields
+        """
+        fields = {name: [] for name in FIELD_SCHEMA.names}
+        qualities = {name: [] for name in QUALITY_SCHEMA.names}
+        rows = {}
+        for filename, survey in surveys:
+            models = survey.config.get("models", {})
+            for index, projectedField in enumerate(survey.projectedFields):
+                model = models.get(projectedField.model, {})
+                modelFile = (model.get("file", projectedField.model)
+                             if isinstance(model, dict) else model)
+                modelRows = rows.setdefault(modelFile, [])
+                hotSpot = projectedField.hotSpot or {}
+                fields["survey"].append(filename)
+                fields["participant"].append(survey.participant)
+                fields["date"].append(survey.date)
+                fields["startTime"].append(survey.startTime)
+                fields["endTime"].append(survey.endTime)
+                fields["field"].append(index)
+                fields["model"].append(projectedField.model)
+                fields["modelFile"].append(modelFile)
+                fields["meshHash"].append(survey.meshes.get(modelFile))
+                fields["name"].append(projectedField.name)
+                fields["hotSpotX"].append(_number(hotSpot.get("x")))
+                fields["hotSpotY"].append(_number(hotSpot.get("y")))
+                fields["hotSpotZ"].append(_number(hotSpot.get("z")))
+                fields["naturalness"].append(
+                    _number(projectedField.naturalness)
+                )
+                fields["pain"].append(_number(projectedField.pain))
+                fields["intensity"].append(_number(projectedField.intensity))
+                fields["vertexCount"].append(len(projectedField.vertices))
+                fields["part"].append(part)
+                fields["row"].append(len(modelRows))
+                modelRows.append(projectedField.vertices)
+                for quality in projectedField.qualities:
+                    qualities["survey"].append(filename)
+                    qualities["field"].append(index)
+                    qualities["type"].append(quality.type)
+                    qualities["intensity"].append(_number(quality.intensity))
+                    qualities["depth"].append(list(quality.depth))
+
+        matrices = {}
+        for modelFile, vertexSets in rows.items():
+            indptr = np.zeros(len(vertexSets) + 1, dtype = np.int64)
+            np.cumsum([len(v) for v in vertexSets], out = indptr[1:])
+            indices = np.empty(indptr[-1], dtype = np.int32)
+            for i, vertexSet in enumerate(vertexSets):
+                # Expand each run with arange rather than one index at a time
+                row = [np.arange(start, stop, dtype = np.int32)
+                       for start, stop in vertexSet.ranges()]
+                if row:
+                    indices[indptr[i]:indptr[i + 1]] = np.concatenate(row)
+            matrices[modelFile] = (indptr, indices)
+        return fields, qualities, matrices
+
+    def addFolder(self, dataPath: str) -> str | None:
+        """
+        Export every survey in a data folder which is not yet exported
+
+        Args:
+            dataPath: The folder holding Survey3D_*.json files
+
+        Returns: The name of the new part, or None if nothing was exported
+        """
+        surveys = []
+        filenames = []
+        for path in sorted(glob.glob(os.path.join(dataPath, "Survey3D_*.json"))):
+            if self.has(os.path.basename(path)):
+                continue
+            try:
+                with open(path, 'r') as file:
+                    survey = Survey()
+                    survey.fromDict(json.load(file))
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print(f"Could not export {path}: {e}")
+                continue
+            surveys.append(survey)
+            filenames.append(os.path.basename(path))
+        return self.add(surveys, filenames)
+
+def readFieldMatrix(path: str, modelFile: str) -> list[tuple]:
+    """
+    Open the CSR vertex-membership arrays of one model's fields in an export
+    without reading them into memory
+
+    Args:
+        path: The export folder
+        modelFile: The model's filename
+
+    Returns: A list with one (part, indptr, indices, columns) tuple per part,
+        where indptr and indices are read-only memory maps
+    """
+    with open(os.path.join(path, MANIFEST), 'r') as file:
+        model = json.load(file)["models"][modelFile]
+    folder = os.path.join(path, "matrices", model["folder"])
+    return [
+        (
+            entry["part"],
+            np.load(os.path.join(folder, entry["part"] + ".indptr.npy"),
+                    mmap_mode = "r"),
+            np.load(os.path.join(folder, entry["part"] + ".indices.npy"),
+                    mmap_mode = "r"),
+            entry["columns"]
+        )
+        for entry in model["parts"]
+    ]
+
+if __name__ == "__main__":
+    folder = sys.argv[1] if len(sys.argv) > 1 else "../data/"
+    exporter = SurveyExporter(os.path.join(folder, "export"))
+    part = exporter.addFolder(folder)
+    if part is None:
+        print("Every survey is already exported")
+    else:
+        print(f"Exported new surveys as {part}")
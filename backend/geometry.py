@@ -0,0 +1,376 @@
+"""
+Geometry statistics of projected fields, computed on the server from tables
+precomputed once per mesh, so that analyses need not rebuild a mesh's
+adjacency for every survey.
+
+The tables of a mesh are its faces' areas and unit normals, each vertex's
+area (a third of the area of each face it is a corner of), and the adjacency
+of its vertices as a CSR matrix of edge lengths. Vertices at the same
+position are welded together in the adjacency, so that meshes stored with
+separate vertices for each face, as unindexed glTF geometry is, are still
+connected. The tables are kept in memory and beside the mesh in the mesh
+store as <hash>.tables.npz.
+
+From them each field's statistics (see survey3d.FieldStatistics) take a few
+array operations:
+
+    area             the sum of the areas of the field's vertices
+    centroid         the area-weighted mean position of the field's vertices
+    normal           the area-weighted mean normal of the faces whose
+                     corners are all in the field
+    components       the number of connected patches the field is made of
+    hotSpotDistance  the distance along the mesh's edges from the vertex
+                     nearest the hotspot to the nearest vertex of the field,
+                     0 if the hotspot is on the field
+
+Surveys are measured as they are saved; running this module adds the
+statistics to the saved surveys of a data folder which lack them:
+
+    python geometry.py ../data
+"""
+import os
+import sys
+import glob
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, dijkstra
+from persistence import atomicOpen
+from survey3d import Survey, FieldStatistics, MeshStore
+from vertexset import VertexSet
+from meshbin import MeshArrays
+from codec import encodePretty, decode
+
+# Bumped whenever the tables would be computed differently, so that stale
+# tables are not reused
+TABLES_VERSION = 1
+EXTENSION = ".tables.npz"
+
+@dataclass
+class MeshTables():
+    """
+    The precomputed tables of one mesh
+    """
+    vertices: np.ndarray
+    faces: np.ndarray
+    faceAreas: np.ndarray
+    faceNormals: np.ndarray
+    vertexAreas: np.ndarray
+    weld: np.ndarray
+    weldedVertices: np.ndarray
+    adjacency: csr_matrix
+
+    @classmethod
+    def fromMesh(cls, mesh: MeshArrays) -> "MeshTables":
+        """
+        Compute the tables of a mesh
+        """
+        vertices = np.asarray(mesh.vertices, dtype = np.float64).reshape(-1, 3)
+        faces = np.asarray(mesh.faces, dtype = np.int64).reshape(-1, 3)
+        corners = vertices[faces]
+        cross = np.cross(corners[:, 1] - corners[:, 0],
+                         corners[:, 2] - corners[:, 0])
+        doubleAreas = np.linalg.norm(cross, axis = 1)
+        faceAreas = doubleAreas / 2
+        faceNormals = np.divide(cross, doubleAreas[:, None],
+                                out = np.zeros_like(cross),
+                                where = doubleAreas[:, None] > 0)
+        vertexAreas = np.bincount(faces.ravel(),
+                                  weights = np.repeat(faceAreas / 3, 3),
+                                  minlength = len(vertices))
+
+        # Viewing each position as one opaque value makes finding the unique
+        # positions a flat sort rather than np.unique's sort of rows
+        rows = np.ascontiguousarray(vertices).view(
+            np.dtype((np.void, vertices.itemsize * 3))
+        ).ravel()
+        _, first, weld = np.unique(rows, return_index = True,
+                                   return_inverse = True)
+        weld = weld.reshape(-1)
+        weldedVertices = vertices[first]
+
+        # Each edge is shared by the faces either side of it, and the CSR
+        # matrix merges the copies as it sorts its indices, so its data is
+        # only a count until the lengths are filled in
+        weldedFaces = weld[faces]
+        start = weldedFaces.ravel()
+        end = np.roll(weldedFaces, -1, axis = 1).ravel()
+        keep = start != end
+        start, end = start[keep], end[keep]
+        adjacency = csr_matrix(
+            (np.ones(2 * len(start)), (np.concatenate([start, end]),
+                                       np.concatenate([end, start]))),
+            shape = (len(weldedVertices),) * 2
+        )
+        adjacency.sum_duplicates()
+        origins = np.repeat(np.arange(len(weldedVertices)),
+                            np.diff(adjacency.indptr))
+        adjacency.data = np.linalg.norm(
+            weldedVertices[origins] - weldedVertices[adjacency.indices],
+            axis = 1
+        )
+        return cls(vertices, faces, faceAreas, faceNormals, vertexAreas,
+                   weld, weldedVertices, adjacency)
+
+    def toArrays(self) -> dict:
+        return {
+            "version": np.array(TABLES_VERSION),
+            "vertices": self.vertices,
+            "faces": self.faces,
+            "faceAreas": self.faceAreas,
+            "faceNormals": self.faceNormals,
+            "vertexAreas": self.vertexAreas,
+            "weld": self.weld,
+            "weldedVertices": self.weldedVertices,
+            "indptr": self.adjacency.indptr,
+            "indices": self.adjacency.indices,
+            "lengths": self.adjacency.data
+        }
+
+    @classmethod
+    def fromArrays(cls, arrays) -> "MeshTables":
+        welded = len(arrays["weldedVertices"])
+        adjacency = csr_matrix(
+            (arrays["lengths"], arrays["indices"], arrays["indptr"]),
+            shape = (welded, welded)
+        )
+        return cls(arrays["vertices"], arrays["faces"], arrays["faceAreas"],
+                   arrays["faceNormals"], arrays["vertexAreas"],
+                   arrays["weld"], arrays["weldedVertices"], adjacency)
+
+def expandRanges(vertices: VertexSet, 
+                 size: int | None = None) -> np.ndarray:
+    """
+    Return every index of a VertexSet as an array, without a Python loop
+    over its vertices
+
+    Args:
+        vertices: The VertexSet to be expanded
+        size: If given, the ranges are clipped to [0, size) before they are
+        expanded, so indices beyond a mesh cost nothing
+
+    Returns: The VertexSet's indices in ascending order
+    """
+    ranges = np.array(vertices.ranges(), dtype = np.int64).reshape(-1, 2)
+    if size is not None:
+        ranges = np.clip(ranges, 0, size)
+    lengths = ranges[:, 1] - ranges[:, 0]
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.arange(lengths.sum()) - offsets + np.repeat(ranges[:, 0],
+                                                          lengths)
+
+def _point(value: np.ndarray) -> dict:
+    return {"x": float(value[0]), "y": float(value[1]),
+            "z": float(value[2])}
+
+def _hotSpot(hotSpot: dict) -> np.ndarray | None:
+    try:
+        point = np.array([hotSpot["x"], hotSpot["y"], hotSpot["z"]],
+                         dtype = np.float64)
+    except (KeyError, TypeError, ValueError):
+        return None
+    return point if np.isfinite(point).all() else None
+
+def geodesicDistance(tables: MeshTables, source: int,
+                     targets: np.ndarray) -> float | None:
+    """
+    Return the distance along the mesh's edges from a welded vertex to the
+    nearest of some welded vertices, or None if none can be reached. The
+    search is bounded, starting from twice the straight-line distance and
+    widening until a target is reached, so a nearby field costs far less
+    than a search of the whole mesh
+
+    Args:
+        tables: The mesh's tables
+        source: The welded vertex the distance is measured from
+        targets: The welded vertices the distance is measured to
+    """
+    positions = tables.weldedVertices
+    limit = 2 * np.sqrt(((positions[targets] - positions[source]) ** 2)
+                        .sum(axis = 1).min())
+    reachable = -1
+    while True:
+        distances = dijkstra(tables.adjacency, indices = source,
+                             limit = limit)
+        nearest = distances[targets].min()
+        if np.isfinite(nearest):
+            return float(nearest)
+        # Once widening the search reaches no more vertices, the field is
+        # on another part of the mesh
+        count = np.isfinite(distances).sum()
+        if count == reachable:
+            return None
+        reachable = count
+        limit *= 4
+
+def measureField(tables: MeshTables, vertices: VertexSet,
+                 hotSpot: dict | None = None) -> FieldStatistics:
+    """
+    Compute the statistics of a field on a mesh
+
+    Args:
+        tables: The mesh's tables
+        vertices: The field's vertices; any beyond the mesh are ignored
+        hotSpot: The field's hotspot, as {"x", "y", "z"}
+
+    Returns: The field's FieldStatistics
+    """
+    indices = expandRanges(vertices, len(tables.vertices))
+    if not len(indices):
+        return FieldStatistics()
+    areas = tables.vertexAreas[indices]
+    area = float(areas.sum())
+    points = tables.vertices[indices]
+    if area > 0:
+        centroid = areas @ points / area
+    else:
+        centroid = points.mean(axis = 0)
+
+    inField = np.zeros(len(tables.vertices), dtype = bool)
+    inField[indices] = True
+    covered = inField[tables.faces].all(axis = 1)
+    normal = tables.faceAreas[covered] @ tables.faceNormals[covered]
+    length = np.linalg.norm(normal)
+
+    welded = np.unique(tables.weld[indices])
+    components, _ = connected_components(
+        tables.adjacency[welded][:, welded], directed = False
+    )
+
+    distance = None
+    point = _hotSpot(hotSpot or {})
+    if point is not None:
+        source = int(((tables.weldedVertices - point) ** 2)
+                     .sum(axis = 1).argmin())
+        position = np.searchsorted(welded, source)
+        if position < len(welded) and welded[position] == source:
+            distance = 0.0
+        else:
+            distance = geodesicDistance(tables, source, welded)
+
+    return FieldStatistics(
+        area = area,
+        centroid = _point(centroid),
+        normal = _point(normal / length) if length > 0 else {},
+        components = int(components),
+        hotSpotDistance = distance
+    )
+
+def fieldMeshHash(survey: Survey, projectedField) -> str | None:
+    """
+    Return the hash of the mesh a field was drawn on, found by the hash the
+    survey records for the file of the field's model, or None if the survey
+    records none
+    """
+    model = survey.config.get("models", {}).get(projectedField.model, {})
+    modelFile = (model.get("file", projectedField.model)
+                 if isinstance(model, dict) else model)
+    return survey.meshes.get(modelFile)
+
+class MeshTableCache():
+    """
+    The tables of the meshes in a mesh store, computed the first time a mesh
+    is measured and then kept beside it, and in memory for the most recently
+    used meshes. Safe to call from the compute pool's threads
+    """
+    def __init__(self, meshStore: MeshStore, capacity: int = 8):
+        """
+        Class initialization function
+
+        Args:
+            meshStore: The store holding the meshes, by content hash
+            capacity: The number of meshes whose tables are kept in memory
+        """
+        self.meshStore = meshStore
+        self.capacity = capacity
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+
+    def pathFor(self, meshHash: str) -> str:
+        return self.meshStore.pathFor(meshHash, EXTENSION)
+
+    def get(self, meshHash: str) -> MeshTables | None:
+        """
+        Return the tables of the mesh with the given hash, or None if the
+        store does not hold it
+        """
+        with self._lock:
+            tables = self._tables.get(meshHash)
+            if tables is not None:
+                self._tables.move_to_end(meshHash)
+                return tables
+            tables = self._load(meshHash)
+            if tables is None:
+                return None
+            self._tables[meshHash] = tables
+            if len(self._tables) > self.capacity:
+                self._tables.popitem(last = False)
+            return tables
+
+    def _load(self, meshHash: str) -> MeshTables | None:
+        path = self.pathFor(meshHash)
+        if os.path.isfile(path):
+            try:
+                with np.load(path) as arrays:
+                    if int(arrays["version"]) == TABLES_VERSION:
+                        return MeshTables.fromArrays(dict(arrays))
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Could not read mesh tables {path}: {e}")
+        if not self.meshStore.has(meshHash):
+            return None
+        tables = MeshTables.fromMesh(self.meshStore.loadArrays(meshHash))
+        with atomicOpen(path, 'wb') as file:
+            np.savez(file, **tables.toArrays())
+        return tables
+
+    def measureSurvey(self, survey: Survey) -> int:
+        """
+        Set the statistics of every field of a survey whose mesh is in the
+        store, found by the hash the survey records for its model file
+
+        Returns: The number of fields measured
+        """
+        measured = 0
+        for projectedField in survey.projectedFields:
+            meshHash = fieldMeshHash(survey, projectedField)
+            tables = self.get(meshHash) if meshHash else None
+            if tables is None:
+                continue
+            projectedField.statistics = measureField(
+                tables, projectedField.vertices, projectedField.hotSpot
+            )
+            measured += 1
+        return measured
+
+def measureFolder(dataPath: str) -> int:
+    """
+    Add statistics to the saved surveys in a data folder which have fields
+    without them, rewriting each survey file
+
+    Returns: The number of surveys measured
+    """
+    cache = MeshTableCache(MeshStore(os.path.join(dataPath, "meshes")))
+    updated = 0
+    for path in sorted(glob.glob(os.path.join(dataPath, "Survey3D_*.json"))):
+        try:
+            with open(path, 'rb') as file:
+                survey = decode(file.read(), Survey)
+        except (OSError, ValueError) as e:
+            print(f"Could not read {path}: {e}")
+            continue
+        if all(projectedField.statistics is not None
+               for projectedField in survey.projectedFields):
+            continue
+        if cache.measureSurvey(survey):
+            with atomicOpen(path, 'wb') as file:
+                file.write(encodePretty(survey))
+            updated += 1
+        else:
+            print(f"No stored meshes for the fields of {path}")
+    return updated
+
+if __name__ == "__main__":
+    folder = sys.argv[1] if len(sys.argv) > 1 else "../data/"
+    print(f"Measured the fields of {measureFolder(folder)} surveys")
@@ -0,0 +1,331 @@
+import os
+import json
+import base64
+import struct
+import hashlib
+import threading
+from urllib.parse import unquote
+import numpy as np
+from meshbin import MeshArrays
+
+GLB_MAGIC = b"glTF"
+GLB_HEADER = struct.Struct("<4sII")
+GLB_CHUNK = struct.Struct("<I4s")
+JSON_CHUNK = b"JSON"
+BIN_CHUNK = b"BIN\0"
+TRIANGLES = 4
+ARRAY_BUFFER = 34962
+ELEMENT_ARRAY_BUFFER = 34963
+# Extensions which change how geometry is stored, and which are not decoded
+UNSUPPORTED_EXTENSIONS = {
+    "KHR_draco_mesh_compression",
+    "EXT_meshopt_compression"
+}
+
+COMPONENT_TYPES = {
+    5120: np.int8,
+    5121: np.uint8,
+    5122: np.int16,
+    5123: np.uint16,
+    5125: np.uint32,
+    5126: np.float32
+}
+TYPE_SIZES = {
+    "SCALAR": 1,
+    "VEC2": 2,
+    "VEC3": 3,
+    "VEC4": 4,
+    "MAT2": 4,
+    "MAT3": 9,
+    "MAT4": 16
+}
+
+def readGLTF(path: str) -> tuple[dict, list[bytes]]:
+    """
+    Read a .glb or .gltf file and the buffers it refers to
+
+    Args:
+        path: The path of the model file
+
+    Returns: The glTF document and the contents of each of its buffers
+    """
+    binaryChunk = None
+    with open(path, 'rb') as file:
+        data = file.read()
+    if data[:4] == GLB_MAGIC:
+        magic, version, length = GLB_HEADER.unpack_from(data, 0)
+        if version != 2:
+            raise ValueError(f"{path} has unsupported GLB version {version}")
+        document = None
+        offset = GLB_HEADER.size
+        while offset < length:
+            chunkLength, chunkType = GLB_CHUNK.unpack_from(data, offset)
+            offset += GLB_CHUNK.size
+            chunk = data[offset:offset + chunkLength]
+            if chunkType == JSON_CHUNK:
+                document = json.loads(chunk)
+            elif chunkType == BIN_CHUNK and binaryChunk is None:
+                binaryChunk = chunk
+            offset += chunkLength
+        if document is None:
+            raise ValueError(f"{path} has no JSON chunk")
+    else:
+        document = json.loads(data)
+
+    buffers = []
+    for i, buffer in enumerate(document.get("buffers", [])):
+        uri = buffer.get("uri")
+        if uri is None:
+            if i != 0 or binaryChunk is None:
+                raise ValueError(f"Buffer {i} of {path} has no data")
+            buffers.append(binaryChunk)
+        elif uri.startswith("data:"):
+            buffers.append(base64.b64decode(uri.split(",", 1)[1]))
+        else:
+            bufferPath = os.path.join(os.path.dirname(path), unquote(uri))
+            with open(bufferPath, 'rb') as file:
+                buffers.append(file.read())
+    return document, buffers
+
+def readAccessor(document: dict, buffers: list[bytes],
+                 index: int) -> np.ndarray:
+    """
+    Read the data of a glTF accessor, with its elements as rows
+
+    Args:
+        document: The glTF document
+        buffers: The contents of the document's buffers
+        index: The index of the accessor
+
+    Returns: A (count, components) array of the accessor's component type
+    """
+    accessor = document["accessors"][index]
+    dtype = np.dtype(COMPONENT_TYPES[accessor["componentType"]])
+    components = TYPE_SIZES[accessor["type"]]
+    count = accessor["count"]
+
+    if "bufferView" in accessor:
+        view = document["bufferViews"][accessor["bufferView"]]
+        buffer = buffers[view["buffer"]]
+        offset = view.get("byteOffset", 0) + accessor.get("byteOffset", 0)
+        stride = view.get("byteStride", dtype.itemsize * components)
+        result = np.ndarray(
+            (count, components),
+            dtype = dtype.newbyteorder("<"),
+            buffer = buffer,
+            offset = offset,
+            strides = (stride, dtype.itemsize)
+        ).copy()
+    else:
+        result = np.zeros((count, components), dtype = dtype)
+
+    sparse = accessor.get("sparse")
+    if sparse:
+        indexInfo = sparse["indices"]
+        indexView = document["bufferViews"][indexInfo["bufferView"]]
+        indices = np.frombuffer(
+            buffers[indexView["buffer"]],
+            dtype = np.dtype(
+                COMPONENT_TYPES[indexInfo["componentType"]]
+            ).newbyteorder("<"),
+            count = sparse["count"],
+            offset = (indexView.get("byteOffset", 0)
+                      + indexInfo.get("byteOffset", 0))
+        )
+        valueInfo = sparse["values"]
+        valueView = document["bufferViews"][valueInfo["bufferView"]]
+        values = np.frombuffer(
+            buffers[valueView["buffer"]],
+            dtype = dtype.newbyteorder("<"),
+            count = sparse["count"] * components,
+            offset = (valueView.get("byteOffset", 0)
+                      + valueInfo.get("byteOffset", 0))
+        ).reshape(-1, components)
+        result[indices] = values
+    return result
+
+def loadGeometry(path: str, filename: str = "") -> MeshArrays:
+    """
+    Load the geometry of a model file as the frontend sees it. The frontend
+    takes the first object of the model's scene and converts its geometry to
+    non-indexed form, so every face has its own three vertices; this does
+    the same, so vertex indices recorded in surveys refer to the same
+    vertices here. Faces are listed in order, ((0, 1, 2), (3, 4, 5), ...)
+
+    Args:
+        path: The path of the .glb or .gltf file
+        filename: The filename to record on the geometry, by default the
+        file's name
+
+    Returns: The model's vertices and faces
+    """
+    document, buffers = readGLTF(path)
+    unsupported = UNSUPPORTED_EXTENSIONS.intersection(
+        document.get("extensionsUsed", [])
+    )
+    if unsupported:
+        raise ValueError(f"{path} uses unsupported extensions "
+                         f"{sorted(unsupported)}")
+
+    scene = document["scenes"][document.get("scene", 0)]
+    if not scene.get("nodes"):
+        raise ValueError(f"{path} has an empty scene")
+    node = document["nodes"][scene["nodes"][0]]
+    if "mesh" not in node:
+        raise ValueError(f"The first object in {path} is not a mesh")
+    primitives = document["meshes"][node["mesh"]]["primitives"]
+    if len(primitives) != 1:
+        raise ValueError(f"The first mesh in {path} has "
+                         f"{len(primitives)} primitives, not 1")
+    primitive = primitives[0]
+    if primitive.get("mode", TRIANGLES) != TRIANGLES:
+        raise ValueError(f"The first mesh in {path} is not triangles")
+
+    positions = readAccessor(
+        document, buffers, primitive["attributes"]["POSITION"]
+    )[:, :3]
+    if "indices" in primitive:
+        indices = readAccessor(document, buffers, primitive["indices"])
+        positions = positions[indices.ravel()]
+    vertices = np.ascontiguousarray(positions, dtype = "<f4")
+    faceCount = len(vertices) // 3
+    faces = np.arange(3 * faceCount, dtype = "<i4").reshape(faceCount, 3)
+    return MeshArrays(filename or os.path.basename(path), vertices, faces)
+
+def encodeGLB(vertices: np.ndarray, faces: np.ndarray,
+              name: str = "") -> bytes:
+    """
+    Encode indexed triangle geometry as a minimal GLB file: one scene of one
+    node of one mesh, with positions and indices only. The frontend shades
+    models flat, so no normals are needed
+
+    Args:
+        vertices: An (N, 3) array of vertex positions
+        faces: An (M, 3) array of vertex indices
+        name: The name of the mesh and its node
+
+    Returns: The contents of the GLB file
+    """
+    positions = np.ascontiguousarray(vertices, dtype = "<f4").reshape(-1, 3)
+    indices = np.ascontiguousarray(faces, dtype = "<u4").reshape(-1)
+    binary = positions.tobytes() + indices.tobytes()
+    bounds = positions if len(positions) else np.zeros((1, 3))
+    document = {
+        "asset": {"version": "2.0", "generator": "SensorySurvey3D"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"mesh": 0, "name": name}],
+        "meshes": [{
+            "name": name,
+            "primitives": [{
+                "attributes": {"POSITION": 0},
+                "indices": 1,
+                "mode": TRIANGLES
+            }]
+        }],
+        "buffers": [{"byteLength": len(binary)}],
+        "bufferViews": [
+            {"buffer": 0, "byteOffset": 0, "byteLength": positions.nbytes,
+             "target": ARRAY_BUFFER},
+            {"buffer": 0, "byteOffset": positions.nbytes,
+             "byteLength": indices.nbytes, "target": ELEMENT_ARRAY_BUFFER}
+        ],
+        "accessors": [
+            {"bufferView": 0, "componentType": 5126, "type": "VEC3",
+             "count": len(positions),
+             "min": bounds.min(axis = 0).tolist(),
+             "max": bounds.max(axis = 0).tolist()},
+            {"bufferView": 1, "componentType": 5125, "type": "SCALAR",
+             "count": len(indices)}
+        ]
+    }
+    text = json.dumps(document, separators = (",", ":")).encode("utf-8")
+    # Chunks are padded to 4 bytes, the JSON with spaces
+    text += b" " * (-len(text) % 4)
+    binary += b"\0" * (-len(binary) % 4)
+    length = (GLB_HEADER.size + 2 * GLB_CHUNK.size + len(text) 
+              + len(binary))
+    return b"".join([
+        GLB_HEADER.pack(GLB_MAGIC, 2, length),
+        GLB_CHUNK.pack(len(text), JSON_CHUNK), text,
+        GLB_CHUNK.pack(len(binary), BIN_CHUNK), binary
+    ])
+
+class GeometryCache():
+    """
+    Parsed geometry of the model files under a directory, so that the server
+    can produce the mesh data of a model by its filename instead of having
+    clients upload it. Each file is parsed once; entries are checked against
+    the file's size and modification time, and a file which was touched but
+    not changed is recognised by its hash and not parsed again
+    """
+    directory: str
+
+    def __init__(self, directory: str):
+        """
+        Class initialization function
+
+        Args:
+            directory: The directory holding the model files, as mounted at
+            /3dmodels
+        """
+        self.directory = os.path.abspath(directory)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def pathFor(self, filename: str) -> str | None:
+        """
+        Return the path of the model file with the given filename, or None
+        if there is no such model under the directory
+        """
+        path = os.path.abspath(os.path.join(self.directory, filename))
+        if (os.path.commonpath([path, self.directory]) != self.directory
+                or not path.endswith((".glb", ".gltf"))
+                or not os.path.isfile(path)):
+            return None
+        return path
+
+    def has(self, filename: str) -> bool:
+        """
+        Return True if the geometry of the given model can be produced
+        """
+        try:
+            return self.get(filename) is not None
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            print(f"Could not load geometry of {filename}: {e}")
+            return False
+
+    def get(self, filename: str) -> MeshArrays | None:
+        """
+        Return the geometry of the given model, parsing it if it is not
+        cached or has changed. Safe to call from several threads
+
+        Args:
+            filename: The model's filename relative to the directory
+
+        Returns: The model's geometry, or None if there is no such model
+        """
+        path = self.pathFor(filename)
+        if path is None:
+            return None
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is not None and entry[0] == key:
+                return entry[2]
+            fileHash = self._hashFile(path)
+            if entry is not None and entry[1] == fileHash:
+                self._entries[filename] = (key, fileHash, entry[2])
+                return entry[2]
+            geometry = loadGeometry(path, filename)
+            self._entries[filename] = (key, fileHash, geometry)
+            return geometry
+
+    @staticmethod
+    def _hashFile(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
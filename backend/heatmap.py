@@ -0,0 +1,516 @@
+"""
+Running per-vertex heatmaps of every saved survey's projected fields.
+
+Each heatmap is kept for a (model file, participant, group) key, where the
+group is one of
+
+    all                 every projected field
+    field/<name>        fields with that name, e.g. an electrode
+    quality/<type>      fields reporting that quality
+
+and the participant "*" aggregates every participant. A heatmap holds the
+number of fields added, and per vertex the number of fields covering it,
+the number of those which rated an intensity, and the sum of the intensities
+they rated (the field's intensity, or the quality's for quality groups).
+Adding a survey updates only the runs of vertices its fields cover.
+
+The heatmaps are saved in the folder given as
+
+    manifest.json           the keys, the .npz file holding each key's
+                            heatmap, and the surveys in those files
+    <key>-NNNNN.npz         one heatmap, as of the manifest's generation
+    deltas-NNNNN.log        the surveys added since, one JSON line each,
+                            holding the vertex runs each adds to each key
+
+so saving a survey appends one line in proportion to its fields, rather
+than rewriting every heatmap it touches. Once the log holds COMPACT_INTERVAL
+surveys it is compacted: the heatmaps it changed are written to the next
+generation's files, and then the manifest, which starts an empty log.
+Running this module adds any surveys in a data folder which are missing from
+its heatmaps:
+
+    python heatmap.py ../data
+"""
+import os
+import sys
+import json
+import glob
+import hashlib
+import threading
+from typing import Callable
+import numpy as np
+from persistence import atomicOpen, processLock, fileStamp
+from survey3d import Survey
+
+MANIFEST = "manifest.json"
+# Held by the server process adding to the heatmaps, when there are several
+LOCK = "heatmaps.lock"
+MANIFEST_VERSION = 2
+# The number of surveys the log holds before it is folded into the heatmaps'
+# files
+COMPACT_INTERVAL = 100
+
+# The participant under which every participant's fields are aggregated
+ALL_PARTICIPANTS = "*"
+ALL_FIELDS = "all"
+
+# The colors heatmaps are drawn between, matching the survey viewport's
+# default mesh color and brush color
+LOW_COLOR = np.array([1.0, 1.0, 1.0], dtype = np.float32)
+HIGH_COLOR = np.array([0xEC, 0x40, 0x7A], dtype = np.float32) / 255
+
+class Heatmap():
+    """
+    The running per-vertex totals of the fields added under one key
+    """
+    __slots__ = ("fields", "counts", "rated", "intensity")
+
+    def __init__(self, size: int = 0):
+        self.fields = 0
+        self.counts = np.zeros(size, dtype = np.int32)
+        self.rated = np.zeros(size, dtype = np.int32)
+        self.intensity = np.zeros(size, dtype = np.float64)
+
+    @property
+    def size(self) -> int:
+        return len(self.counts)
+
+    def _grow(self, size: int) -> None:
+        if size <= self.size:
+            return
+        # Grow geometrically, so growing a vertex at a time stays cheap
+        size = max(size, 2 * self.size)
+        for name in ("counts", "rated", "intensity"):
+            array = getattr(self, name)
+            grown = np.zeros(size, dtype = array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+    def add(self, ranges: list[tuple[int, int]], intensity: float | None,
+            size: int | None = None) -> None:
+        """
+        Add one field, covering the given [start, stop) runs of vertices
+
+        Args:
+            ranges: The field's vertex runs
+            intensity: The intensity rated for the field, or None if it was
+            not rated
+            size: The number of vertices of the model, if known. Runs are
+            clipped to it, and to start at 0, before the heatmap is grown
+        """
+        self.fields += 1
+        ranges = np.clip(np.array(ranges, dtype = np.int64).reshape(-1, 2),
+                         0, size)
+        ranges = ranges[ranges[:, 1] > ranges[:, 0]]
+        if len(ranges):
+            self._grow(int(ranges[:, 1].max()))
+        for start, stop in ranges.tolist():
+            self.counts[start:stop] += 1
+            if intensity is not None:
+                self.rated[start:stop] += 1
+                self.intensity[start:stop] += intensity
+
+    def values(self, value: str = "coverage",
+               size: int | None = None) -> np.ndarray:
+        """
+        Return a per-vertex value of the heatmap
+
+        Args:
+            value: "coverage", the fraction of fields covering each vertex,
+            "count", the number of fields, or "intensity", the mean
+            intensity rated by the fields covering each vertex
+            size: The number of vertices, by default the highest vertex any
+            field has covered plus one
+
+        Returns: A float64 array with one value per vertex
+        """
+        if size is None:
+            covered = np.flatnonzero(self.counts)
+            size = int(covered[-1]) + 1 if len(covered) else 0
+        counts = np.zeros(size)
+        n = min(size, self.size)
+        if value == "count":
+            counts[:n] = self.counts[:n]
+        elif value == "coverage":
+            counts[:n] = self.counts[:n] / max(self.fields, 1)
+        elif value == "intensity":
+            rated = self.rated[:n]
+            np.divide(self.intensity[:n], rated, out = counts[:n],
+                      where = rated > 0)
+        else:
+            raise ValueError(f"Unknown heatmap value {value}")
+        return counts
+
+    def colors(self, value: str = "coverage",
+               size: int | None = None) -> tuple[np.ndarray, float]:
+        """
+        Return the heatmap as vertex colors, scaled so the highest value is
+        drawn in HIGH_COLOR and vertices no field covers in LOW_COLOR
+
+        Args:
+            value: The value to be drawn, as in Heatmap.values
+            size: The number of vertices, as in Heatmap.values
+
+        Returns: A (vertices, 3) float32 array of RGB colors in [0, 1], which
+            is the layout of a three.js color attribute, and the value drawn
+            in HIGH_COLOR
+        """
+        values = self.values(value, size)
+        peak = float(values.max()) if len(values) else 0.0
+        scaled = (values / peak if peak > 0 else values).astype(np.float32)
+        colors = LOW_COLOR + scaled[:, None] * (HIGH_COLOR - LOW_COLOR)
+        return colors.astype(np.float32), peak
+
+    def toArrays(self) -> dict:
+        return {
+            "fields": np.array(self.fields),
+            "counts": self.counts,
+            "rated": self.rated,
+            "intensity": self.intensity
+        }
+
+    @classmethod
+    def fromArrays(cls, arrays) -> "Heatmap":
+        heatmap = cls()
+        heatmap.fields = int(arrays["fields"])
+        heatmap.counts = arrays["counts"]
+        heatmap.rated = arrays["rated"]
+        heatmap.intensity = arrays["intensity"]
+        return heatmap
+
+def _intensity(value) -> float | None:
+    """
+    Return a rated intensity, or None for the -1 of an unrated one
+    """
+    if value is None or value < 0:
+        return None
+    return float(value)
+
+class HeatmapAggregator():
+    """
+    Maintains the heatmaps of the surveys in a data folder, adding each
+    newly saved survey's fields to the heatmaps of its keys. Safe to call
+    from the persistence writer's and compute pool's threads, and from
+    several server processes, each of which reads the surveys another has
+    appended to the log, and reloads the heatmaps when another has compacted
+    them
+    """
+    path: str
+
+    def __init__(self, path: str, 
+                 vertexCount: Callable[[str], int | None] | None = None):
+        """
+        Class initialization function
+
+        Args:
+            path: The heatmap folder, created if missing
+            vertexCount: A function returning the number of vertices of a
+            model file, or None if it is unknown. If given, fields' vertex
+            runs are clipped to their model, and fields on models it does
+            not know are left out
+        """
+        self.path = path
+        self.vertexCount = vertexCount
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok = True)
+        self._stamp = fileStamp(os.path.join(path, MANIFEST))
+        self._load()
+
+    def _load(self) -> None:
+        self.heatmaps = {}
+        self.manifest = self._readManifest()
+        self._surveys = set(self.manifest["surveys"])
+        for entry in self.manifest["keys"]:
+            key = (entry["model"], entry["participant"], entry["group"])
+            with np.load(os.path.join(self.path, entry["file"])) as arrays:
+                self.heatmaps[key] = Heatmap.fromArrays(arrays)
+        # The surveys and keys added through the log since the manifest
+        self._logged = []
+        self._dirty = set()
+        self._logOffset = 0
+        self._readLog()
+
+    def _logPath(self) -> str:
+        return os.path.join(self.path, 
+                            f"deltas-{self.manifest['generation']:05d}.log")
+
+    def _readLog(self) -> None:
+        """
+        Apply the surveys appended to the log since it was last read. Only
+        whole lines are read, so a line another process is appending, or
+        one cut short by a crash, is left for later
+        """
+        try:
+            with open(self._logPath(), 'rb') as file:
+                file.seek(self._logOffset)
+                data = file.read()
+        except FileNotFoundError:
+            return
+        end = data.rfind(b"\n") + 1
+        sizes = {}
+        for line in data[:end].splitlines():
+            record = json.loads(line)
+            for model, participant, group, ranges, intensity in record["adds"]:
+                key = (model, participant, group)
+                heatmap = self.heatmaps.get(key)
+                if heatmap is None:
+                    heatmap = self.heatmaps[key] = Heatmap()
+                if model not in sizes:
+                    sizes[model] = self._size(model)
+                heatmap.add(ranges, intensity, sizes[model])
+                self._dirty.add(key)
+            self._logged.append(record["survey"])
+            self._surveys.add(record["survey"])
+        self._logOffset += end
+
+    def _refresh(self) -> None:
+        """
+        Reload the manifest and the heatmaps if another process has 
+        replaced the manifest, as it does whenever it compacts the log, and
+        otherwise apply whatever it has appended to the log
+        """
+        stamp = fileStamp(os.path.join(self.path, MANIFEST))
+        if stamp != self._stamp:
+            self._stamp = stamp
+            self._load()
+        else:
+            self._readLog()
+
+    def _size(self, modelFile: str) -> int | None:
+        """
+        Return the number of vertices of a model file, or None if it is
+        unknown
+        """
+        if self.vertexCount is None:
+            return None
+        return self.vertexCount(modelFile)
+
+    def _readManifest(self) -> dict:
+        manifestPath = os.path.join(self.path, MANIFEST)
+        if os.path.isfile(manifestPath):
+            with open(manifestPath, 'r') as file:
+                manifest = json.load(file)
+            # A version 1 manifest is generation 0, with no log
+            manifest.setdefault("generation", 0)
+            return manifest
+        return {"version": MANIFEST_VERSION, "generation": 0, "surveys": [],
+                "keys": []}
+
+    @staticmethod
+    def fileFor(key: tuple[str, str, str], generation: int) -> str:
+        """
+        Return the name of the file a key's heatmap is saved to when the
+        log is compacted into the given generation
+        """
+        digest = hashlib.sha256("\0".join(key).encode("utf-8")).hexdigest()
+        return f"{digest[:24]}-{generation:05d}.npz"
+
+    def has(self, filename: str) -> bool:
+        """
+        Return True if the survey saved under the given filename is in the
+        heatmaps
+        """
+        return filename in self._surveys
+
+    def colors(self, model: str, participant: str = ALL_PARTICIPANTS,
+               group: str = ALL_FIELDS, value: str = "coverage",
+               size: int | None = None) -> tuple | None:
+        """
+        Return the vertex colors of a key's heatmap, as in Heatmap.colors
+
+        Args:
+            model: The model file
+            participant: The participant, or ALL_PARTICIPANTS
+            group: The group of fields, e.g. "all" or "quality/tingling"
+            value: The value to be drawn, as in Heatmap.values
+            size: The number of vertices of the model, if known
+
+        Returns: The colors, the value drawn in HIGH_COLOR and the number of
+            fields in the heatmap, or None if no field has been added to the
+            key
+        """
+        with self._lock:
+            self._refresh()
+            heatmap = self.heatmaps.get((model, participant, group))
+            if heatmap is None:
+                return None
+            colors, peak = heatmap.colors(value, size)
+            return colors, peak, heatmap.fields
+
+    def keys(self) -> list[dict]:
+        """
+        Return every key with a heatmap, and the number of fields in each
+        """
+        with self._lock:
+            self._refresh()
+            return [
+                {
+                    "model": model,
+                    "participant": participant,
+                    "group": group,
+                    "fields": heatmap.fields
+                }
+                for (model, participant, group), heatmap
+                in sorted(self.heatmaps.items())
+            ]
+
+    def add(self, surveys: list[Survey],
+            filenames: list[str] | None = None) -> int:
+        """
+        Add the fields of surveys which are not yet in the heatmaps, and
+        append them to the log, compacting it once it is long enough
+
+        Args:
+            surveys: The surveys to be added
+            filenames: The names the surveys were saved under, by default
+            their Survey.filename
+
+        Returns: The number of surveys added
+        """
+        if filenames is None:
+            filenames = [survey.filename for survey in surveys]
+        with self._lock, processLock(os.path.join(self.path, LOCK)):
+            self._refresh()
+            lines = {}
+            for filename, survey in zip(filenames, surveys):
+                if not self.has(filename) and filename not in lines:
+                    lines[filename] = self._surveyAdds(survey)
+            if not lines:
+                return 0
+
+            # A survey is only recorded once its line is durable, and a
+            # line cut short by a crash is cut off before appending after it
+            data = b"".join(
+                json.dumps({"survey": filename, "adds": adds},
+                           separators = (",", ":")).encode("utf-8") + b"\n"
+                for filename, adds in lines.items()
+            )
+            with open(self._logPath(), 'ab') as file:
+                file.truncate(self._logOffset)
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            self._readLog()
+            if len(self._logged) >= COMPACT_INTERVAL:
+                self._compact()
+            return len(lines)
+
+    def _compact(self) -> None:
+        """
+        Write the heatmaps the log has changed to the next generation's 
+        files, then the manifest, which starts the next generation's empty
+        log. The files of the generation before are left for processes
+        still reading them, and removed at the next compaction. Called 
+        holding both locks
+        """
+        previous = self.manifest
+        generation = previous["generation"] + 1
+        files = {
+            (entry["model"], entry["participant"], entry["group"]): 
+            entry["file"] for entry in previous["keys"]
+        }
+        for key in self._dirty:
+            files[key] = self.fileFor(key, generation)
+            with atomicOpen(os.path.join(self.path, files[key]), 'wb') as f:
+                np.savez(f, **self.heatmaps[key].toArrays())
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "generation": generation,
+            "surveys": previous["surveys"] + self._logged,
+            "keys": [
+                {
+                    "model": key[0],
+                    "participant": key[1],
+                    "group": key[2],
+                    "file": file
+                }
+                for key, file in sorted(files.items())
+            ]
+        }
+        # As with the export, the manifest is written last, so a crash part
+        # way through leaves the last generation whole
+        with atomicOpen(os.path.join(self.path, MANIFEST), 'w') as file:
+            json.dump(manifest, file, indent = 4)
+        self._stamp = fileStamp(os.path.join(self.path, MANIFEST))
+        oldLog = self._logPath()
+        self.manifest = manifest
+        self._logged = []
+        self._dirty = set()
+        self._logOffset = 0
+
+        keep = {entry["file"] for entry in previous["keys"]}
+        keep |= set(files.values())
+        keep.add(os.path.basename(oldLog))
+        for name in os.listdir(self.path):
+            if ((name.endswith(".npz") or name.startswith("deltas-")) 
+                    and name not in keep):
+                os.remove(os.path.join(self.path, name))
+
+    def _surveyAdds(self, survey: Survey) -> list[list]:
+        """
+        Return what every field of a survey adds to the heatmaps of its keys,
+        as [model, participant, group, ranges, intensity] for the survey's
+        line in the log
+        """
+        adds = []
+        sizes = {}
+        models = survey.config.get("models", {})
+        for projectedField in survey.projectedFields:
+            model = models.get(projectedField.model, {})
+            modelFile = (model.get("file", projectedField.model)
+                         if isinstance(model, dict) else model)
+            if modelFile not in sizes:
+                sizes[modelFile] = self._size(modelFile)
+            size = sizes[modelFile]
+            if size is None and self.vertexCount is not None:
+                print(f"Could not add a field on {modelFile} to heatmaps; "
+                      "the model has no geometry")
+                continue
+            ranges = [
+                [start, min(stop, size) if size is not None else stop]
+                for start, stop in projectedField.vertices.ranges()
+                if size is None or start < size
+            ]
+            groups = [(ALL_FIELDS, _intensity(projectedField.intensity))]
+            if projectedField.name:
+                groups.append((f"field/{projectedField.name}",
+                               _intensity(projectedField.intensity)))
+            for quality in projectedField.qualities:
+                groups.append((f"quality/{quality.type}",
+                               _intensity(quality.intensity)))
+            for participant in (survey.participant, ALL_PARTICIPANTS):
+                for group, intensity in groups:
+                    adds.append([modelFile, participant, group, ranges,
+                                 intensity])
+        return adds
+
+    def addFolder(self, dataPath: str) -> int:
+        """
+        Add every survey in a data folder which is not yet in the heatmaps
+
+        Args:
+            dataPath: The folder holding Survey3D_*.json files
+
+        Returns: The number of surveys added
+        """
+        surveys = []
+        filenames = []
+        for path in sorted(glob.glob(os.path.join(dataPath, "Survey3D_*.json"))):
+            if self.has(os.path.basename(path)):
+                continue
+            try:
+                with open(path, 'r') as file:
+                    survey = Survey()
+                    survey.fromDict(json.load(file))
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print(f"Could not add {path} to heatmaps: {e}")
+                continue
+            surveys.append(survey)
+            filenames.append(os.path.basename(path))
+        return self.add(surveys, filenames)
+
+if __name__ == "__main__":
+    folder = sys.argv[1] if len(sys.argv) > 1 else "../data/"
+    aggregator = HeatmapAggregator(os.path.join(folder, "heatmaps"))
+    added = aggregator.addFolder(folder)
+    print(f"Added {added} surveys to the heatmaps")
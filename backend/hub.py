@@ -0,0 +1,145 @@
+import asyncio
+from typing import Callable
+from codec import encodeText
+
+# The topic followed by clients which have not named a session
+DEFAULT_TOPIC = ""
+
+class Publication():
+    """
+    One published message. The message is only built and serialized when a
+    subscriber first needs it, and the text is then shared by every
+    subscriber, so each change costs at most one serialization however many
+    clients are watching
+    """
+    __slots__ = ("_build", "_text", "_hub")
+
+    def __init__(self, build: Callable[[], dict], hub: "SurveyHub"):
+        self._build = build
+        self._text = None
+        self._hub = hub
+
+    @property
+    def text(self) -> str:
+        """
+        The serialized message
+        """
+        if self._text is None:
+            self._text = encodeText(self._build())
+            self._build = None
+            self._hub.serializations += 1
+        return self._text
+
+class Subscriber():
+    """
+    A client's subscription to a topic. The subscriber holds a single slot
+    for the latest publication it has not yet received; a newer publication
+    replaces an undelivered one, so a slow client only ever receives the
+    latest state rather than a growing backlog
+    """
+    __slots__ = ("topic", "_latest", "_event", "_hub")
+
+    def __init__(self, topic: str, hub: "SurveyHub"):
+        self.topic = topic
+        self._latest = None
+        self._event = asyncio.Event()
+        self._hub = hub
+
+    def offer(self, publication: Publication) -> None:
+        """
+        Place a publication in the subscriber's slot, replacing any which has
+        not been delivered yet
+        """
+        if self._latest is not None:
+            self._hub.coalesced += 1
+        self._latest = publication
+        self._event.set()
+
+    async def next(self) -> str:
+        """
+        Wait for a publication and return its serialized message
+        """
+        await self._event.wait()
+        self._event.clear()
+        publication, self._latest = self._latest, None
+        return publication.text
+
+class SurveyHub():
+    """
+    A publish/subscribe hub which pushes survey state to watching clients.
+    Topics are session ids; the last publication on each topic is kept so
+    that a new subscriber receives the current state straight away
+    """
+    def __init__(self):
+        self._subscribers = {}
+        self._latest = {}
+        self.publications = 0
+        self.serializations = 0
+        self.coalesced = 0
+
+    def subscribe(self, topic: str) -> Subscriber:
+        """
+        Subscribe to a topic
+
+        Args:
+            topic: The topic to follow
+
+        Returns: The new Subscriber, already holding the topic's latest
+            publication if there is one
+        """
+        subscriber = Subscriber(topic, self)
+        self._attach(subscriber)
+        return subscriber
+
+    def move(self, subscriber: Subscriber, topic: str) -> None:
+        """
+        Switch a subscriber to another topic, offering it that topic's latest
+        publication
+        """
+        if subscriber.topic == topic:
+            return
+        self.unsubscribe(subscriber)
+        subscriber.topic = topic
+        self._attach(subscriber)
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        """
+        Stop a subscriber receiving publications
+        """
+        subscribers = self._subscribers.get(subscriber.topic)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[subscriber.topic]
+
+    def _attach(self, subscriber: Subscriber) -> None:
+        self._subscribers.setdefault(subscriber.topic, set()).add(subscriber)
+        if subscriber.topic in self._latest:
+            subscriber.offer(self._latest[subscriber.topic])
+
+    def publish(self, topic: str, build: Callable[[], dict]) -> None:
+        """
+        Publish a message to every subscriber of a topic
+
+        Args:
+            topic: The topic to publish to
+            build: A function returning the message, called at most once and
+            only if a subscriber receives it
+        """
+        publication = Publication(build, self)
+        self._latest[topic] = publication
+        self.publications += 1
+        for subscriber in self._subscribers.get(topic, ()):
+            subscriber.offer(publication)
+
+    def stats(self) -> dict:
+        """
+        Return counts of subscribers, publications, serializations, and
+        publications replaced before a slow subscriber received them
+        """
+        return {
+            "subscribers": sum(len(s) for s in self._subscribers.values()),
+            "publications": self.publications,
+            "serializations": self.serializations,
+            "coalesced": self.coalesced
+        }
@@ -0,0 +1,166 @@
+import asyncio
+from collections import deque
+from fastapi import WebSocket
+from messages import (decodeParticipantMessage, peekMessage, MessageHeader,
+                      PARTICIPANT_TYPES)
+from codec import DecodeError
+from metrics import REGISTRY
+
+RECEIVED_BYTES = REGISTRY.counter(
+    "survey3d_ws_received_bytes_total",
+    "Characters of JSON text received over websockets, by endpoint",
+    ("endpoint",)
+)
+QUEUE_DEPTH = REGISTRY.gauge(
+    "survey3d_ingest_queue_depth",
+    "Participant messages received but not yet handled"
+)
+RECEIVED = REGISTRY.counter(
+    "survey3d_ingest_messages_total",
+    "Participant messages received, by type",
+    ("type",)
+)
+DROPPED = REGISTRY.counter(
+    "survey3d_ingest_dropped_updates_total",
+    "Participant updates replaced by a newer update before being handled"
+)
+
+class MalformedMessage(ValueError):
+    """
+    Raised for a message whose header could be read but whose body is
+    invalid, such as a survey with negative vertex runs, so that the handler
+    can answer it as its type requires
+    """
+    def __init__(self, type: str, error: Exception):
+        super().__init__(str(error))
+        self.type = type
+
+def supersedes(message: MessageHeader, pending: MessageHeader) -> bool:
+    """
+    Return True if a newly received message makes a pending one pointless:
+    both are full updates of the same survey, so handling the older one
+    would only be overwritten by the newer
+    """
+    return (message.type == "update" and pending.type == "update"
+            and message.survey is not None and pending.survey is not None
+            and message.survey == pending.survey)
+
+class IngestQueue():
+    """
+    Reads a participant's messages off its websocket as fast as they arrive,
+    and holds them until the handler is ready for them. A full update which
+    is still waiting when a newer update of the same survey arrives straight
+    behind it is replaced by the newer one, and is never acknowledged; every
+    other message, such as a patch or a submit, is kept and handled in the
+    order it was sent. Only a message's header is read as it arrives, and
+    the rest is decoded once the handler takes it, so a replaced update 
+    costs little more than reading it off the socket. However fast a client
+    paints, the handler does one update's work per update it gets through,
+    and the queue holds at most one update between other messages. Once 
+    maxPending messages are waiting the queue stops reading, and the socket
+    holds the client back.
+
+    Use as an async context manager, which starts and stops the reader:
+
+        async with IngestQueue(websocket) as queue:
+            while True:
+                message = await queue.get()
+    """
+    def __init__(self, websocket: WebSocket, maxPending: int = 64):
+        """
+        Class initialization function
+
+        Args:
+            websocket: The accepted websocket of the participant client
+            maxPending: The number of messages held before reading stops
+        """
+        self.maxPending = maxPending
+        self.received = 0
+        self.dropped = 0
+        self._websocket = websocket
+        self._pending = deque()
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._error = None
+        self._reader = None
+
+    async def __aenter__(self) -> "IngestQueue":
+        self._reader = asyncio.create_task(self._read())
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self._reader.cancel()
+        QUEUE_DEPTH.dec(amount = len(self._pending))
+        self._pending.clear()
+
+    @property
+    def depth(self) -> int:
+        """
+        The number of messages waiting to be handled
+        """
+        return len(self._pending)
+
+    async def _read(self) -> None:
+        try:
+            while True:
+                while len(self._pending) >= self.maxPending:
+                    self._space.clear()
+                    await self._space.wait()
+                text = await self._websocket.receive_text()
+                RECEIVED_BYTES.inc("participant", amount = len(text))
+                self._put(peekMessage(text), text)
+        except Exception as e:
+            # The disconnect, or the malformed message, is raised to the
+            # handler once it has handled every message before it
+            self._error = e
+            self._ready.set()
+
+    def _put(self, header: MessageHeader, text: str) -> None:
+        self.received += 1
+        RECEIVED.inc(header.type if header.type in PARTICIPANT_TYPES 
+                     else "unknown")
+        if self._pending and supersedes(header, self._pending[-1][0]):
+            self._pending[-1] = (header, text)
+            self.dropped += 1
+            DROPPED.inc()
+        else:
+            self._pending.append((header, text))
+            QUEUE_DEPTH.inc()
+        self._ready.set()
+
+    async def get(self):
+        """
+        Wait for the next message to be handled
+
+        Returns: The decoded message
+
+        Raises: WebSocketDisconnect once the client has disconnected and
+            every message it sent has been handled, codec.DecodeError when
+            the next message's header cannot be read, after which no more
+            messages are, or MalformedMessage when the rest of the next
+            message is invalid
+        """
+        while not self._pending:
+            if self._error is not None:
+                raise self._error
+            self._ready.clear()
+            await self._ready.wait()
+        header, text = self._pending.popleft()
+        QUEUE_DEPTH.dec()
+        self._space.set()
+        try:
+            return decodeParticipantMessage(text)
+        except DecodeError as e:
+            raise MalformedMessage(header.type, e) from e
+
+    def stats(self) -> dict:
+        """
+        Return the number of messages waiting, received, and dropped as
+        superseded
+        """
+        return {
+            "depth": self.depth,
+            "received": self.received,
+            "dropped": self.dropped
+        }
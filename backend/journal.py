@@ -0,0 +1,125 @@
+import os
+from persistence import atomicOpen, WRITE_SECONDS
+from codec import encode, decode, DecodeError
+
+EXTENSION = ".journal"
+
+class SurveyJournal():
+    """
+    An append-only journal of the updates applied to one in-progress survey,
+    so that the survey can be rebuilt after a crash or reload. Each line of
+    the journal is a JSON record, either
+
+        {"type": "snapshot", "version": v, "survey": {...}}
+        {"type": "patch", "version": v, "ops": [...]}
+
+    where version is the survey version after the record is applied. A
+    checkpoint atomically replaces the journal with a single snapshot, which
+    keeps replay short; between checkpoints each patch costs one small
+    append.
+    """
+    path: str
+    checkpointInterval: int
+    recordsSinceCheckpoint: int
+    shared = False
+
+    def __init__(self, path: str, checkpointInterval: int = 500):
+        """
+        Class initialization function
+
+        Args:
+            path: The path of the journal file
+            checkpointInterval: The number of patches after which the
+            journal should be compacted into a snapshot
+        """
+        self.path = path
+        self.checkpointInterval = checkpointInterval
+        self.recordsSinceCheckpoint = 0
+        self._file = None
+
+    @property
+    def needsCheckpoint(self) -> bool:
+        """
+        True once enough patches have been appended since the last
+        checkpoint that the journal should be compacted
+        """
+        return self.recordsSinceCheckpoint >= self.checkpointInterval
+
+    def checkpoint(self, survey, version: int) -> None:
+        """
+        Atomically replace the journal with a snapshot of the survey. This
+        writes and syncs the whole survey, so the session runs it on the
+        persistence writer, which times it
+
+        Args:
+            survey: The Survey, or a dictionary of it as from Survey.toDict
+            version: The survey version the snapshot represents
+        """
+        self.close()
+        record = {"type": "snapshot", "version": version, "survey": survey}
+        line = encode(record) + b"\n"
+        with atomicOpen(self.path, 'wb') as file:
+            file.write(line)
+        self._file = open(self.path, 'ab')
+        self.recordsSinceCheckpoint = 0
+
+    def appendPatch(self, version: int, ops: list[dict]) -> None:
+        """
+        Append a patch to the journal. The record reaches the operating
+        system before this returns, so it survives the server process
+        crashing
+
+        Args:
+            version: The survey version after the patch was applied
+            ops: The patch operations, see Survey.applyPatch
+        """
+        if self._file is None:
+            self._file = open(self.path, 'ab')
+        record = {"type": "patch", "version": version, "ops": ops}
+        line = encode(record) + b"\n"
+        with WRITE_SECONDS.time("SurveyJournal.appendPatch"):
+            self._file.write(line)
+            self._file.flush()
+        self.recordsSinceCheckpoint += 1
+
+    def close(self) -> None:
+        """
+        Close the journal file, leaving it on disk
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def delete(self) -> None:
+        """
+        Close and remove the journal, once its survey has been saved
+        """
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    @staticmethod
+    def read(path: str) -> list[dict]:
+        """
+        Read the records of a journal from its last snapshot onwards. A
+        record cut short by a crash ends the journal
+
+        Args:
+            path: The path of the journal file
+
+        Returns: The records, starting with a snapshot, or an empty list if
+            the journal holds no snapshot
+        """
+        records = []
+        with open(path, 'rb') as file:
+            for line in file:
+                try:
+                    record = decode(line)
+                except DecodeError:
+                    break
+                if record["type"] == "snapshot":
+                    records = []
+                records.append(record)
+        if records and records[0]["type"] != "snapshot":
+            return []
+        return records
@@ -0,0 +1,399 @@
+"""
+Decimated level-of-detail (LOD) variants of the models under 3dmodels, and
+the mapping of each variant's vertices back to its full-resolution model.
+
+A model in the participant config may ask for a level of detail:
+
+    "3D Right Hand": {"file": "hand_r_vertical.glb", "lod": 1}
+
+Level n has about 1/4^n of the faces of the full model. When a survey
+starts, the model's file in the survey's config is replaced with the
+variant's, lod/hand_r_vertical.lod1.glb, so participants download, and
+send the vertex indices of, the smaller mesh. When the survey is saved its
+fields are mapped back to the full model's vertices and the model's file
+is restored, so saved surveys, their meshes and everything computed from
+them are always at full resolution.
+
+Variants are made by vertex clustering: the model's bounding box is cut
+into cubic cells, every vertex in a cell is merged into one at their mean
+position, and faces which collapse are dropped. The cell size is searched
+for to get closest to the level's face count. Which cell each full vertex
+fell in is the mapping back to full resolution; cells left without a face
+are merged into the nearest cell which has one, so every full vertex maps
+to a vertex of the variant. Clustering is deterministic, so the same model
+always gives the same variant and mapping.
+
+Each variant is written as a GLB beside the models, with its mapping in
+<variant>.map.npz, and is rebuilt if its model's contents change. Variants
+are built when the server starts, or when first asked for; running this
+module builds them ahead of time for every model under a folder:
+
+    python lod.py ../frontend/dist/3dmodels 1 2
+"""
+import os
+import sys
+import threading
+from dataclasses import dataclass
+import numpy as np
+from scipy.spatial import cKDTree
+from gltf import GeometryCache, encodeGLB
+from meshbin import MeshArrays
+from meshindex import MODEL_EXTENSIONS, LOD_DIRECTORY, hashFile
+from persistence import atomicOpen
+from vertexset import VertexSet
+from geometry import expandRanges
+
+MAPPING_EXTENSION = ".map.npz"
+# Bumped whenever variants would be built differently, so that stale
+# variants are rebuilt
+MAPPING_VERSION = 1
+# The factor by which each level reduces the face count
+REDUCTION = 4
+# The most cells along the longest side of a model's bounding box
+MAX_RESOLUTION = 4096
+
+@dataclass
+class LodMesh():
+    """
+    A decimated variant of a model and the mapping of its vertices back to
+    the model's
+    """
+    vertices: np.ndarray
+    faces: np.ndarray
+    # The variant's vertex each of the full model's vertices was merged into
+    clusters: np.ndarray
+    # The hash of the model file the variant was built from
+    sourceHash: str = ""
+
+    def toFull(self, vertices: VertexSet) -> VertexSet:
+        """
+        Map vertices of the variant, as the frontend indexes them, to the
+        full model's. The frontend gives every face its own three vertices,
+        so a painted vertex stands for its merged vertex, and so for every
+        full vertex merged into it
+
+        Args:
+            vertices: Vertices of the variant's non-indexed geometry
+
+        Returns: The vertices of the full model's non-indexed geometry
+        """
+        corners = self.faces.ravel()
+        indices = expandRanges(vertices, len(corners))
+        painted = np.zeros(len(self.vertices), dtype = bool)
+        painted[corners[indices]] = True
+        return indicesToVertexSet(np.flatnonzero(painted[self.clusters]))
+
+    def toArrays(self) -> dict:
+        return {
+            "version": np.array(MAPPING_VERSION),
+            "sourceHash": np.array(self.sourceHash),
+            "vertices": self.vertices,
+            "faces": self.faces,
+            "clusters": self.clusters
+        }
+
+    @classmethod
+    def fromArrays(cls, arrays) -> "LodMesh":
+        return cls(arrays["vertices"], arrays["faces"], arrays["clusters"],
+                   str(arrays["sourceHash"]))
+
+def indicesToVertexSet(indices: np.ndarray) -> VertexSet:
+    """
+    Make a VertexSet from sorted, unique indices, finding its runs without a
+    Python loop over the indices
+    """
+    if not len(indices):
+        return VertexSet()
+    breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+    starts = indices[np.concatenate([[0], breaks])]
+    stops = indices[np.concatenate([breaks - 1, [len(indices) - 1]])] + 1
+    return VertexSet.fromRanges(zip(starts.tolist(), stops.tolist()))
+
+def _cluster(positions: np.ndarray, faces: np.ndarray,
+             resolution: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Merge the vertices in each of the cells of a grid with the given number
+    of cells along the longest side of the positions' bounding box
+
+    Returns: The cell of each vertex, numbered from 0, and the faces which
+        do not collapse, between cells, without repeats
+    """
+    lower = positions.min(axis = 0)
+    extent = positions.max(axis = 0) - lower
+    size = max(float(extent.max()), np.finfo(np.float32).tiny) / resolution
+    cells = np.minimum((positions - lower) // size,
+                       resolution - 1).astype(np.int64)
+    keys = (cells[:, 0] * resolution + cells[:, 1]) * resolution + cells[:, 2]
+    _, clusters = np.unique(keys, return_inverse = True)
+    clusters = clusters.reshape(-1)
+
+    merged = clusters[faces]
+    merged = merged[(merged[:, 0] != merged[:, 1])
+                    & (merged[:, 1] != merged[:, 2])
+                    & (merged[:, 2] != merged[:, 0])]
+    # The same three cells may be joined by several faces; the first is kept,
+    # with its winding, and faces keep their order
+    corners = np.ascontiguousarray(np.sort(merged, axis = 1))
+    _, first = np.unique(corners.view(np.dtype((np.void, 24))).ravel(),
+                         return_index = True)
+    return clusters, merged[np.sort(first)]
+
+def decimate(mesh: MeshArrays, targetFaces: int) -> LodMesh:
+    """
+    Build a variant of a mesh with about the given number of faces by vertex
+    clustering, see the module's description
+
+    Args:
+        mesh: The full model's geometry, as loaded by gltf.loadGeometry
+        targetFaces: The number of faces wanted
+
+    Returns: The variant, with the mapping of the mesh's vertices to it
+    """
+    positions = np.asarray(mesh.vertices, dtype = np.float64).reshape(-1, 3)
+    faces = np.asarray(mesh.faces, dtype = np.int64).reshape(-1, 3)
+    if not len(faces):
+        raise ValueError(f"{mesh.filename} has no faces")
+
+    # The face count grows with the resolution, so the resolution is found
+    # by doubling and then bisection, and whichever of the two resolutions
+    # either side of the target is closer to it is used
+    results = {}
+    def clusterAt(resolution: int) -> tuple[np.ndarray, np.ndarray]:
+        if resolution not in results:
+            results[resolution] = _cluster(positions, faces, resolution)
+        return results[resolution]
+
+    low, high = 1, 2
+    while high < MAX_RESOLUTION and len(clusterAt(high)[1]) < targetFaces:
+        low, high = high, 2 * high
+    high = min(high, MAX_RESOLUTION)
+    while high - low > 1:
+        middle = (low + high) // 2
+        if len(clusterAt(middle)[1]) >= targetFaces:
+            high = middle
+        else:
+            low = middle
+    result = min((clusterAt(low), clusterAt(high)),
+                 key = lambda result: (not len(result[1]),
+                                       abs(len(result[1]) - targetFaces)))
+    clusters, merged = result
+    if not len(merged):
+        raise ValueError(f"{mesh.filename} cannot be decimated")
+
+    counts = np.bincount(clusters)
+    centers = np.stack([
+        np.bincount(clusters, weights = positions[:, axis]) / counts
+        for axis in range(3)
+    ], axis = 1)
+
+    # Only cells with faces become vertices of the variant; the vertices of
+    # the others are merged into the nearest of them
+    used = np.zeros(len(centers), dtype = bool)
+    used[merged.ravel()] = True
+    kept = np.flatnonzero(used)
+    renumber = np.empty(len(centers), dtype = np.int64)
+    renumber[kept] = np.arange(len(kept))
+    orphans = np.flatnonzero(~used)
+    if len(orphans):
+        _, nearest = cKDTree(centers[kept]).query(centers[orphans])
+        renumber[orphans] = nearest
+    return LodMesh(
+        centers[kept].astype(np.float32),
+        renumber[merged].astype(np.int32),
+        renumber[clusters].astype(np.int32)
+    )
+
+class LodLibrary():
+    """
+    The LOD variants of the models served from a directory, built when they
+    are first asked for and then kept beside the models, and in memory.
+    Safe to call from the compute pool's threads
+    """
+    def __init__(self, directory: str, geometry: GeometryCache):
+        """
+        Class initialization function
+
+        Args:
+            directory: The directory holding the model files, as mounted at
+            /3dmodels
+            geometry: The cache from which the models' geometry is loaded
+        """
+        self.directory = directory
+        self.geometry = geometry
+        self._variants = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def filenameFor(filename: str, level: int) -> str:
+        """
+        Return the filename, relative to the models directory, of a model's
+        variant at a level
+        """
+        stem = os.path.splitext(filename.replace("\\", "/"))[0]
+        return f"{LOD_DIRECTORY}/{stem}.lod{level}.glb"
+
+    def get(self, filename: str, level: int) -> LodMesh | None:
+        """
+        Return a model's variant at a level, building it if it has not been
+        built from the model's current contents
+
+        Args:
+            filename: The model's filename relative to the directory
+            level: The level of detail, from 1
+
+        Returns: The variant, or None if there is no such model
+        """
+        source = self.geometry.pathFor(filename)
+        if source is None:
+            return None
+        stat = os.stat(source)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._variants.get((filename, level))
+            if entry is not None and entry[0] == key:
+                return entry[1]
+            variant = self._load(filename, level, hashFile(source))
+            self._variants[(filename, level)] = (key, variant)
+            return variant
+
+    def _load(self, filename: str, level: int, sourceHash: str) -> LodMesh:
+        path = os.path.join(self.directory, self.filenameFor(filename, level))
+        mappingPath = path + MAPPING_EXTENSION
+        if os.path.isfile(path) and os.path.isfile(mappingPath):
+            try:
+                with np.load(mappingPath) as arrays:
+                    if (int(arrays["version"]) == MAPPING_VERSION
+                            and str(arrays["sourceHash"]) == sourceHash):
+                        return LodMesh.fromArrays(dict(arrays))
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Could not read LOD mapping {mappingPath}: {e}")
+
+        mesh = self.geometry.get(filename)
+        print(f"Building level {level} of detail of {filename}")
+        variant = decimate(mesh, max(1, len(mesh.faces) // REDUCTION ** level))
+        variant.sourceHash = sourceHash
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with atomicOpen(path, 'wb') as file:
+            file.write(encodeGLB(variant.vertices, variant.faces,
+                                 os.path.basename(filename)))
+        with atomicOpen(mappingPath, 'wb') as file:
+            np.savez(file, **variant.toArrays())
+        return variant
+
+    def resolveConfig(self, config: dict) -> dict:
+        """
+        Return a copy of a participant's config in which each model with a
+        "lod" level is shown at that level: its file is the variant's, and
+        its own file and hash are kept as "sourceFile" and "sourceHash" for
+        remapSurvey. A model whose variant cannot be built is shown at full
+        resolution
+
+        Args:
+            config: The participant's entry in the participant config
+
+        Returns: The config for the participant's new survey
+        """
+        models = {}
+        for name, model in config.get("models", {}).items():
+            level = model.get("lod", 0) if isinstance(model, dict) else 0
+            if not isinstance(level, int) or level <= 0 or "file" not in model:
+                models[name] = model
+                continue
+            try:
+                variant = self.get(model["file"], level)
+            except (OSError, ValueError, KeyError, IndexError) as e:
+                print(f"Could not build level {level} of detail of "
+                      f"{model['file']}: {e}")
+                variant = None
+            if variant is None:
+                models[name] = model
+                continue
+            models[name] = {
+                **model,
+                "file": self.filenameFor(model["file"], level),
+                "sourceFile": model["file"],
+                "sourceHash": variant.sourceHash
+            }
+        return {**config, "models": models}
+
+    def remapSurvey(self, survey) -> dict[str, str]:
+        """
+        Map the fields a survey's participant drew on variants to their full
+        models, and restore the models' files in the survey's config, which
+        keeps the variant's file as "lodFile". A model whose file has
+        changed since the survey started cannot be mapped, and is left at
+        its variant. This blocks, so it should be run on the compute pool
+
+        Args:
+            survey: The survey, whose config came from resolveConfig
+
+        Returns: The filenames of the variants whose fields were mapped, to
+            the filenames of their models
+        """
+        remapped = {}
+        for name, model in survey.config.get("models", {}).items():
+            if not isinstance(model, dict) or "sourceFile" not in model:
+                continue
+            variant = self.get(model["sourceFile"], model["lod"])
+            if variant is None or variant.sourceHash != model["sourceHash"]:
+                print(f"{model['sourceFile']} has changed since the survey "
+                      f"began; its fields are left at level {model['lod']}")
+                continue
+            fields = [projectedField for projectedField
+                      in survey.projectedFields if projectedField.model == name]
+            mapped = [variant.toFull(projectedField.vertices)
+                      for projectedField in fields]
+            for projectedField, vertices in zip(fields, mapped):
+                projectedField.vertices = vertices
+            model["lodFile"] = model["file"]
+            model["file"] = model.pop("sourceFile")
+            del model["sourceHash"]
+            remapped[model["lodFile"]] = model["file"]
+        return remapped
+
+    def prepare(self, config: dict) -> int:
+        """
+        Build every variant the participant config asks for which is not
+        built yet, so that surveys start without waiting for one
+
+        Returns: The number of variants the config asks for
+        """
+        count = 0
+        for participant in config.values():
+            resolved = self.resolveConfig(participant)
+            count += sum(isinstance(model, dict) and "sourceFile" in model
+                         for model in resolved["models"].values())
+        return count
+
+def buildFolder(directory: str, levels: list[int]) -> int:
+    """
+    Build the variants at the given levels of every model under a folder,
+    except the variants themselves
+
+    Returns: The number of variants built or found current
+    """
+    library = LodLibrary(directory, GeometryCache(directory))
+    built = 0
+    for root, dirs, filenames in os.walk(directory):
+        if os.path.samefile(root, directory) and LOD_DIRECTORY in dirs:
+            dirs.remove(LOD_DIRECTORY)
+        for filename in sorted(filenames):
+            if not filename.endswith(MODEL_EXTENSIONS):
+                continue
+            relative = os.path.relpath(os.path.join(root, filename),
+                                       directory).replace("\\", "/")
+            for level in levels:
+                try:
+                    variant = library.get(relative, level)
+                except (OSError, ValueError, KeyError, IndexError) as e:
+                    print(f"Could not build level {level} of {relative}: {e}")
+                    continue
+                print(f"{library.filenameFor(relative, level)}: "
+                      f"{len(variant.faces)} faces")
+                built += 1
+    return built
+
+if __name__ == "__main__":
+    folder = sys.argv[1] if len(sys.argv) > 1 else "../frontend/dist/3dmodels"
+    levels = [int(level) for level in sys.argv[2:]] or [1, 2]
+    print(f"Built or found {buildFolder(folder, levels)} variants")
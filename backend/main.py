@@ -1,28 +1,121 @@
 import os
 from typing import Any
-from pathlib import Path
-from asyncio import run
+from time import perf_counter
+from asyncio import run, create_task
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import Response, FileResponse
+from fastapi.responses import Response, FileResponse, JSONResponse
 from fastapi.routing import Mount
-from survey3d import SurveyManager, Mesh, LandmarkSet, Landmark
+from survey3d import SurveyManager, Survey, Mesh, LandmarkSet
+from codec import encodeText, decode
+from messages import (decodeExperimenterMessage,
+                      Waiting, Update, Patch, MeshQuery, Submit, Start, 
+                      RequestSurvey, RequestConfig, LandmarkSetRequest, 
+                      MeshQueryRequest, NearestRequest, messageType)
+from hub import Subscriber, DEFAULT_TOPIC
+from meshindex import MeshIndex
+from staticfiles import CompressedStaticFiles
+from export import SurveyExporter
+from geometry import MeshTableCache
+from lod import LodLibrary
+from sessionstore import openSessionStore
+from spatial import SpatialIndexCache
+from catalog import SurveyCatalog, CATALOG
+from heatmap import HeatmapAggregator, ALL_PARTICIPANTS, ALL_FIELDS
+from ingest import IngestQueue, MalformedMessage, RECEIVED_BYTES
+from metrics import REGISTRY, CONTENT_TYPE, profile
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Follow a shared session store while the app runs, so that changes made
+    through other server processes reach this process's clients
+    """
+    watcher = None
+    if manager.store.shared:
+        watcher = create_task(manager.watchStore())
+    yield
+    if watcher is not None:
+        watcher.cancel()
 
 # The app we are serving
-app = FastAPI()
+app = FastAPI(lifespan = lifespan)
 
 # The path we pull our configs from
 CONFIG_PATH = r"./config/"
 DATA_PATH = r"../data/"
 DIST_PATH = r"../frontend/dist/"
 
+# In-progress sessions are kept in journal files by default. Set 
+# SURVEY3D_SESSION_STORE=sqlite to keep them in an SQLite database which 
+# several server processes can share, e.g. under uvicorn --workers N
+SESSION_STORE = os.environ.get("SURVEY3D_SESSION_STORE")
+
 # The survey manager
-manager = SurveyManager(CONFIG_PATH, DATA_PATH)
+manager = SurveyManager(CONFIG_PATH, DATA_PATH, DIST_PATH + r"3dmodels",
+                        openSessionStore(SESSION_STORE, DATA_PATH))
+# Models the config asks to show at a lower level of detail are decimated,
+# and fields drawn on them are mapped back to full resolution when saved
+manager.lods = LodLibrary(DIST_PATH + r"3dmodels", manager.geometry)
+manager.lods.prepare(manager.config)
+# Fields are measured on their meshes as their surveys are saved
+manager.meshTables = MeshTableCache(manager.meshStore)
+# and their hotspots, like landmarks, are snapped to the nearest vertex and face
+manager.spatial = SpatialIndexCache(manager.meshTables)
+# Saved surveys are added to a columnar export for cohort analysis
+manager.exporter = SurveyExporter(os.path.join(DATA_PATH, "export"))
+# and to running per-vertex heatmaps
+manager.heatmaps = HeatmapAggregator(os.path.join(DATA_PATH, "heatmaps"),
+                                     manager.modelVertexCount)
+# and to a catalog which can be queried without reading the survey files
+manager.catalog = SurveyCatalog(os.path.join(DATA_PATH, CATALOG))
+
+# Metrics of websocket traffic, served with the rest at /metrics
+MESSAGE_SECONDS = REGISTRY.histogram(
+    "survey3d_ws_message_seconds",
+    "Time taken to handle websocket messages, by endpoint and type",
+    ("endpoint", "type")
+)
+SENT_BYTES = REGISTRY.counter(
+    "survey3d_ws_sent_bytes_total",
+    "Characters of JSON text sent over websockets, by endpoint",
+    ("endpoint",)
+)
+CONNECTIONS = REGISTRY.gauge(
+    "survey3d_ws_connections",
+    "Websocket clients connected, by endpoint",
+    ("endpoint",)
+)
+REGISTRY.collect("survey3d_hub", "Survey pushes to experimenter clients", 
+                 manager.hub.stats)
+REGISTRY.collect("survey3d_config", "Participant config reloads", 
+                 manager.configCache.stats)
+REGISTRY.collect("survey3d_session_store", "Shared session store activity",
+                 manager.store.stats)
+
+# Set SURVEY3D_PROFILING=1 to profile any HTTP request whose URL has a 
+# ?profile parameter; the profile is returned in place of the response
+PROFILING = os.environ.get("SURVEY3D_PROFILING", "0") not in ("", "0")
+
+async def profile_request(request: Request, call_next) -> Response:
+    """
+    Profile a request with a ?profile parameter, returning the profile in
+    place of its response
+    """
+    if "profile" not in request.query_params:
+        return await call_next(request)
+    response, report = await profile(lambda: call_next(request))
+    if report is None:
+        return response
+    return Response(report, media_type = "text/plain")
+
+if PROFILING:
+    app.middleware("http")(profile_request)
 
 # Mount files
-app.mount("/assets", StaticFiles(directory=DIST_PATH + r"assets", html=True))
-app.mount("/images", StaticFiles(directory=DIST_PATH + r"images", html=True))
-app.mount("/3dmodels", StaticFiles(directory=DIST_PATH + r"3dmodels", html=True))
+app.mount("/assets", CompressedStaticFiles(directory=DIST_PATH + r"assets", html=True))
+app.mount("/images", CompressedStaticFiles(directory=DIST_PATH + r"images", html=True))
+app.mount("/3dmodels", CompressedStaticFiles(directory=DIST_PATH + r"3dmodels", html=True))
 
 @app.get("/")
 def home() -> Response:
@@ -47,129 +140,434 @@ async def save_landmark_set(request: Request) -> dict[str, Any]:
     with those inputs, then save to the DATA_PATH.
     """
     print("Saving landmark set...")
-    data = await request.json()
     try:
-        mesh = Mesh()
-        mesh.fromDict(data["mesh"])
-        lset = LandmarkSet(
-            data["name"], 
-            mesh, 
-            [
-                Landmark(
-                    l["name"], 
-                    l["x"], 
-                    l["y"], 
-                    l["z"]
-                ) for l in data["landmarks"]
-            ],
-        )
-        lset.save(DATA_PATH)
+        data = decode(await request.body(), LandmarkSetRequest)
+        mesh = Mesh(data.mesh.filename)
+        # Meshes already in the store are sent by reference only
+        if data.mesh.vertices is not None:
+            mesh.vertices = data.mesh.vertices
+            mesh.faces = data.mesh.faces or []
+            meshHash = await manager.writer.run(
+                manager.meshStore.put, 
+                mesh, 
+                data.mesh.hash
+            )
+        else:
+            meshHash = data.mesh.hash
+            # Meshes the store lacks are produced from the server's models
+            if not manager.meshStore.has(meshHash):
+                meshHash = await manager.storeModel(mesh.filename)
+            if meshHash is None:
+                raise ValueError(f"Mesh {mesh.filename} is not stored")
+        lset = LandmarkSet(data.name, mesh, data.landmarks, meshHash)
+        await manager.snapLandmarks(meshHash, lset.landmarks)
+        await manager.writer.run(lset.save, DATA_PATH)
         print("Successfully saved landmark set")
         return {"result": True, "error": ""}
     except Exception as e:
         print(f"Error while saving landmark set: {e}")
         return {"result": False, "error": str(e)}
 
-@app.get("/all-mesh-filenames")
-def all_mesh_filenames() -> dict:
+@app.post("/mesh-query")
+async def mesh_query(request: Request) -> dict[str, Any]:
     """
-    Returns a list of all available mesh filenames
+    Take a dictionary of mesh filenames to content hashes and return the 
+    filenames whose geometry must be uploaded, which excludes any the server
+    can read from its own model files
     """
-    filenames = []
+    data = decode(await request.body(), MeshQueryRequest)
+    return {"missing": await manager.missingMeshes(data.meshes)}
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """
+    Return True if a request's If-None-Match header names the given ETag
+    """
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or f'"{etag}"' in tags
+
+@app.get("/participant-config/{participant}")
+def participant_config(participant: str, request: Request) -> Response:
+    """
+    Returns a participant's entry in the participant config, with an ETag,
+    so a client revalidating its copy is answered with an empty 304 unless
+    the entry has changed
+    """
+    snapshot = manager.configCache.current()
+    fragment = snapshot.fragments.get(participant)
+    if fragment is None:
+        return Response("No such participant", status_code = 404)
+    data, etag = fragment
+    headers = {
+        "etag": f'"{etag}"',
+        "cache-control": "no-cache",
+        "x-config-version": str(snapshot.version)
+    }
+    if etag_matches(request, etag):
+        return Response(status_code = 304, headers = headers)
+    return Response(data, media_type = "application/json", headers = headers)
+
+# The most points one /nearest request may ask about
+MAX_NEAREST_POINTS = 100000
+
+@app.post("/nearest")
+async def nearest(request: Request) -> Response:
+    """
+    Takes points on a mesh, given by the mesh's content hash or by a model's
+    filename, and returns the nearest vertex and face to each, the distance
+    to the face and the barycentric coordinates of the face's nearest point
+    """
+    try:
+        data = decode(await request.body(), NearestRequest)
+    except ValueError as e:
+        return Response(str(e), status_code = 400)
+    if len(data.points) > MAX_NEAREST_POINTS:
+        return Response(f"At most {MAX_NEAREST_POINTS} points may be queried",
+                        status_code = 400)
+    meshHash = data.mesh
+    if meshHash is None and data.model is not None:
+        meshHash = await manager.storeModel(data.model)
+    if meshHash is None or not manager.meshStore.isHash(meshHash):
+        return Response("No such mesh", status_code = 404)
+    index = await manager.compute.run(manager.spatial.get, meshHash)
+    if index is None:
+        return Response("No such mesh", status_code = 404)
+    try:
+        result = await manager.compute.run(index.query, data.points)
+    except ValueError as e:
+        return Response(str(e), status_code = 400)
+    return JSONResponse(result)
+
+@app.get("/persistence-stats")
+def persistence_stats() -> dict:
+    """
+    Returns latency statistics for survey, mesh and landmark file writes,
+    and separately for the work run on the compute pool
+    """
+    return {
+        "writes": manager.writer.stats(),
+        "compute": manager.compute.stats()
+    }
+
+@app.get("/metrics")
+def metrics() -> Response:
+    """
+    Returns the server's metrics in the Prometheus text format
+    """
+    return Response(REGISTRY.render(), media_type = CONTENT_TYPE)
+
+@app.get("/hub-stats")
+def hub_stats() -> dict:
+    """
+    Returns counts of survey pushes to experimenter clients
+    """
+    return manager.hub.stats()
+
+@app.get("/surveys")
+def surveys(participant: str | None = None, model: str | None = None, 
+            quality: str | None = None, minIntensity: float | None = None,
+            dateFrom: str | None = None, dateTo: str | None = None, 
+            limit: int = 50, offset: int = 0) -> dict:
+    """
+    Returns a page of the saved surveys matching the given filters, newest 
+    first, from the survey catalog
+    """
+    limit = max(1, min(limit, 500))
+    return manager.catalog.query(participant, model, quality, minIntensity, 
+                                 dateFrom, dateTo, limit, max(0, offset))
+
+@app.get("/surveys/{filename}")
+def survey_summary(filename: str) -> Response:
+    """
+    Returns a saved survey's fields and qualities from the survey catalog
+    """
+    survey = manager.catalog.get(filename)
+    if survey is None:
+        return Response("No such survey", status_code = 404)
+    return JSONResponse(survey)
+
+@app.get("/heatmap-keys")
+def heatmap_keys() -> dict:
+    """
+    Returns the model, participant and group of every heatmap, and the 
+    number of fields in each
+    """
+    return {"heatmaps": manager.heatmaps.keys()}
+
+@app.get("/heatmap")
+async def heatmap(model: str, participant: str = ALL_PARTICIPANTS, 
+                  group: str = ALL_FIELDS, 
+                  value: str = "coverage") -> Response:
+    """
+    Returns a heatmap's vertex colors as float32 RGB triples, ready to be 
+    set as a three.js color attribute, with one triple per vertex of the 
+    model when the server can read the model itself
+    """
+    size = None
+    if manager.geometry is not None:
+        try:
+            geometry = await manager.compute.run(manager.geometry.get, model)
+            if geometry is not None:
+                size = len(geometry.vertices)
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            print(f"Could not load geometry of {model}: {e}")
+    try:
+        result = await manager.compute.run(manager.heatmaps.colors, model,
+                                           participant, group, value, size)
+    except ValueError as e:
+        return Response(str(e), status_code = 400)
+    if result is None:
+        return Response("No such heatmap", status_code = 404)
+    colors, peak, fields = result
+    return Response(
+        colors.tobytes(), 
+        media_type = "application/octet-stream",
+        headers = {
+            "x-heatmap-fields": str(fields), 
+            "x-heatmap-peak": str(peak),
+            "cache-control": "no-cache"
+        }
+    )
+
+def model_mount_indexes() -> list[MeshIndex]:
+    """
+    Build a MeshIndex for every directory mounted below /3dmodels
+    """
+    indexes = []
     for route in app.routes: 
         if isinstance(route, Mount) and route.path.startswith("/3dmodels"):
-            route_directory = Path(route.app.directory)
             route_prefix = route.path.split("/3dmodels")[-1][1:]
             if route_prefix: route_prefix = route_prefix + "/"
-            for root, dirs, files in os.walk(route_directory):
-                for file in files:
-                    if file.endswith((".glb", ".gltf")):
-                        file_path = Path(root) / file
-                        relative_path = file_path.relative_to(route_directory)
-                        filenames.append(route_prefix + str(relative_path).replace("\\", "/"))
-    return {"filenames": filenames}
+            indexes.append(MeshIndex(route.app.directory, route_prefix))
+    return indexes
+
+# Indexes of the model files, rescanned only when their directories change
+mesh_indexes = model_mount_indexes()
+
+@app.get("/all-mesh-filenames")
+def all_mesh_filenames() -> dict:
+    """
+    Returns a list of all available mesh filenames, and the size, vertex and
+    face counts and content hash of each file
+    """
+    filenames = []
+    meshes = {}
+    for index in mesh_indexes:
+        for filename, info in index.files().items():
+            filenames.append(filename)
+            meshes[filename] = info.toDict()
+    return {"filenames": filenames, "meshes": meshes}
+
+def bound_session_id(sessionId: str | None, 
+                     survey: Survey | None = None) -> str | None:
+    """
+    Resolve the session a websocket is working on. Clients name their session
+    with the ?session= query parameter; otherwise a survey message names it by
+    its participant, and failing that the only session in progress is used
+    """
+    if sessionId is not None:
+        return sessionId
+    if survey is not None:
+        return survey.participant
+    return manager.defaultSessionId()
+
+async def send_message(websocket: WebSocket, msg: dict | str, 
+                       endpoint: str) -> None:
+    """
+    Send a message, which may hold survey3d objects, as a JSON text frame.
+    A message already serialized is sent as it is
+    """
+    text = msg if isinstance(msg, str) else encodeText(msg)
+    SENT_BYTES.inc(endpoint, amount = len(text))
+    await websocket.send_text(text)
 
 @app.websocket("/participant-ws")
 async def participant_ws(websocket: WebSocket):
     """
-    The websocket entry point for the participant client
+    The websocket entry point for the participant client. Messages are read
+    by an IngestQueue, so a full update still waiting when a newer one 
+    arrives is skipped
     """
     await websocket.accept()
+    CONNECTIONS.inc("participant")
+    sessionId = websocket.query_params.get("session")
     try:
-        while True:
-            data = await websocket.receive_json()
-            # If participant is waiting and a survey exists, 
-            # pass along the survey
-            if data["type"] == "waiting":
-                if manager.survey:
-                    msg = {
-                        "type" : "survey",
-                        "survey" : manager.survey.toDict()
-                    }
-                    print("Sending survey to participant...")
-                    await websocket.send_json(msg)
-            # If participant reports having an update, update the server's
-            # representation of the survey with that data
-            elif data["type"] == "update":
-                manager.updateSurvey(data["survey"])
-            # If participant requests to submit the survey, update the survey
-            # then attempt to save to .json
-            elif data["type"] == "submit":
-                manager.updateSurvey(data["survey"])
-                result = manager.saveSurvey()
-                result &= manager.saveMeshData(data["meshes"])
-                msg = {
-                    "type" : "submitResponse",
-                    "success" : result
-                } 
-                await websocket.send_json(msg)
-            else:
-                raise ValueError("Bad type value in participant-ws: " 
-                                 + f"{data['type']}")
+        async with IngestQueue(websocket) as queue:
+            while True:
+                try:
+                    data = await queue.get()
+                except MalformedMessage as e:
+                    print(f"Malformed {e.type} message: {e}")
+                    await answer_malformed(websocket, e.type)
+                    continue
+                start = perf_counter()
+                await handle_participant_message(websocket, sessionId, data)
+                MESSAGE_SECONDS.observe(perf_counter() - start, 
+                                        "participant", messageType(data))
     except WebSocketDisconnect:
         print("Participant disconnected")
+    finally:
+        CONNECTIONS.dec("participant")
+
+async def answer_malformed(websocket: WebSocket, type: str) -> None:
+    """
+    Answer a participant message which could not be decoded as its sender
+    expects a refused message of its type to be answered, so the client 
+    does not wait on it
+    """
+    if type in ("update", "patch"):
+        msg = {
+            "type" : "resync"
+        }
+    elif type == "submit":
+        msg = {
+            "type" : "submitResponse",
+            "success" : False
+        }
+    else:
+        return
+    await send_message(websocket, msg, "participant")
+
+async def handle_participant_message(websocket: WebSocket, 
+                                     sessionId: str | None, data) -> None:
+    """
+    Handle one message from a participant client
+    """
+    # If participant is waiting and a survey exists, 
+    # pass along the survey
+    if isinstance(data, Waiting):
+        session = manager.getSession(bound_session_id(sessionId))
+        if session:
+            msg = {
+                "type" : "survey",
+                "survey" : session.survey
+            }
+            print("Sending survey to participant...")
+            await send_message(websocket, msg, "participant")
+    # If participant reports having an update, update the server's
+    # representation of the survey with that data
+    elif isinstance(data, Update):
+        updateId = bound_session_id(sessionId, data.survey)
+        if await manager.updateSurvey(updateId, data.survey):
+            msg = {
+                "type" : "updateAck",
+                "version" : manager.getSession(updateId).version
+            }
+        else:
+            # The client holds back its edits until its update is answered,
+            # so a rejected update must be answered too
+            msg = {
+                "type" : "resync"
+            }
+        await send_message(websocket, msg, "participant")
+    # If participant reports a patch against a known version, apply
+    # it in place, or ask for the full survey if versions diverged
+    elif isinstance(data, Patch):
+        patchId = bound_session_id(sessionId)
+        if await manager.patchSurvey(patchId,
+                                     data.startTime, 
+                                     data.baseVersion, 
+                                     data.ops):
+            msg = {
+                "type" : "patchAck",
+                "version" : manager.getSession(patchId).version
+            }
+        else:
+            msg = {
+                "type" : "resync"
+            }
+        await send_message(websocket, msg, "participant")
+    # If participant offers the hashes of its meshes ahead of a 
+    # submit, tell it which ones the server does not hold
+    elif isinstance(data, MeshQuery):
+        msg = {
+            "type" : "meshQueryResponse",
+            "missing" : await manager.missingMeshes(data.meshes)
+        }
+        await send_message(websocket, msg, "participant")
+    # If participant requests to submit the survey, update the survey
+    # then attempt to save to .json
+    elif isinstance(data, Submit):
+        submitId = bound_session_id(sessionId, data.survey)
+        result = await manager.updateSurvey(submitId, data.survey)
+        if result:
+            result = await manager.saveMeshData(submitId,
+                                                data.meshes, 
+                                                data.meshHashes)
+        # A survey whose meshes could not be stored is not saved, so the
+        # session stays open for the client to resubmit with them uploaded
+        if result:
+            result = await manager.saveSurvey(submitId)
+        msg = {
+            "type" : "submitResponse",
+            "success" : result
+        } 
+        await send_message(websocket, msg, "participant")
+
+async def push_publications(websocket: WebSocket, subscriber: Subscriber):
+    """
+    Send a subscriber's publications down its websocket as they arrive. While
+    a send is under way newer publications replace older ones, so a slow
+    client skips straight to the latest state
+    """
+    try:
+        while True:
+            text = await subscriber.next()
+            SENT_BYTES.inc("experimenter", amount = len(text))
+            await websocket.send_text(text)
+    except (WebSocketDisconnect, RuntimeError):
+        pass
 
 @app.websocket("/experimenter-ws")
 async def experimenter_ws(websocket: WebSocket):
     """
-    The websocket entry point for the experimenter client
+    The websocket entry point for the experimenter client. The survey being
+    followed is pushed to the client whenever it changes
     """
     await websocket.accept()
+    CONNECTIONS.inc("experimenter")
+    sessionId = websocket.query_params.get("session")
+    subscriber = manager.hub.subscribe(sessionId or DEFAULT_TOPIC)
+    pusher = create_task(push_publications(websocket, subscriber))
     try:
         while True:
-            data = await websocket.receive_json()
-            # Start a new survey for a given participant
-            if data["type"] == "start":
-                if manager.newSurvey(data["subject"]):
-                    print(f"Starting survey for {data['subject']}.")
+            text = await websocket.receive_text()
+            RECEIVED_BYTES.inc("experimenter", amount = len(text))
+            data = decodeExperimenterMessage(text)
+            start = perf_counter()
+            # Start a new survey for a given participant, and follow it
+            if isinstance(data, Start):
+                if await manager.newSurvey(data.subject):
+                    print(f"Starting survey for {data.subject}.")
+                    sessionId = data.subject
+                    manager.hub.move(subscriber, sessionId)
                 else:
-                    print(f"Cannot start survey for {data['subject']}!")
+                    print(f"Cannot start survey for {data.subject}!")
             # Return to the experimenter a dictionary with all survey data, 
-            # to be viewed by the experimenter client
-            elif data["type"] == "requestSurvey":
-                if manager.survey != None:
-                    msg = {
-                        "type" : "survey",
-                        "survey" : manager.survey.toDict()
-                    }
-                    await websocket.send_json(msg)
+            # to be viewed by the experimenter client. Surveys are pushed as 
+            # they change, so this is only needed by clients which poll
+            elif isinstance(data, RequestSurvey):
+                msg = manager.surveyMessage(bound_session_id(sessionId))
+                await send_message(websocket, msg, "experimenter")
+            # Return to the experimenter the current participant config, 
+            # already serialized, unless its copy is current
+            elif isinstance(data, RequestConfig):
+                snapshot = manager.configCache.current()
+                if data.etag == snapshot.etag:
+                    msg = snapshot.notModified()
                 else:
-                    msg = {
-                        "type" : "noSurvey"
-                    }
-                    await websocket.send_json(msg)
-            # Return to the experimenter the current participant config
-            elif data["type"] == "requestConfig":
-                msg = {
-                    "type" : "config",
-                    "config" : manager.config
-                }
-                await websocket.send_json(msg)
-            else:
-                raise ValueError(f"Bad type value in experimenter-ws: " 
-                                 + f"{data['type']}")
+                    msg = snapshot.message
+                await send_message(websocket, msg, "experimenter")
+            MESSAGE_SECONDS.observe(perf_counter() - start, 
+                                    "experimenter", messageType(data))
     except WebSocketDisconnect:
         print("Experimenter disconnected")
+    finally:
+        pusher.cancel()
+        manager.hub.unsubscribe(subscriber)
+        CONNECTIONS.dec("experimenter")
 
 @app.get("/favicon.ico")
 async def favicon():
@@ -0,0 +1,174 @@
+"""
+A binary, memory-mappable storage format for mesh geometry.
+
+A .s3dmesh file is a 32 byte little-endian header, the mesh's filename as
+UTF-8, then the vertices as contiguous float32 triples and the faces as
+contiguous int32 triples. Both buffers start on a 16 byte boundary so that
+they can be mapped straight into numpy arrays without copying.
+
+    offset  type      field
+    0       char[8]   magic, b"S3DMESH\\0"
+    8       uint32    format version
+    12      uint32    vertex count
+    16      uint32    face count
+    20      uint32    byte offset of the vertex buffer
+    24      uint32    byte offset of the face buffer
+    28      uint32    byte length of the filename
+
+Running this module converts the JSON meshes in a data folder:
+
+    python meshbin.py ../data
+"""
+import os
+import sys
+import json
+import struct
+import hashlib
+from dataclasses import dataclass
+import numpy as np
+from persistence import atomicOpen
+
+MAGIC = b"S3DMESH\0"
+VERSION = 1
+EXTENSION = ".s3dmesh"
+HEADER = struct.Struct("<8sIIIIII")
+ALIGNMENT = 16
+
+@dataclass
+class MeshArrays():
+    """
+    Mesh geometry as numpy arrays, usually mapped from a .s3dmesh file
+    """
+    filename: str
+    vertices: np.ndarray
+    faces: np.ndarray
+
+    def contentHash(self) -> str:
+        """
+        Return the same hash of the geometry as Mesh.contentHash, computed 
+        from the arrays' buffers
+        """
+        vertices = np.ascontiguousarray(self.vertices, dtype = "<f4")
+        faces = np.ascontiguousarray(self.faces, dtype = "<i4")
+        digest = hashlib.sha256()
+        digest.update(struct.pack("<II", len(vertices), len(faces)))
+        digest.update(vertices.tobytes())
+        digest.update(faces.tobytes())
+        return digest.hexdigest()
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def writeMeshBinary(path: str, filename: str, vertices, faces) -> None:
+    """
+    Write mesh geometry to a .s3dmesh file
+
+    Args:
+        path: The path of the file to be written
+        filename: The filename of the model the geometry came from
+        vertices: An (N, 3) array-like of vertex positions
+        faces: An (M, 3) array-like of vertex indices
+    """
+    vertices = np.ascontiguousarray(vertices, dtype = "<f4").reshape(-1, 3)
+    faces = np.ascontiguousarray(faces, dtype = "<i4").reshape(-1, 3)
+    name = filename.encode("utf-8")
+
+    vertexOffset = _align(HEADER.size + len(name))
+    faceOffset = _align(vertexOffset + vertices.nbytes)
+    header = HEADER.pack(MAGIC, VERSION, len(vertices), len(faces),
+                         vertexOffset, faceOffset, len(name))
+
+    with atomicOpen(path, 'wb') as file:
+        file.write(header)
+        file.write(name)
+        file.write(b"\0" * (vertexOffset - HEADER.size - len(name)))
+        file.write(vertices.tobytes())
+        file.write(b"\0" * (faceOffset - vertexOffset - vertices.nbytes))
+        file.write(faces.tobytes())
+
+def loadMeshBinary(path: str) -> MeshArrays:
+    """
+    Open a .s3dmesh file without copying its buffers. The returned arrays
+    are read-only memory maps of the file
+
+    Args:
+        path: The path of the file to be opened
+
+    Returns: The mesh's filename, vertices and faces
+    """
+    with open(path, 'rb') as file:
+        header = file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError(f"{path} is too short to be a mesh file")
+        (magic, version, vertexCount, faceCount, vertexOffset, faceOffset,
+         nameLength) = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a mesh file")
+        if version != VERSION:
+            raise ValueError(f"{path} has unsupported version {version}")
+        filename = file.read(nameLength).decode("utf-8")
+
+    if vertexCount:
+        vertices = np.memmap(path, dtype = "<f4", mode = "r",
+                             offset = vertexOffset, shape = (vertexCount, 3))
+    else:
+        vertices = np.empty((0, 3), dtype = "<f4")
+    if faceCount:
+        faces = np.memmap(path, dtype = "<i4", mode = "r",
+                          offset = faceOffset, shape = (faceCount, 3))
+    else:
+        faces = np.empty((0, 3), dtype = "<i4")
+    return MeshArrays(filename, vertices, faces)
+
+def convertJSONMesh(jsonPath: str, binaryPath: str | None = None) -> bool:
+    """
+    Convert a JSON mesh dump, as written by Mesh.saveMesh, to a .s3dmesh
+    file next to it. Files which are not mesh dumps, or which are already
+    converted and unchanged, are skipped
+
+    Args:
+        jsonPath: The path of the JSON mesh
+        binaryPath: The path to write to, by default the JSON path with its
+        .json extension replaced
+
+    Returns: True if a file was written, False if skipped
+    """
+    if binaryPath is None:
+        binaryPath = jsonPath[:-len(".json")] + EXTENSION
+    if (os.path.isfile(binaryPath)
+            and os.path.getmtime(binaryPath) >= os.path.getmtime(jsonPath)):
+        return False
+    with open(jsonPath, 'r') as file:
+        data = json.load(file)
+    if not (isinstance(data, dict) and "vertices" in data and "faces" in data
+            and "projectedFields" not in data):
+        return False
+    writeMeshBinary(binaryPath, data.get("filename", ""),
+                    data["vertices"], data["faces"])
+    return True
+
+def convertFolder(path: str) -> int:
+    """
+    Convert every JSON mesh dump in a folder and its subfolders
+
+    Args:
+        path: The folder to search, usually the data folder
+
+    Returns: The number of files converted
+    """
+    converted = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            if file.endswith(".json") and not file.startswith("Survey3D"):
+                fullpath = os.path.join(root, file)
+                try:
+                    if convertJSONMesh(fullpath):
+                        print(f"Converted {fullpath}")
+                        converted += 1
+                except (ValueError, json.JSONDecodeError) as e:
+                    print(f"Could not convert {fullpath}: {e}")
+    return converted
+
+if __name__ == "__main__":
+    folder = sys.argv[1] if len(sys.argv) > 1 else "../data/"
+    print(f"Converted {convertFolder(folder)} meshes")
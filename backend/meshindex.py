@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import struct
+import hashlib
+from dataclasses import dataclass, asdict
+
+MODEL_EXTENSIONS = (".glb", ".gltf")
+# The folder of the served models' decimated variants, see lod.py, which are
+# not models in their own right
+LOD_DIRECTORY = "lod"
+GLB_HEADER = struct.Struct("<4sII")
+GLB_CHUNK = struct.Struct("<I4s")
+
+@dataclass
+class MeshFileInfo():
+    """
+    Metadata of one model file, enough for a client to decide whether its
+    cached copy is current without downloading the file
+    """
+    size: int
+    mtime: float
+    vertices: int
+    faces: int
+    hash: str
+
+    def toDict(self) -> dict:
+        return asdict(self)
+
+def readGLTFJSON(path: str) -> dict:
+    """
+    Read the JSON document of a .gltf file, or the JSON chunk of a .glb file
+    without reading its binary chunk
+
+    Args:
+        path: The path of the model file
+
+    Returns: The parsed glTF document
+    """
+    if path.endswith(".gltf"):
+        with open(path, 'r') as file:
+            return json.load(file)
+    with open(path, 'rb') as file:
+        magic, version, length = GLB_HEADER.unpack(file.read(GLB_HEADER.size))
+        if magic != b"glTF":
+            raise ValueError(f"{path} is not a GLB file")
+        chunkLength, chunkType = GLB_CHUNK.unpack(file.read(GLB_CHUNK.size))
+        if chunkType != b"JSON":
+            raise ValueError(f"{path} does not start with a JSON chunk")
+        return json.loads(file.read(chunkLength))
+
+def countGeometry(document: dict) -> tuple[int, int]:
+    """
+    Count the vertices and triangles of every mesh primitive in a glTF
+    document, from its accessors alone
+
+    Args:
+        document: A parsed glTF document
+
+    Returns: The vertex count and the face count
+    """
+    accessors = document.get("accessors", [])
+    vertices = faces = 0
+    for mesh in document.get("meshes", []):
+        for primitive in mesh.get("primitives", []):
+            if "POSITION" not in primitive.get("attributes", {}):
+                continue
+            count = accessors[primitive["attributes"]["POSITION"]]["count"]
+            vertices += count
+            if "indices" in primitive:
+                faces += accessors[primitive["indices"]]["count"] // 3
+            else:
+                faces += count // 3
+    return vertices, faces
+
+def hashFile(path: str) -> str:
+    """
+    Return the SHA-256 of a file's contents as hex
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class MeshIndex():
+    """
+    An in-memory index of the model files under a directory. The index is
+    built once, then only rescanned when the modification time of one of its
+    directories changes, which happens whenever a file is added, removed or
+    replaced in it. Checks are themselves limited to one per checkInterval
+    seconds, so most lookups cost no filesystem access at all. Rescans reuse
+    the metadata of files whose size and modification time are unchanged
+    """
+    directory: str
+    prefix: str
+    checkInterval: float
+
+    def __init__(self, directory: str, prefix: str = "",
+                 checkInterval: float = 1.0):
+        """
+        Class initialization function
+
+        Args:
+            directory: The directory holding the model files
+            prefix: A prefix for the indexed filenames, as for a mount below
+            /3dmodels
+            checkInterval: The minimum number of seconds between checks for
+            changes
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self.checkInterval = checkInterval
+        self.version = 0
+        self._files = {}
+        self._directoryTimes = {}
+        self._lastCheck = 0.0
+        self.rebuild()
+
+    def _changed(self) -> bool:
+        for path, mtime in self._directoryTimes.items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    return True
+            except FileNotFoundError:
+                return True
+        return not self._directoryTimes
+
+    def rebuild(self) -> None:
+        """
+        Scan the directory for model files and refresh their metadata
+        """
+        files = {}
+        directoryTimes = {}
+        for root, dirs, filenames in os.walk(self.directory):
+            directoryTimes[root] = os.stat(root).st_mtime_ns
+            if root == self.directory and LOD_DIRECTORY in dirs:
+                dirs.remove(LOD_DIRECTORY)
+            for filename in filenames:
+                if not filename.endswith(MODEL_EXTENSIONS):
+                    continue
+                path = os.path.join(root, filename)
+                relative = os.path.relpath(path, self.directory)
+                name = self.prefix + relative.replace("\\", "/")
+                try:
+                    files[name] = self._describe(path, self._files.get(name))
+                except (OSError, ValueError, KeyError, IndexError) as e:
+                    print(f"Could not index model {path}: {e}")
+        self._files = files
+        self._directoryTimes = directoryTimes
+        self._lastCheck = time.monotonic()
+        self.version += 1
+
+    def _describe(self, path: str,
+                  previous: MeshFileInfo | None) -> MeshFileInfo:
+        stat = os.stat(path)
+        if (previous is not None and previous.size == stat.st_size
+                and previous.mtime == stat.st_mtime):
+            return previous
+        vertices, faces = countGeometry(readGLTFJSON(path))
+        return MeshFileInfo(stat.st_size, stat.st_mtime, vertices, faces,
+                            hashFile(path))
+
+    def refresh(self) -> None:
+        """
+        Rebuild the index if its directories have changed, checking no more
+        than once per checkInterval
+        """
+        now = time.monotonic()
+        if now - self._lastCheck < self.checkInterval:
+            return
+        self._lastCheck = now
+        if self._changed():
+            self.rebuild()
+
+    def filenames(self) -> list[str]:
+        """
+        Return the indexed model filenames
+        """
+        self.refresh()
+        return list(self._files)
+
+    def files(self) -> dict[str, MeshFileInfo]:
+        """
+        Return the indexed model filenames with their metadata
+        """
+        self.refresh()
+        return dict(self._files)
+
+    def get(self, filename: str) -> MeshFileInfo | None:
+        """
+        Return the metadata of one model file, or None if it is not indexed
+        """
+        self.refresh()
+        return self._files.get(filename)
@@ -0,0 +1,156 @@
+"""
+The messages clients send over the participant and experimenter websockets,
+as msgspec Structs tagged by their "type" key, and the bodies of the JSON
+requests they post. Each message is decoded and validated in one step,
+straight from the frame's text or the request's body.
+"""
+from typing import Any, Union, get_args
+from collections.abc import Sequence
+import msgspec
+from survey3d import Survey, Mesh, Landmark
+from codec import decode
+
+class Waiting(msgspec.Struct, tag = "waiting", tag_field = "type"):
+    """
+    The participant is ready for a survey
+    """
+
+class Update(msgspec.Struct, tag = "update", tag_field = "type"):
+    """
+    The participant's full survey. An update still waiting when a newer one
+    of the same survey arrives is replaced by it and never acknowledged, see
+    ingest.IngestQueue, so a client which sends updates without waiting for
+    their acks must take the ack of its latest update for every update 
+    before it. The frontend waits for each ack, so none of its updates are
+    replaced
+    """
+    survey: Survey
+
+class Patch(msgspec.Struct, tag = "patch", tag_field = "type"):
+    """
+    Edits to the participant's survey, see Survey.applyPatch
+    """
+    startTime: str
+    baseVersion: int
+    ops: list[dict[str, Any]]
+
+class MeshQuery(msgspec.Struct, tag = "meshQuery", tag_field = "type"):
+    """
+    The content hashes of the participant's meshes, or null for meshes it
+    could not hash
+    """
+    meshes: dict[str, str | None]
+
+class Submit(msgspec.Struct, tag = "submit", tag_field = "type"):
+    """
+    The participant's finished survey, with the meshes the server lacks
+    """
+    survey: Survey
+    meshes: dict[str, Mesh] = {}
+    meshHashes: dict[str, str | None] | None = None
+
+ParticipantMessage = Union[Waiting, Update, Patch, MeshQuery, Submit]
+
+class Start(msgspec.Struct, tag = "start", tag_field = "type"):
+    """
+    Start a survey for a participant
+    """
+    subject: str
+
+class RequestSurvey(msgspec.Struct, tag = "requestSurvey", tag_field = "type"):
+    """
+    Ask for the survey being followed
+    """
+
+class RequestConfig(msgspec.Struct, tag = "requestConfig", tag_field = "type"):
+    """
+    Ask for the participant config, unless the copy with the given ETag is
+    still current
+    """
+    etag: str | None = None
+
+ExperimenterMessage = Union[Start, RequestSurvey, RequestConfig]
+
+class SurveyHeader(msgspec.Struct):
+    """
+    The fields which identify a survey
+    """
+    participant: str = ""
+    startTime: str = ""
+
+class MessageHeader(msgspec.Struct):
+    """
+    The type of a message, and which survey it carries if any, read without
+    decoding the rest of the message
+    """
+    type: str
+    survey: SurveyHeader | None = None
+
+# The types of message a participant client may send
+PARTICIPANT_TYPES = frozenset(
+    message.__struct_config__.tag for message in get_args(ParticipantMessage)
+)
+
+def peekMessage(data: str | bytes) -> MessageHeader:
+    """
+    Read the header of a message. This only skips over a survey's fields and
+    vertices, so it costs a fraction of decoding the whole message
+
+    Raises: codec.DecodeError if the message is not JSON or has no type
+    """
+    return decode(data, MessageHeader)
+
+def messageType(message: msgspec.Struct) -> str:
+    """
+    Return the "type" of a decoded message, such as "patch"
+    """
+    return message.__struct_config__.tag
+
+def decodeParticipantMessage(data: str | bytes) -> ParticipantMessage:
+    """
+    Decode and validate a message from a participant client
+
+    Raises: codec.DecodeError if the message is malformed or of no known type
+    """
+    return decode(data, ParticipantMessage)
+
+def decodeExperimenterMessage(data: str | bytes) -> ExperimenterMessage:
+    """
+    Decode and validate a message from an experimenter client
+
+    Raises: codec.DecodeError if the message is malformed or of no known type
+    """
+    return decode(data, ExperimenterMessage)
+
+class MeshReference(msgspec.Struct):
+    """
+    A mesh sent with a landmark set, either by reference to the mesh store
+    and the server's models, or with its geometry
+    """
+    filename: str
+    hash: str | None = None
+    vertices: list[Sequence[float]] | None = None
+    faces: list[Sequence[int]] | None = None
+
+class LandmarkSetRequest(msgspec.Struct):
+    """
+    The body of a /save-landmark-set request
+    """
+    name: str
+    mesh: MeshReference
+    landmarks: list[Landmark]
+
+class MeshQueryRequest(msgspec.Struct):
+    """
+    The body of a /mesh-query request
+    """
+    meshes: dict[str, str | None]
+
+class NearestRequest(msgspec.Struct):
+    """
+    The body of a /nearest request: points on a mesh, given by its content
+    hash or by the filename of one of the server's models
+    """
+    points: list[tuple[float, float, float]]
+    mesh: str | None = None
+    model: str | None = None
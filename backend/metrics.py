@@ -0,0 +1,287 @@
+"""
+Counters, gauges and histograms of the server's work, kept in one registry
+and rendered in the Prometheus text exposition format for /metrics:
+
+    survey3d_ws_message_seconds_count{endpoint="participant",type="patch"} 1532
+
+Updating a metric takes a lock and a dictionary lookup, and for a histogram
+a bisection into its fixed buckets, so metrics are cheap enough to update on
+every message. They may be updated from the persistence writer's and compute
+pool's threads as well as from the event loop.
+
+Also here is the profiler behind the server's optional per-request
+profiling, see profile.
+"""
+import io
+import bisect
+import pstats
+import cProfile
+import threading
+from time import perf_counter
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Iterator
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Histogram bucket bounds in seconds, spanning everything from decoding a
+# small message to saving a large survey
+DEFAULT_BUCKETS = (0.00001, 0.00003, 0.0001, 0.0003, 0.001, 0.003, 0.01,
+                   0.03, 0.1, 0.3, 1.0, 3.0, 10.0)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace("\"",
+                                                                    "\\\"")
+
+def _labels(names: tuple[str, ...], values: tuple,
+            extra: str | None = None) -> str:
+    pairs = [f"{name}=\"{_escape(str(value))}\""
+             for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+class Metric():
+    """
+    A named family of values, one for each combination of label values
+    """
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        """
+        Class initialization function
+
+        Args:
+            name: The metric's name
+            help: A description of the metric
+            labels: The names of the metric's labels, whose values are given
+            in order whenever the metric is updated
+        """
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def value(self, *labels) -> Any:
+        """
+        Return the value for the given label values
+        """
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def _header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}",
+                f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> list[str]:
+        """
+        Return the metric's lines in the text exposition format
+        """
+        with self._lock:
+            items = sorted(self._values.items())
+        return self._header() + [
+            f"{self.name}{_labels(self.labelNames, labels)} {_number(value)}"
+            for labels, value in items
+        ]
+
+class Counter(Metric):
+    """
+    A count which only goes up
+    """
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    """
+    A value which goes up and down, such as the number of connections
+    """
+    kind = "gauge"
+
+    def set(self, value: float, *labels) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1) -> None:
+        self.inc(*labels, amount = -amount)
+
+class Histogram(Metric):
+    """
+    A distribution of observed values, such as durations, counted into
+    buckets with their sum and count
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        """
+        Class initialization function
+
+        Args:
+            name: The metric's name
+            help: A description of the metric
+            labels: The names of the metric's labels
+            buckets: The upper bounds of the buckets
+        """
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels) -> None:
+        """
+        Count one observation of a value for the given label values
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [
+                    [0] * (len(self.buckets) + 1), 0.0, 0
+                ]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *labels) -> Iterator[None]:
+        """
+        Observe the seconds the block takes, whether or not it raises
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, *labels)
+
+    def value(self, *labels) -> tuple[int, float]:
+        """
+        Return the count and sum of the observations for the given labels
+        """
+        with self._lock:
+            series = self._values.get(labels)
+            return (series[2], series[1]) if series else (0, 0.0)
+
+    def render(self) -> list[str]:
+        with self._lock:
+            items = sorted(
+                (labels, (list(counts), total, count))
+                for labels, (counts, total, count) in self._values.items()
+            )
+        lines = self._header()
+        bounds = self.buckets + (float("inf"),)
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucketCount in zip(bounds, counts):
+                cumulative += bucketCount
+                le = f"le=\"{_number(bound)}\""
+                lines.append(f"{self.name}_bucket"
+                             f"{_labels(self.labelNames, labels, le)} "
+                             f"{cumulative}")
+            suffix = _labels(self.labelNames, labels)
+            lines.append(f"{self.name}_sum{suffix} {_number(total)}")
+            lines.append(f"{self.name}_count{suffix} {count}")
+        return lines
+
+class MetricsRegistry():
+    """
+    The metrics of the server, which modules add to as they are imported
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def _add(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str,
+                labels: tuple[str, ...] = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str,
+              labels: tuple[str, ...] = ()) -> Gauge:
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def collect(self, prefix: str, help: str,
+                function: Callable[[], dict]) -> None:
+        """
+        Render the numbers of a stats dictionary, such as SurveyHub.stats
+        returns, at every scrape, each as an untyped metric named
+        <prefix>_<key>
+
+        Args:
+            prefix: The prefix of the metrics' names
+            help: A description of the statistics
+            function: A function returning a dictionary of numbers
+        """
+        self._collectors.append((prefix, help, function))
+
+    def render(self) -> str:
+        """
+        Return every metric in the text exposition format
+        """
+        lines = []
+        for metric in self._metrics.values():
+            lines += metric.render()
+        for prefix, help, function in self._collectors:
+            for key, value in function().items():
+                if isinstance(value, (int, float)):
+                    name = f"{prefix}_{key}"
+                    lines += [f"# HELP {name} {help}: {key}",
+                              f"# TYPE {name} untyped",
+                              f"{name} {_number(value)}"]
+        return "\n".join(lines) + "\n"
+
+# The registry rendered by /metrics
+REGISTRY = MetricsRegistry()
+
+_profiling = threading.Lock()
+
+async def profile(call: Callable[[], Awaitable],
+                  limit: int = 40) -> tuple[Any, str | None]:
+    """
+    Await a call under cProfile, and report the functions in which it spent
+    the most time. cProfile follows the event loop's thread, so the report
+    also holds whatever else the loop ran meanwhile, but not work done on
+    the persistence writer's or compute pool's threads. Only one call is
+    profiled at a time; calls made while another is being profiled run
+    without a report
+
+    Args:
+        call: A function returning the awaitable to be profiled
+        limit: The number of functions reported
+
+    Returns: The call's result, and the report sorted by cumulative time or
+        None if the call was not profiled
+    """
+    if not _profiling.acquire(blocking = False):
+        return await call(), None
+    try:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            result = await call()
+        finally:
+            profiler.disable()
+    finally:
+        _profiling.release()
+    report = io.StringIO()
+    stats = pstats.Stats(profiler, stream = report)
+    stats.sort_stats("cumulative").print_stats(limit)
+    return result, report.getvalue()
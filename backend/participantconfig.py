@@ -0,0 +1,334 @@
+"""
+The participant config as a cached, versioned resource. The config file is
+read, validated and serialized once, and then only again when its
+modification time or size changes, so editing participant_config.json takes
+effect without restarting the server and dropping every websocket. A config
+which cannot be read or fails validation is reported and the previous one
+is kept; the new one replaces it in a single step once it is fully checked.
+
+Each version of the config is held as a ConfigSnapshot, with the experimenter
+message listing it and each participant's entry already serialized, and
+strong ETags taken from their contents, so clients holding a current copy
+are answered without sending it again.
+
+Validation checks the shape of every entry, see the config README:
+
+    models         an object of models, each with a "file" in the model
+                   library, optional "views" of [x, y, z, zoom] and an
+                   optional non-negative integer "lod"
+    qualityTypes   a list of distinct, non-empty strings
+    hide...        booleans
+    reportEdge     "left" or "right"
+    controlEdge    "top" or "bottom"
+
+Model files missing from the library and unknown keys are warnings, since
+models may be added after the config; anything else is an error. Running
+this module checks a config file:
+
+    python participantconfig.py config/participant_config.json ../frontend/dist/3dmodels
+"""
+import os
+import sys
+import json
+import math
+import time
+import hashlib
+import threading
+from dataclasses import dataclass, field
+from typing import Callable
+from codec import encode, encodeText
+
+CONFIG_FILENAME = "participant_config.json"
+
+BOOLEAN_KEYS = ("hideScaleValues", "hidePainSlider",
+                "hideFieldIntensitySlider")
+CHOICES = {
+    "reportEdge": ("left", "right"),
+    "controlEdge": ("top", "bottom")
+}
+KNOWN_KEYS = {"models", "qualityTypes", *BOOLEAN_KEYS, *CHOICES}
+MODEL_KEYS = {"file", "views", "lod"}
+
+class ConfigError(ValueError):
+    """
+    A participant config which cannot be read or is invalid
+    """
+
+def _contentTag(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:32]
+
+def _isNumber(value) -> bool:
+    return (isinstance(value, (int, float)) and not isinstance(value, bool)
+            and math.isfinite(value))
+
+def validateEntry(participant: str, entry,
+                  modelExists: Callable[[str], bool] | None = None
+                  ) -> tuple[list[str], list[str]]:
+    """
+    Check one participant's entry in the participant config
+
+    Args:
+        participant: The participant's name, used in the messages
+        entry: The participant's entry
+        modelExists: A function returning True if a model file is in the
+        model library, or None to skip that check
+
+    Returns: The errors and the warnings found, as messages
+    """
+    errors = []
+    warnings = []
+    if not isinstance(entry, dict):
+        return [f"{participant}: entry is not an object"], warnings
+
+    models = entry.get("models")
+    if not isinstance(models, dict) or not models:
+        errors.append(f"{participant}: models must be a non-empty object")
+        models = {}
+    for name, model in models.items():
+        where = f"{participant}: model {name!r}"
+        if not isinstance(model, dict):
+            errors.append(f"{where} is not an object")
+            continue
+        filename = model.get("file")
+        if not isinstance(filename, str) or not filename:
+            errors.append(f"{where} has no file")
+        elif modelExists is not None and not modelExists(filename):
+            warnings.append(f"{where}: {filename} is not in the model "
+                            "library")
+        views = model.get("views", {})
+        if not isinstance(views, dict):
+            errors.append(f"{where}: views must be an object")
+            views = {}
+        for view, vector in views.items():
+            if (not isinstance(vector, list) or len(vector) != 4
+                    or not all(_isNumber(value) for value in vector)):
+                errors.append(f"{where}: view {view!r} must be "
+                              "[x, y, z, zoom]")
+            elif vector[3] <= 0:
+                errors.append(f"{where}: view {view!r} has a zoom of "
+                              f"{vector[3]}, which must be positive")
+        lod = model.get("lod", 0)
+        if not isinstance(lod, int) or isinstance(lod, bool) or lod < 0:
+            errors.append(f"{where}: lod must be a non-negative integer")
+        for key in model.keys() - MODEL_KEYS:
+            warnings.append(f"{where}: unknown key {key!r}")
+
+    qualityTypes = entry.get("qualityTypes", [])
+    if (not isinstance(qualityTypes, list)
+            or not all(isinstance(quality, str) and quality
+                       for quality in qualityTypes)):
+        errors.append(f"{participant}: qualityTypes must be a list of "
+                      "non-empty strings")
+    elif len(set(qualityTypes)) != len(qualityTypes):
+        errors.append(f"{participant}: qualityTypes has duplicates")
+
+    for key in BOOLEAN_KEYS:
+        if key in entry and not isinstance(entry[key], bool):
+            errors.append(f"{participant}: {key} must be true or false")
+    for key, choices in CHOICES.items():
+        if key in entry and entry[key] not in choices:
+            errors.append(f"{participant}: {key} must be one of "
+                          f"{', '.join(choices)}")
+    for key in entry.keys() - KNOWN_KEYS:
+        warnings.append(f"{participant}: unknown key {key!r}")
+    return errors, warnings
+
+def validateConfig(config, modelExists: Callable[[str], bool] | None = None
+                   ) -> list[str]:
+    """
+    Check a whole participant config
+
+    Args:
+        config: The parsed config
+        modelExists: A function returning True if a model file is in the
+        model library, or None to skip that check
+
+    Returns: The warnings found
+
+    Raises: ConfigError listing every error found
+    """
+    if not isinstance(config, dict):
+        raise ConfigError("The participant config is not an object")
+    errors = []
+    warnings = []
+    for participant, entry in config.items():
+        entryErrors, entryWarnings = validateEntry(participant, entry,
+                                                   modelExists)
+        errors += entryErrors
+        warnings += entryWarnings
+    if errors:
+        raise ConfigError("The participant config is invalid:\n  "
+                          + "\n  ".join(errors))
+    return warnings
+
+@dataclass(frozen = True)
+class ConfigSnapshot():
+    """
+    One validated version of the participant config, with its serialized
+    forms
+    """
+    config: dict
+    version: int
+    etag: str
+    # The experimenter's "config" message, serialized
+    message: str
+    # Each participant's entry, serialized, with its ETag
+    fragments: dict[str, tuple[bytes, str]] = field(default_factory = dict)
+    warnings: list[str] = field(default_factory = list)
+
+    @classmethod
+    def build(cls, config: dict, version: int,
+              warnings: list[str]) -> "ConfigSnapshot":
+        fragments = {}
+        for participant, entry in config.items():
+            data = encode(entry)
+            fragments[participant] = (data, _contentTag(data))
+        etag = _contentTag(encode(config))
+        message = encodeText({
+            "type": "config",
+            "config": config,
+            "etag": etag,
+            "version": version,
+            "warnings": warnings
+        })
+        return cls(config, version, etag, message, fragments, warnings)
+
+    def notModified(self) -> str:
+        """
+        Return the experimenter's "configNotModified" message, serialized
+        """
+        return encodeText({"type": "configNotModified", "etag": self.etag,
+                           "version": self.version})
+
+class ParticipantConfig():
+    """
+    The participant config file, reloaded when it changes. Checks for
+    changes are limited to one per checkInterval seconds, so most reads cost
+    no filesystem access at all
+    """
+    path: str
+    checkInterval: float
+
+    def __init__(self, path: str,
+                 modelExists: Callable[[str], bool] | None = None,
+                 checkInterval: float = 1.0):
+        """
+        Class initialization function
+
+        Args:
+            path: The path of participant_config.json
+            modelExists: A function returning True if a model file is in the
+            model library, or None to skip that check
+            checkInterval: The minimum number of seconds between checks for
+            changes
+
+        Raises: ConfigError if the config cannot be read or is invalid
+        """
+        self.path = path
+        self.modelExists = modelExists
+        self.checkInterval = checkInterval
+        self.reloads = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._key = self._stat()
+        self._lastCheck = time.monotonic()
+        self._snapshot = self._load(1)
+        self._report(self._snapshot)
+
+    def _stat(self) -> tuple[int, int] | None:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _load(self, version: int) -> ConfigSnapshot:
+        try:
+            with open(self.path, 'r') as file:
+                config = json.load(file)
+        except json.JSONDecodeError as e:
+            raise ConfigError(f"Participant config cannot be parsed: {e}")
+        except OSError as e:
+            raise ConfigError(f"Participant config cannot be read: {e}")
+        warnings = validateConfig(config, self.modelExists)
+        return ConfigSnapshot.build(config, version, warnings)
+
+    def _report(self, snapshot: ConfigSnapshot) -> None:
+        for warning in snapshot.warnings:
+            print(f"Participant config warning: {warning}")
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Reload the config if its file has changed, checking no more than once
+        per checkInterval. A config which cannot be read or is invalid is
+        reported, and the current one kept until the file changes again
+
+        Args:
+            force: Check now, whenever the last check was
+
+        Returns: True if a new config was loaded
+        """
+        now = time.monotonic()
+        if not force and now - self._lastCheck < self.checkInterval:
+            return False
+        with self._lock:
+            self._lastCheck = now
+            key = self._stat()
+            if key == self._key:
+                return False
+            self._key = key
+            try:
+                snapshot = self._load(self._snapshot.version + 1)
+            except ConfigError as e:
+                self.failures += 1
+                print(f"{e}\nKeeping version {self._snapshot.version} of "
+                      "the participant config")
+                return False
+            if snapshot.etag == self._snapshot.etag:
+                return False
+            self._report(snapshot)
+            self._snapshot = snapshot
+            self.reloads += 1
+            print(f"Loaded version {snapshot.version} of the participant "
+                  "config")
+        return True
+
+    def current(self) -> ConfigSnapshot:
+        """
+        Return the current snapshot, reloading the config first if it has
+        changed
+        """
+        self.refresh()
+        return self._snapshot
+
+    @property
+    def config(self) -> dict:
+        """
+        The current config. Callers must not modify it
+        """
+        return self.current().config
+
+    def stats(self) -> dict:
+        """
+        Return the config's version, and counts of reloads and of changes
+        which were rejected
+        """
+        return {
+            "version": self._snapshot.version,
+            "reloads": self.reloads,
+            "failures": self.failures
+        }
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else f"config/{CONFIG_FILENAME}"
+    models = sys.argv[2] if len(sys.argv) > 2 else "../frontend/dist/3dmodels"
+    try:
+        snapshot = ParticipantConfig(
+            path, lambda filename: os.path.isfile(os.path.join(models,
+                                                               filename))
+        ).current()
+    except ConfigError as e:
+        print(e)
+        sys.exit(1)
+    print(f"{len(snapshot.config)} participants, {len(snapshot.warnings)} "
+          "warnings")
@@ -0,0 +1,242 @@
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterator, IO
+from metrics import REGISTRY
+
+if os.name == "posix":
+    import fcntl
+else:
+    import msvcrt
+
+WRITE_SECONDS = REGISTRY.histogram(
+    "survey3d_file_write_seconds",
+    "Time taken by file writes, by the function performing them",
+    ("operation",)
+)
+COMPUTE_SECONDS = REGISTRY.histogram(
+    "survey3d_compute_seconds",
+    "Time taken by geometry parsing, indexing, queries and measurements "
+    "off the event loop, by the function performing them",
+    ("operation",)
+)
+
+def _fsyncDirectory(path: str) -> None:
+    """
+    Flush a directory entry to disk so that a rename within it is durable.
+    Directories cannot be opened for syncing on Windows, where the rename
+    itself is the best that can be done.
+    """
+    if os.name != "posix":
+        return
+    fd = os.open(path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+@contextmanager
+def atomicOpen(path: str, mode: str = 'w') -> Iterator[IO]:
+    """
+    Open a temporary file next to the given path for writing. When the block
+    exits cleanly the file is flushed, fsynced and renamed over the path, so
+    readers see either the old file or the complete new one, never a partial
+    write. If the block raises, the temporary file is removed.
+
+    Args:
+        path: The path of the file to be written
+        mode: The mode to open the temporary file with, 'w' or 'wb'
+    """
+    directory = os.path.dirname(path)
+    tmpPath = f"{path}.{os.getpid()}.{time.monotonic_ns()}.tmp"
+    try:
+        with open(tmpPath, mode) as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmpPath, path)
+    except BaseException:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
+    _fsyncDirectory(directory)
+
+@contextmanager
+def processLock(path: str) -> Iterator[None]:
+    """
+    Hold an exclusive lock on a lock file for the block, so that of several
+    server processes writing the same files only one at a time does. This
+    does not exclude the threads of one process, which need their own lock
+
+    Args:
+        path: The path of the lock file, created if missing
+    """
+    with open(path, 'a+b') as file:
+        if os.name == "posix":
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        else:
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if os.name == "posix":
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+            else:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+def fileStamp(path: str) -> tuple[int, int] | None:
+    """
+    Return a file's modification time and size, which change whenever it
+    is replaced, or None if there is no such file
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+class LatencyStats():
+    """
+    Running statistics of operation latencies, keeping a bounded window of
+    recent samples for percentiles
+    """
+    def __init__(self, window: int = 1000):
+        self.count = 0
+        self.errors = 0
+        self.totalSeconds = 0.0
+        self.maxSeconds = 0.0
+        self._recent = deque(maxlen = window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, error: bool = False) -> None:
+        """
+        Add one operation's latency to the statistics
+        """
+        with self._lock:
+            self.count += 1
+            self.errors += error
+            self.totalSeconds += seconds
+            self.maxSeconds = max(self.maxSeconds, seconds)
+            self._recent.append(seconds)
+
+    def percentile(self, fraction: float) -> float:
+        """
+        Return the given percentile, as a fraction, of the recent latencies
+        """
+        with self._lock:
+            ordered = sorted(self._recent)
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def toDict(self) -> dict:
+        """
+        Return the statistics as a dictionary, with latencies in milliseconds
+        """
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "meanMs": (1000 * self.totalSeconds / self.count 
+                       if self.count else 0.0),
+            "p50Ms": 1000 * self.percentile(0.5),
+            "p99Ms": 1000 * self.percentile(0.99),
+            "maxMs": 1000 * self.maxSeconds
+        }
+
+class TimedExecutor():
+    """
+    Runs blocking functions on a dedicated thread pool, so that they never 
+    stall the event loop, and records how long each takes
+    """
+    histogram = None
+    threadName = "executor"
+
+    def __init__(self, workers: int = 2):
+        """
+        Class initialization function
+
+        Args:
+            workers: The number of threads
+        """
+        self._executor = ThreadPoolExecutor(
+            max_workers = workers,
+            thread_name_prefix = self.threadName
+        )
+        self.latency = LatencyStats()
+
+    def _timed(self, function: Callable, *args) -> Any:
+        start = time.perf_counter()
+        try:
+            result = function(*args)
+        except BaseException:
+            self.latency.record(time.perf_counter() - start, error = True)
+            raise
+        finally:
+            self.histogram.observe(time.perf_counter() - start, 
+                                   function.__qualname__)
+        self.latency.record(time.perf_counter() - start)
+        return result
+
+    async def run(self, function: Callable, *args) -> Any:
+        """
+        Run a blocking function on the pool's threads and wait for it to
+        finish, without blocking the event loop
+
+        Args:
+            function: The function to be run
+            args: Arguments for the function
+
+        Returns: The function's return value
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor,
+            self._timed,
+            function,
+            *args
+        )
+
+    def stats(self) -> dict:
+        """
+        Return latency statistics
+        """
+        return self.latency.toDict()
+
+    def shutdown(self) -> None:
+        """
+        Wait for pending work to finish and stop the pool's threads
+        """
+        self._executor.shutdown(wait = True)
+
+class PersistenceWriter(TimedExecutor):
+    """
+    Runs blocking file writes, so that saving a large survey or mesh never
+    stalls the event loop. Only writes are run here, so that reads and 
+    computation never queue ahead of a survey being made durable
+    """
+    histogram = WRITE_SECONDS
+    threadName = "persistence"
+
+class ComputePool(TimedExecutor):
+    """
+    Runs CPU-bound and read-only work, such as parsing models, building and
+    querying spatial indexes and measuring fields, apart from the 
+    persistence writer
+    """
+    histogram = COMPUTE_SECONDS
+    threadName = "compute"
+
+    def __init__(self, workers: int | None = None):
+        """
+        Class initialization function
+
+        Args:
+            workers: The number of threads, by default one per CPU up to 4
+        """
+        super().__init__(workers or min(4, os.cpu_count() or 1))
@@ -0,0 +1,531 @@
+"""
+Stores of the in-progress surveys' sessions, which the survey manager keeps
+its sessions in so they outlive the server process, and, with a shared
+store, so that several server processes (uvicorn --workers N) can serve the
+same sessions.
+
+A store hands out a journal for each session, to which the session's
+updates are recorded as in journal.SurveyJournal, and gives back the
+records of a session as SurveyJournal.read does: a snapshot followed by the
+patches made since. Two stores are provided:
+
+    LocalSessionStore   a journal file per session, in one process only; the
+                        default
+    SqliteSessionStore  an SQLite database in WAL mode, shared by any number
+                        of processes on the machine
+
+In the shared store every write is conditional on the version the writing
+process last saw, so of two processes editing one session only the first
+succeeds; the other is told through SessionConflict, catches up and, like a
+client whose patch was made against an old version, has its client resync.
+Each process polls the database's data_version, which changes whenever
+another process commits, and catches up on the sessions which changed, so
+its experimenter clients are pushed changes made through other processes.
+A write waits up to the busy timeout for another process's to finish, so the
+survey manager makes the shared store's writes on its persistence writer and
+its reads on its compute pool, never on the event loop.
+
+Set SURVEY3D_SESSION_STORE to choose the store, see openSessionStore.
+Running this module lists the sessions in a store:
+
+    python sessionstore.py ../data/sessions.sqlite3
+"""
+import os
+import sys
+import sqlite3
+import threading
+from journal import SurveyJournal, EXTENSION as JOURNAL_EXTENSION
+from codec import encode, decode
+
+SESSION_STORE = "sessions.sqlite3"
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    snapshotVersion INTEGER NOT NULL,
+    survey BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS patches (
+    session TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    ops BLOB NOT NULL,
+    PRIMARY KEY (session, version)
+) WITHOUT ROWID;
+"""
+
+class SessionConflict(Exception):
+    """
+    Raised when a session's update cannot be recorded because another
+    process changed the session first
+    """
+
+class LocalSessionStore():
+    """
+    Keeps each session in a journal file in a folder, for a single server
+    process
+    """
+    shared = False
+    pollInterval = None
+
+    def __init__(self, path: str):
+        """
+        Class initialization function
+
+        Args:
+            path: The journal folder, created if missing
+        """
+        self.path = path
+        os.makedirs(path, exist_ok = True)
+
+    def journalFor(self, filename: str) -> SurveyJournal:
+        """
+        Return the journal of the survey saved under the given filename
+        """
+        stem = filename[:-len(".json")]
+        return SurveyJournal(os.path.join(self.path,
+                                          stem + JOURNAL_EXTENSION))
+
+    def restore(self) -> list[tuple[list[dict], SurveyJournal]]:
+        """
+        Read the journals left in the folder, as after a crash or reload,
+        oldest first
+
+        Returns: The records and the journal of each session, see
+            SurveyJournal.read
+        """
+        paths = sorted(
+            (os.path.join(self.path, filename)
+             for filename in os.listdir(self.path)
+             if filename.endswith(JOURNAL_EXTENSION)),
+            key = os.path.getmtime
+        )
+        sessions = []
+        for path in paths:
+            try:
+                records = SurveyJournal.read(path)
+            except OSError as e:
+                print(f"Could not read journal {path}: {e}")
+                continue
+            if not records:
+                print(f"Journal {path} holds no snapshot")
+                continue
+            sessions.append((records, SurveyJournal(path)))
+        return sessions
+
+    def load(self, sessionId: str) -> None:
+        """
+        Read a session another process started. No other process shares
+        this store, so there is none
+        """
+        return None
+
+    def create(self, sessionId: str, survey) -> SurveyJournal | None:
+        """
+        Record a new session's survey at version 0
+
+        Args:
+            sessionId: The session's id, its participant
+            survey: The Survey
+
+        Returns: The session's journal. The manager checks that it holds no
+            session with the id, which for this store is enough
+        """
+        journal = self.journalFor(survey.filename)
+        journal.checkpoint(survey, 0)
+        return journal
+
+    def catchUp(self, sessionId: str, journal: SurveyJournal,
+                version: int | None) -> list[dict] | None:
+        """
+        Return the records of a session's changes which the process has not
+        applied. Only this process changes its sessions, so there are none
+        """
+        return []
+
+    def end(self, sessionId: str, journal: SurveyJournal) -> bool:
+        """
+        Remove a session once its survey has been saved
+
+        Returns: True if this process ended the session
+        """
+        journal.delete()
+        return True
+
+    def changes(self) -> dict[str, int] | None:
+        """
+        Return the version of every session if another process may have
+        changed any, otherwise None
+        """
+        return None
+
+    def stats(self) -> dict:
+        return {}
+
+    def close(self) -> None:
+        pass
+
+class SqliteJournal():
+    """
+    The journal of one session in a SqliteSessionStore, with the interface
+    of journal.SurveyJournal. It remembers the version of the session the
+    process last saw in the store, and its writes only succeed if the store
+    still holds that version. Its writes may wait for other processes', so
+    are never made on the event loop
+    """
+    shared = True
+
+    def __init__(self, store: "SqliteSessionStore", sessionId: str,
+                 filename: str, version: int, snapshotVersion: int,
+                 checkpointInterval: int = 500):
+        """
+        Class initialization function
+
+        Args:
+            store: The store holding the session
+            sessionId: The session's id
+            filename: The filename of the session's survey
+            version: The session's version in the store
+            snapshotVersion: The version of the store's snapshot
+            checkpointInterval: The number of patches after which the
+            session should be compacted into a snapshot
+        """
+        self.store = store
+        self.sessionId = sessionId
+        self.filename = filename
+        self.version = version
+        self.snapshotVersion = snapshotVersion
+        self.checkpointInterval = checkpointInterval
+
+    @property
+    def needsCheckpoint(self) -> bool:
+        return self.version - self.snapshotVersion >= self.checkpointInterval
+
+    def checkpoint(self, survey, version: int) -> None:
+        """
+        Replace the session's snapshot and patches with a snapshot of the
+        survey
+
+        Raises: SessionConflict if another process changed the session
+        """
+        self.store._write(
+            self,
+            ("UPDATE sessions SET version = ?, snapshotVersion = ?, "
+             "survey = ? WHERE id = ? AND version = ?",
+             (version, version, encode(survey), self.sessionId,
+              self.version)),
+            ("DELETE FROM patches WHERE session = ? AND version <= ?",
+             (self.sessionId, version))
+        )
+        self.version = self.snapshotVersion = version
+
+    def appendPatch(self, version: int, ops: list[dict]) -> None:
+        """
+        Record a patch made against the version the process last saw
+
+        Raises: SessionConflict if another process changed the session
+        """
+        self.store._write(
+            self,
+            ("UPDATE sessions SET version = ? "
+             "WHERE id = ? AND version = ?",
+             (version, self.sessionId, self.version)),
+            ("INSERT INTO patches (session, version, ops) "
+             "VALUES (?, ?, ?)", (self.sessionId, version, encode(ops)))
+        )
+        self.version = version
+
+    def close(self) -> None:
+        pass
+
+class SqliteSessionStore():
+    """
+    Keeps the sessions in an SQLite database in WAL mode, which any number
+    of server processes on the machine may share, see the module's
+    description
+    """
+    shared = True
+
+    def __init__(self, path: str, pollInterval: float = 0.05,
+                 busyTimeout: float = 5.0):
+        """
+        Class initialization function
+
+        Args:
+            path: The database file, created if missing
+            pollInterval: The seconds between checks for changes made by
+            other processes
+            busyTimeout: The seconds a write waits for another process's
+            write to finish
+        """
+        self.path = path
+        self.pollInterval = pollInterval
+        self.conflicts = 0
+        self.catchUps = 0
+        self._dataVersion = None
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, timeout = busyTimeout, isolation_level = None,
+            check_same_thread = False
+        )
+        with self._lock:
+            connection = self._connection
+            connection.execute("PRAGMA journal_mode = WAL")
+            # Commits reach the operating system before they return, as the
+            # journal files' appends do, and the disk at checkpoints
+            connection.execute("PRAGMA synchronous = NORMAL")
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version not in (0, SCHEMA_VERSION):
+                raise ValueError(
+                    f"Session store {path} has schema version {version}"
+                )
+            connection.executescript(SCHEMA)
+            connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _write(self, journal: SqliteJournal,
+               *statements: tuple[str, tuple]) -> None:
+        """
+        Run statements in one write transaction, the first of which must
+        change the session's row, or else nothing is written
+
+        Raises: SessionConflict if the first statement changed no row
+        """
+        with self._lock:
+            connection = self._connection
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                for i, (sql, parameters) in enumerate(statements):
+                    cursor = connection.execute(sql, parameters)
+                    if i == 0 and cursor.rowcount != 1:
+                        connection.execute("ROLLBACK")
+                        self.conflicts += 1
+                        raise SessionConflict(
+                            f"Session {journal.sessionId} has changed since "
+                            f"version {journal.version}"
+                        )
+                connection.execute("COMMIT")
+            except sqlite3.Error:
+                connection.execute("ROLLBACK")
+                raise
+
+    def _read(self, sessionId: str, since: int | None
+              ) -> tuple[tuple, list[dict]] | None:
+        """
+        Read a session's row, and its records from its snapshot onwards or,
+        if it has not been compacted since the given version, only its
+        patches after that version. Called holding the lock
+
+        Returns: The row's filename, version and snapshotVersion, and the
+            records, or None if the store holds no such session
+        """
+        connection = self._connection
+        connection.execute("BEGIN")
+        try:
+            row = connection.execute(
+                "SELECT filename, version, snapshotVersion FROM sessions "
+                "WHERE id = ?", (sessionId,)
+            ).fetchone()
+            if row is None:
+                return None
+            _, version, snapshotVersion = row
+            records = []
+            if since is None or since < snapshotVersion or since > version:
+                survey = connection.execute(
+                    "SELECT survey FROM sessions WHERE id = ?", (sessionId,)
+                ).fetchone()[0]
+                records.append({"type": "snapshot",
+                                "version": snapshotVersion,
+                                "survey": decode(survey)})
+                since = snapshotVersion
+            for patchVersion, ops in connection.execute(
+                "SELECT version, ops FROM patches WHERE session = ? AND "
+                "version > ? ORDER BY version", (sessionId, since)
+            ):
+                records.append({"type": "patch", "version": patchVersion,
+                                "ops": decode(ops)})
+            return row, records
+        finally:
+            connection.execute("COMMIT")
+
+    def load(self, sessionId: str
+             ) -> tuple[list[dict], SqliteJournal] | None:
+        """
+        Read a session
+
+        Returns: The session's records and journal, or None if the store
+            holds no such session
+        """
+        with self._lock:
+            result = self._read(sessionId, None)
+        if result is None:
+            return None
+        (filename, version, snapshotVersion), records = result
+        return records, SqliteJournal(self, sessionId, filename, version,
+                                      snapshotVersion)
+
+    def restore(self) -> list[tuple[list[dict], SqliteJournal]]:
+        """
+        Read every session in the store
+
+        Returns: The records and the journal of each session
+        """
+        with self._lock:
+            sessionIds = [row[0] for row in self._connection.execute(
+                "SELECT id FROM sessions"
+            )]
+        sessions = []
+        for sessionId in sessionIds:
+            loaded = self.load(sessionId)
+            if loaded is not None:
+                sessions.append(loaded)
+        return sessions
+
+    def create(self, sessionId: str, survey) -> SqliteJournal | None:
+        """
+        Record a new session's survey at version 0, unless another process
+        already holds a session with that id
+
+        Returns: The session's journal, or None if the store already holds
+            a session with that id
+        """
+        with self._lock:
+            try:
+                self._connection.execute(
+                    "INSERT INTO sessions (id, filename, version, "
+                    "snapshotVersion, survey) VALUES (?, ?, 0, 0, ?)",
+                    (sessionId, survey.filename, encode(survey))
+                )
+            except sqlite3.IntegrityError:
+                return None
+        return SqliteJournal(self, sessionId, survey.filename, 0, 0)
+
+    def catchUp(self, sessionId: str, journal: SqliteJournal,
+                version: int | None) -> list[dict] | None:
+        """
+        Return the records of a session's changes which the process has not
+        applied, made through other processes
+
+        Args:
+            sessionId: The session's id
+            journal: The session's journal
+            version: The version of the process's copy of the session, or
+            None to read the whole session
+
+        Returns: An empty list if the copy is current; the patches to be
+            applied to it; or a snapshot and the patches after it, which
+            replace it. None if the session has ended, or been replaced by
+            another survey for the same participant
+        """
+        with self._lock:
+            if (version is not None and version == journal.version
+                    and self._connection.execute(
+                        "SELECT version FROM sessions WHERE id = ?",
+                        (sessionId,)
+                    ).fetchone() == (version,)):
+                return []
+            # A copy the journal has not recorded, as after a patch which
+            # failed part way, is read afresh
+            if version != journal.version:
+                version = None
+            result = self._read(sessionId, version)
+        if result is None:
+            return None
+        (filename, journal.version, journal.snapshotVersion), records = result
+        if filename != journal.filename:
+            return None
+        self.catchUps += 1
+        return records
+
+    def end(self, sessionId: str, journal: SqliteJournal) -> bool:
+        """
+        Remove a session once its survey has been saved
+
+        Returns: True if this process ended the session, False if another
+            process already had
+        """
+        with self._lock:
+            connection = self._connection
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                ended = connection.execute(
+                    "DELETE FROM sessions WHERE id = ? AND filename = ?",
+                    (sessionId, journal.filename)
+                ).rowcount == 1
+                if ended:
+                    connection.execute(
+                        "DELETE FROM patches WHERE session = ?",
+                        (sessionId,)
+                    )
+                connection.execute("COMMIT")
+            except sqlite3.Error:
+                connection.execute("ROLLBACK")
+                raise
+        return ended
+
+    def changes(self) -> dict[str, int] | None:
+        """
+        Return the version of every session if another process has
+        committed since the last call, otherwise None. This costs a single
+        PRAGMA while nothing changes
+        """
+        with self._lock:
+            dataVersion = self._connection.execute(
+                "PRAGMA data_version"
+            ).fetchone()[0]
+            if dataVersion == self._dataVersion:
+                return None
+            self._dataVersion = dataVersion
+            return dict(self._connection.execute(
+                "SELECT id, version FROM sessions"
+            ).fetchall())
+
+    def stats(self) -> dict:
+        """
+        Return the numbers of writes refused because another process changed
+        the session first, and of catch-ups on other processes' changes
+        """
+        return {"conflicts": self.conflicts, "catchUps": self.catchUps}
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+def openSessionStore(spec: str | None, dataPath: str):
+    """
+    Open the session store named by a SURVEY3D_SESSION_STORE value:
+
+        (unset), "local"    journal files in <dataPath>/journal
+        "sqlite"            <dataPath>/sessions.sqlite3
+        "sqlite:<path>"     the SQLite database at the given path
+
+    Args:
+        spec: The store's name
+        dataPath: The data folder
+
+    Returns: The LocalSessionStore or SqliteSessionStore
+
+    Raises: ValueError if the store is unknown
+    """
+    if not spec or spec == "local":
+        return LocalSessionStore(os.path.join(dataPath, "journal"))
+    kind, _, path = spec.partition(":")
+    if kind == "sqlite":
+        return SqliteSessionStore(path or os.path.join(dataPath,
+                                                       SESSION_STORE))
+    raise ValueError(f"Unknown session store {spec}; expected local, "
+                     "sqlite or sqlite:<path>")
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python sessionstore.py <sessions.sqlite3>")
+        sys.exit(1)
+    store = SqliteSessionStore(sys.argv[1])
+    sessions = store.restore()
+    for records, journal in sessions:
+        print(f"{journal.sessionId}: {journal.filename} at version "
+              f"{journal.version}, {len(records) - 1} patches since its "
+              "snapshot")
+    print(f"{len(sessions)} sessions in progress")
+    store.close()
@@ -0,0 +1,267 @@
+"""
+Spatial indexes of the meshes in the mesh store, for finding the vertices
+and faces nearest to points given in a mesh's coordinates, such as hotspots
+and landmarks, in logarithmic rather than linear time.
+
+Each mesh's index is a pair of KD-trees, one over its distinct vertex
+positions and one over its faces' centroids, built from the mesh's tables
+(see geometry.MeshTables) the first time the mesh is queried, and kept in
+memory for the most recently used meshes. The nearest vertex is one query
+of the vertex tree. The nearest face is exact: the face nearest a point is
+no further from it than the nearest vertex, so its centroid is within that
+distance plus the largest distance from a face's centroid to its corners,
+and only the faces whose centroids the face tree finds within that radius
+are measured. That is a handful of faces for points on or near the mesh,
+as hotspots and landmarks are; points far from the mesh, relative to its
+size, have more.
+
+Hotspots are snapped as their surveys are saved, and landmarks as their
+landmark sets are saved, recording the result as a survey3d.SurfacePoint;
+/nearest answers the same query for any points.
+"""
+import threading
+from collections import OrderedDict
+import numpy as np
+from scipy.spatial import cKDTree
+from geometry import MeshTables, MeshTableCache, fieldMeshHash
+from survey3d import Survey, SurfacePoint, Landmark
+
+def closestPointsOnTriangles(points: np.ndarray, a: np.ndarray,
+                             b: np.ndarray, c: np.ndarray
+                             ) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Find the closest point on each of some triangles to each of some points,
+    pairwise
+
+    Args:
+        points: An (N, 3) array of points
+        a, b, c: (N, 3) arrays of the triangles' corners
+
+    Returns: The squared distances to the closest points, and the closest
+        points' barycentric coordinates as an (N, 3) array
+    """
+    ab = b - a
+    ac = c - a
+    ap = points - a
+    d00 = (ab * ab).sum(axis = 1)
+    d01 = (ab * ac).sum(axis = 1)
+    d11 = (ac * ac).sum(axis = 1)
+    d20 = (ap * ab).sum(axis = 1)
+    d21 = (ap * ac).sum(axis = 1)
+    denominator = d00 * d11 - d01 * d01
+    safe = np.where(denominator > 0, denominator, 1.0)
+    v = (d11 * d20 - d01 * d21) / safe
+    w = (d00 * d21 - d01 * d20) / safe
+    u = 1 - v - w
+    inside = (denominator > 0) & (u >= 0) & (v >= 0) & (w >= 0)
+    weights = np.stack([u, v, w], axis = 1)
+
+    # Points beyond a triangle's edges, or degenerate triangles, are closest
+    # to one of its edges
+    best = np.full(len(points), np.inf)
+    edgeWeights = np.zeros_like(weights)
+    for start, end, first, second in ((a, b, 0, 1), (b, c, 1, 2),
+                                      (c, a, 2, 0)):
+        edge = end - start
+        length = (edge * edge).sum(axis = 1)
+        t = np.clip(((points - start) * edge).sum(axis = 1)
+                    / np.where(length > 0, length, 1.0), 0, 1)
+        offset = start + t[:, None] * edge - points
+        distance = (offset * offset).sum(axis = 1)
+        closer = distance < best
+        best[closer] = distance[closer]
+        edgeWeights[closer] = 0
+        edgeWeights[closer, first] = 1 - t[closer]
+        edgeWeights[closer, second] = t[closer]
+
+    weights = np.where(inside[:, None], weights, edgeWeights)
+    closest = (weights[:, 0, None] * a + weights[:, 1, None] * b
+               + weights[:, 2, None] * c)
+    offset = closest - points
+    return (offset * offset).sum(axis = 1), weights
+
+class SpatialIndex():
+    """
+    The KD-trees of one mesh, see the module's description
+    """
+    def __init__(self, tables: MeshTables):
+        """
+        Class initialization function
+
+        Args:
+            tables: The mesh's tables
+        """
+        self.tables = tables
+        self.vertexTree = cKDTree(tables.weldedVertices)
+        # The first of the mesh's vertices at each distinct position
+        _, self.firstVertex = np.unique(tables.weld, return_index = True)
+        corners = tables.vertices[tables.faces]
+        centroids = corners.mean(axis = 1)
+        self.faceTree = cKDTree(centroids)
+        self.faceRadius = float(
+            np.sqrt(((corners - centroids[:, None]) ** 2).sum(axis = 2)).max()
+        ) if len(corners) else 0.0
+
+    def nearestVertices(self, points: np.ndarray
+                        ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find the vertex nearest to each of some points
+
+        Args:
+            points: An (N, 3) array of points
+
+        Returns: The indices of the nearest vertices, as the frontend indexes
+            them, and their distances from the points
+        """
+        distances, welded = self.vertexTree.query(points)
+        return self.firstVertex[welded], distances
+
+    def nearestFaces(self, points: np.ndarray, vertexDistances: np.ndarray
+                     ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Find the face nearest to each of some points
+
+        Args:
+            points: An (N, 3) array of points
+            vertexDistances: The distance from each point to its nearest
+            vertex, which bounds the search
+
+        Returns: The indices of the nearest faces, the distances from the
+            points to them, and the barycentric coordinates of the faces'
+            nearest points as an (N, 3) array
+        """
+        candidates = self.faceTree.query_ball_point(
+            points, vertexDistances * (1 + 1e-9) + self.faceRadius
+        )
+        counts = np.array([len(faces) for faces in candidates],
+                          dtype = np.int64)
+        owners = np.repeat(np.arange(len(points)), counts)
+        faces = np.fromiter((face for faces in candidates for face in faces),
+                            dtype = np.int64, count = int(counts.sum()))
+        corners = self.tables.vertices[self.tables.faces[faces]]
+        distances, weights = closestPointsOnTriangles(
+            points[owners], corners[:, 0], corners[:, 1], corners[:, 2]
+        )
+        # The nearest candidate of each point comes first once sorted by
+        # point and then distance
+        order = np.lexsort((distances, owners))
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        chosen = order[starts]
+        return (faces[chosen], np.sqrt(distances[chosen]), weights[chosen])
+
+    def query(self, points) -> dict:
+        """
+        Find the vertex and face nearest to each of some points
+
+        Args:
+            points: An (N, 3) array-like of points
+
+        Returns: A dictionary of lists, "vertices", "faces", "distances" and
+            "barycentric", with one entry per point
+        """
+        points = np.asarray(points, dtype = np.float64).reshape(-1, 3)
+        if not len(points):
+            return {"vertices": [], "faces": [], "distances": [],
+                    "barycentric": []}
+        if not np.isfinite(points).all():
+            raise ValueError("Points must be finite")
+        vertices, vertexDistances = self.nearestVertices(points)
+        faces, distances, weights = self.nearestFaces(points,
+                                                      vertexDistances)
+        return {
+            "vertices": vertices.tolist(),
+            "faces": faces.tolist(),
+            "distances": distances.tolist(),
+            "barycentric": weights.tolist()
+        }
+
+    def snap(self, points) -> list[SurfacePoint]:
+        """
+        Return the SurfacePoint of each of some points
+        """
+        result = self.query(points)
+        return [
+            SurfacePoint(vertex, face, distance, weights)
+            for vertex, face, distance, weights in zip(
+                result["vertices"], result["faces"], result["distances"],
+                result["barycentric"]
+            )
+        ]
+
+class SpatialIndexCache():
+    """
+    The spatial indexes of the meshes in a mesh store, built from the meshes'
+    tables and kept in memory for the most recently used meshes. Safe to
+    call from the compute pool's threads
+    """
+    def __init__(self, meshTables: MeshTableCache, capacity: int = 8):
+        """
+        Class initialization function
+
+        Args:
+            meshTables: The cache of the meshes' tables
+            capacity: The number of meshes whose indexes are kept in memory
+        """
+        self.meshTables = meshTables
+        self.capacity = capacity
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, meshHash: str) -> SpatialIndex | None:
+        """
+        Return the index of the mesh with the given hash, or None if the
+        store does not hold it
+        """
+        with self._lock:
+            index = self._indexes.get(meshHash)
+            if index is not None:
+                self._indexes.move_to_end(meshHash)
+                return index
+        tables = self.meshTables.get(meshHash)
+        if tables is None:
+            return None
+        index = SpatialIndex(tables)
+        with self._lock:
+            self._indexes[meshHash] = index
+            if len(self._indexes) > self.capacity:
+                self._indexes.popitem(last = False)
+        return index
+
+    def snapSurvey(self, survey: Survey) -> int:
+        """
+        Set the hotspot SurfacePoint of every field of a survey which has a
+        hotspot and whose mesh is in the store
+
+        Returns: The number of hotspots snapped
+        """
+        snapped = 0
+        for projectedField in survey.projectedFields:
+            hotSpot = projectedField.hotSpot or {}
+            try:
+                point = [float(hotSpot[axis]) for axis in ("x", "y", "z")]
+            except (KeyError, TypeError, ValueError):
+                continue
+            if not np.isfinite(point).all():
+                continue
+            meshHash = fieldMeshHash(survey, projectedField)
+            index = self.get(meshHash) if meshHash else None
+            if index is None:
+                continue
+            projectedField.hotSpotSnap = index.snap([point])[0]
+            snapped += 1
+        return snapped
+
+    def snapLandmarks(self, meshHash: str, landmarks: list[Landmark]) -> int:
+        """
+        Set the SurfacePoint of each of a landmark set's landmarks
+
+        Returns: The number of landmarks snapped
+        """
+        index = self.get(meshHash)
+        if index is None or not landmarks:
+            return 0
+        snaps = index.snap([[landmark.x, landmark.y, landmark.z]
+                            for landmark in landmarks])
+        for landmark, snap in zip(landmarks, snaps):
+            landmark.snap = snap
+        return len(snaps)
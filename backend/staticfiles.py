@@ -0,0 +1,249 @@
+"""
+Static file serving with precompressed variants and cache validation.
+
+Compressible files get .gz (and, if the brotli package is installed, .br)
+variants written next to them, either when the server starts or by running
+this module:
+
+    python staticfiles.py ../frontend/dist
+"""
+import os
+import re
+import sys
+import gzip
+import hashlib
+import mimetypes
+from stat import S_ISREG
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import StaticFiles, NotModifiedResponse
+from starlette.types import Scope
+from persistence import atomicOpen
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+mimetypes.add_type("model/gltf-binary", ".glb")
+mimetypes.add_type("model/gltf+json", ".gltf")
+
+COMPRESSIBLE_EXTENSIONS = (".gltf", ".glb", ".bin", ".obj", ".js", ".mjs",
+                           ".css", ".html", ".json", ".svg", ".map", ".txt")
+# Encodings in order of preference, with the suffix of their variant files
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+MINIMUM_SIZE = 1024
+# Variants which save less than this fraction of the original are not kept
+MINIMUM_SAVING = 0.1
+# Vite names built assets like index-B3xk9_aQ.js
+HASHED_NAME = re.compile(r"-[A-Za-z0-9_-]{8,}\.[A-Za-z0-9]+$")
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+
+def compressVariant(path: str, encoding: str) -> bytes:
+    """
+    Compress a file's contents with the given encoding, 'br' or 'gzip'
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    if encoding == "br":
+        return brotli.compress(data, quality = 11)
+    return gzip.compress(data, compresslevel = 9, mtime = 0)
+
+def precompressFile(path: str) -> int:
+    """
+    Write the compressed variants of a file which are missing or older than
+    the file itself
+
+    Args:
+        path: The path of the file
+
+    Returns: The number of variants written
+    """
+    if (not path.endswith(COMPRESSIBLE_EXTENSIONS)
+            or os.path.getsize(path) < MINIMUM_SIZE):
+        return 0
+    written = 0
+    for encoding, suffix in ENCODINGS:
+        if encoding == "br" and brotli is None:
+            continue
+        variant = path + suffix
+        if (os.path.isfile(variant)
+                and os.path.getmtime(variant) >= os.path.getmtime(path)):
+            continue
+        data = compressVariant(path, encoding)
+        if len(data) > (1 - MINIMUM_SAVING) * os.path.getsize(path):
+            continue
+        with atomicOpen(variant, 'wb') as file:
+            file.write(data)
+        written += 1
+    return written
+
+def precompressFolder(path: str) -> int:
+    """
+    Write the missing compressed variants of every file in a folder and its
+    subfolders
+
+    Args:
+        path: The folder to compress, usually the frontend build folder
+
+    Returns: The number of variants written
+    """
+    written = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            try:
+                written += precompressFile(os.path.join(root, file))
+            except OSError as e:
+                print(f"Could not compress {os.path.join(root, file)}: {e}")
+    return written
+
+def hashFile(path: str) -> str:
+    """
+    Return the SHA-256 of a file's contents as hex
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def acceptedEncodings(acceptEncoding: str) -> set[str]:
+    """
+    Return the content codings a client accepts, from its Accept-Encoding
+    header
+    """
+    accepted = set()
+    for part in acceptEncoding.split(","):
+        coding, *params = part.split(";")
+        quality = 1.0
+        for param in params:
+            name, _, value = param.replace(" ", "").partition("=")
+            if name.lower() != "q":
+                continue
+            # A malformed weight is ignored rather than failing the request
+            try:
+                quality = float(value)
+            except ValueError:
+                pass
+        if quality == 0:
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+class CompressedStaticFiles(StaticFiles):
+    """
+    StaticFiles which serves precompressed variants of files to clients that
+    accept them, with strong ETags taken from file contents, so a client
+    revalidating an unchanged file is answered with an empty 304. Files
+    whose names carry a build hash are marked immutable, and every other
+    file must be revalidated before reuse. Range requests are answered from
+    the uncompressed file.
+    """
+    def __init__(self, *args, precompress: bool = True,
+                 immutableHashed: bool = True, **kwargs):
+        """
+        Class initialization function
+
+        Args:
+            precompress: Whether to write missing compressed variants now
+            immutableHashed: Whether files with build hashes in their names
+            may be cached forever
+            Other arguments are passed on to StaticFiles
+        """
+        super().__init__(*args, **kwargs)
+        self.immutableHashed = immutableHashed
+        self._etags = {}
+        if precompress and self.directory is not None:
+            precompressFolder(str(self.directory))
+        if self.directory is not None:
+            self.hashFolder(str(self.directory))
+
+    def hashFolder(self, folder: str) -> None:
+        """
+        Compute the ETags of every file in a folder ahead of serving them
+        """
+        suffixes = tuple(suffix for _, suffix in ENCODINGS)
+        for root, _, files in os.walk(folder):
+            for file in files:
+                if file.endswith(suffixes):
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    self.lookup_path(os.path.relpath(path, folder))
+                except OSError as e:
+                    print(f"Could not hash {path}: {e}")
+
+    def lookup_path(self, path: str) -> tuple[str, os.stat_result | None]:
+        """
+        Find a requested file, as StaticFiles does, and bring its ETag up to
+        date. StaticFiles looks files up on a worker thread, so a file 
+        changed since it was hashed is hashed again there, rather than on
+        the event loop as it is served
+        """
+        full_path, stat_result = super().lookup_path(path)
+        if stat_result is not None and S_ISREG(stat_result.st_mode):
+            self.etag(full_path, stat_result)
+        return full_path, stat_result
+
+    def etag(self, path: str, stat: os.stat_result) -> str:
+        """
+        Return the strong ETag of a file's contents, cached until the file
+        changes
+        """
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self._etags.get(path)
+        if cached is None or cached[0] != key:
+            cached = (key, hashFile(path)[:32])
+            self._etags[path] = cached
+        return cached[1]
+
+    def file_response(self, full_path, stat_result: os.stat_result,
+                      scope: Scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope = scope)
+        path = str(full_path)
+        etag = self.etag(path, stat_result)
+        headers = {"vary": "Accept-Encoding"}
+        if self.immutableHashed and HASHED_NAME.search(path):
+            headers["cache-control"] = IMMUTABLE_CACHE
+        else:
+            headers["cache-control"] = REVALIDATE_CACHE
+
+        servedPath, servedStat = path, stat_result
+        headers["etag"] = f'"{etag}"'
+        if "range" not in request_headers:
+            accepted = acceptedEncodings(
+                request_headers.get("accept-encoding", "")
+            )
+            for encoding, suffix in ENCODINGS:
+                if encoding not in accepted:
+                    continue
+                try:
+                    variantStat = os.stat(path + suffix)
+                except OSError:
+                    continue
+                if variantStat.st_mtime < stat_result.st_mtime:
+                    continue
+                servedPath, servedStat = path + suffix, variantStat
+                headers["content-encoding"] = encoding
+                # Each representation needs its own strong ETag
+                headers["etag"] = f'"{etag}-{encoding}"'
+                break
+
+        response = FileResponse(
+            servedPath,
+            status_code = status_code,
+            headers = headers,
+            media_type = (mimetypes.guess_type(path)[0] 
+                          or "application/octet-stream"),
+            stat_result = servedStat
+        )
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+if __name__ == "__main__":
+    folder = sys.argv[1] if len(sys.argv) > 1 else "../frontend/dist/"
+    if brotli is None:
+        print("brotli is not installed; writing gzip variants only")
+    print(f"Wrote {precompressFolder(folder)} compressed variants")
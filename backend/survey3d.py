@@ -1,12 +1,34 @@
 import os
-import json
+import asyncio
+import struct
+import hashlib
 from datetime import datetime
 from dataclasses import dataclass, field
-from typing import Sequence
+from typing import Any, Sequence
 from os import PathLike
 from pathlib import Path
+from meshbin import MeshArrays, writeMeshBinary, loadMeshBinary, EXTENSION
+from persistence import PersistenceWriter, ComputePool, atomicOpen
+from journal import SurveyJournal
+from sessionstore import LocalSessionStore, SessionConflict
+from hub import SurveyHub, DEFAULT_TOPIC
+from gltf import GeometryCache
+from participantconfig import ParticipantConfig, CONFIG_FILENAME
+from vertexset import VertexSet
+from codec import encode, encodePretty, decode, convert
 
-@dataclass
+def isRelativeFilename(filename: str) -> bool:
+    """
+    Return True if a filename, as sent by a client, names a file within 
+    whichever folder it is joined to: it is not empty or absolute on any 
+    platform, and none of its parts is ".."
+    """
+    parts = filename.replace("\\", "/").split("/")
+    return (bool(filename) and not os.path.isabs(filename) 
+            and ":" not in filename
+            and ".." not in parts and "" not in parts)
+
+@dataclass(slots = True)
 class Mesh():
     filename: str = "default"
     vertices: list[Sequence[float]] = field(default_factory = list)
@@ -36,6 +58,24 @@ class Mesh():
         self.filename = dict["filename"]
         self.vertices = dict["vertices"]
         self.faces = dict["faces"]
+
+    def contentHash(self) -> str:
+        """
+        Return a hash of the Mesh's geometry, independent of its filename. 
+        The hash is the hex SHA-256 of the vertex and face counts as 
+        little-endian uint32, followed by the vertices as little-endian 
+        float32 and the faces as little-endian int32, which is the layout 
+        the frontend hashes from its geometry buffers.
+
+        Returns: The hex digest of the Mesh's geometry
+        """
+        flatVertices = [c for vertex in self.vertices for c in vertex]
+        flatFaces = [i for face in self.faces for i in face]
+        digest = hashlib.sha256()
+        digest.update(struct.pack("<II", len(self.vertices), len(self.faces)))
+        digest.update(struct.pack(f"<{len(flatVertices)}f", *flatVertices))
+        digest.update(struct.pack(f"<{len(flatFaces)}i", *flatFaces))
+        return digest.hexdigest()
     
     def saveMesh(self, path: str):
         """
@@ -45,20 +85,161 @@ class Mesh():
             path: The folder to which the .json file should be saved
 
         Returns: True if saved, False if not
+
+        Raises: ValueError if the Mesh's filename would lead outside the 
+            folder
         """
+        if not isRelativeFilename(self.filename):
+            raise ValueError(f"Cannot save mesh with filename "
+                             f"{self.filename!r}")
         filename = f"{self.filename}.json"
         fullpath = os.path.join(path, filename)
         if not os.path.isfile(fullpath):
             print(f"Saving mesh data to {filename}...")
-            with open(fullpath, 'w') as file:
-                json.dump(self.toDict(), file, indent = 4)
+            # Models in subfolders of 3dmodels, such as LOD variants, are
+            # saved in the same subfolders
+            os.makedirs(os.path.dirname(fullpath), exist_ok = True)
+            with atomicOpen(fullpath, 'wb') as file:
+                file.write(encodePretty(self))
             return True
         else:
             return False
 
-@dataclass
+    def saveBinary(self, path: str) -> bool:
+        """
+        Save this Mesh to the given path in the binary .s3dmesh format, which
+        can be memory-mapped with meshbin.loadMeshBinary.
+
+        Args:
+            path: The folder to which the .s3dmesh file should be saved
+
+        Returns: True if saved, False if not
+        """
+        filename = f"{self.filename}{EXTENSION}"
+        fullpath = os.path.join(path, filename)
+        if not os.path.isfile(fullpath):
+            print(f"Saving binary mesh data to {filename}...")
+            writeMeshBinary(fullpath, self.filename, self.vertices, self.faces)
+            return True
+        else:
+            return False
+
+class MeshStore():
+    """
+    A content-addressed store of Mesh geometry. Each distinct geometry is 
+    saved once, as <hash>.json in the store's folder, where <hash> is the 
+    Mesh's contentHash, so surveys and landmark sets can refer to meshes by 
+    hash instead of embedding them
+    """
+    path: str
+
+    def __init__(self, path: str):
+        """
+        Class initialization function
+
+        Args:
+            path: The folder in which meshes are stored, created if missing
+        """
+        os.makedirs(path, exist_ok = True)
+        self.path = path
+        self._hashes = {
+            filename[:-len(".json")] for filename in os.listdir(path)
+            if filename.endswith(".json")
+        }
+
+    @staticmethod
+    def isHash(meshHash: str) -> bool:
+        """
+        Return True if the given string is shaped like a Mesh contentHash, 
+        which also guarantees it is safe to use in a path
+        """
+        return (isinstance(meshHash, str) and len(meshHash) == 64
+                and all(c in "0123456789abcdef" for c in meshHash))
+
+    def pathFor(self, meshHash: str, extension: str = ".json") -> str:
+        """
+        Return the path at which the mesh with the given hash is stored, as 
+        JSON or, with extension=meshbin.EXTENSION, in binary
+        """
+        if not self.isHash(meshHash):
+            raise ValueError(f"Not a mesh hash: {meshHash}")
+        return os.path.join(self.path, f"{meshHash}{extension}")
+
+    def has(self, meshHash: str) -> bool:
+        """
+        Return True if the store holds a mesh with the given hash. Hashes
+        not yet seen are looked for on disk, as other server processes 
+        sharing the folder may have stored them since
+        """
+        if meshHash in self._hashes:
+            return True
+        if not self.isHash(meshHash) or not os.path.isfile(
+                self.pathFor(meshHash)):
+            return False
+        self._hashes.add(meshHash)
+        return True
+
+    def missing(self, hashes: dict[str, str]) -> list[str]:
+        """
+        Take a dictionary of mesh filenames to hashes and return the 
+        filenames whose hashes the store does not hold
+
+        Args:
+            hashes: a dictionary of mesh filenames to content hashes
+
+        Returns: The filenames whose meshes must be uploaded
+        """
+        return [
+            filename for filename, meshHash in hashes.items()
+            if not self.has(meshHash)
+        ]
+
+    def put(self, mesh: Mesh, expectedHash: str | None = None) -> str:
+        """
+        Save a Mesh to the store if its geometry is not already held
+
+        Args:
+            mesh: The Mesh to be stored
+            expectedHash: If given, the hash the sender computed, which must
+            match the hash of the received geometry
+
+        Returns: The content hash of the Mesh
+        """
+        meshHash = mesh.contentHash()
+        if expectedHash is not None and expectedHash != meshHash:
+            raise ValueError(f"Mesh {mesh.filename} does not match its hash")
+        if not self.has(meshHash):
+            print(f"Storing mesh data for {mesh.filename} as {meshHash}...")
+            with atomicOpen(self.pathFor(meshHash), 'wb') as file:
+                file.write(encode(mesh))
+            writeMeshBinary(self.pathFor(meshHash, EXTENSION), mesh.filename,
+                            mesh.vertices, mesh.faces)
+            self._hashes.add(meshHash)
+        return meshHash
+
+    def load(self, meshHash: str) -> Mesh:
+        """
+        Load the Mesh with the given hash from the store
+        """
+        with open(self.pathFor(meshHash), 'rb') as file:
+            return decode(file.read(), Mesh)
+
+    def loadArrays(self, meshHash: str) -> MeshArrays:
+        """
+        Map the geometry of the mesh with the given hash into numpy arrays 
+        without parsing it, converting the stored JSON to binary first if 
+        the binary copy is missing
+        """
+        binaryPath = self.pathFor(meshHash, EXTENSION)
+        if not os.path.isfile(binaryPath):
+            mesh = self.load(meshHash)
+            writeMeshBinary(binaryPath, mesh.filename, mesh.vertices, 
+                            mesh.faces)
+        return loadMeshBinary(binaryPath)
+
+@dataclass(slots = True)
 class Quality():
-    intensity: float = -1.0
+    intensity: float | None = -1.0
     depth: list[str] = field(default_factory = list)
     type: str = ""
     
@@ -87,16 +268,108 @@ class Quality():
         self.depth = dictionary["depth"]
         self.type = dictionary["type"]
 
-@dataclass
+@dataclass(slots = True)
+class SurfacePoint():
+    """
+    Where a point given in a mesh's coordinates, such as a hotspot or a
+    landmark, lies on the mesh, found by the server when the point is saved,
+    see spatial.SpatialIndex. The vertex is indexed as the frontend indexes
+    the mesh's vertices, every face having its own three
+    """
+    vertex: int = -1
+    face: int = -1
+    # The distance from the point to the nearest face
+    distance: float = 0.0
+    # The weights of the face's corners at the face's nearest point
+    barycentric: list[float] = field(default_factory = list)
+
+    def toDict(self) -> dict:
+        """
+        Return the SurfacePoint's properties as a dictionary.
+
+        Returns: A dictionary of the SurfacePoint's properties
+        """
+        return {
+            "vertex": self.vertex,
+            "face": self.face,
+            "distance": self.distance,
+            "barycentric": self.barycentric
+        }
+
+    def fromDict(self, dictionary: dict) -> None:
+        """
+        Take a dictionary and use its fields to populate the fields of the
+        SurfacePoint object.
+
+        Args:
+            dictionary: a dictionary with keys named for each property of a
+            SurfacePoint
+        """
+        self.vertex = dictionary["vertex"]
+        self.face = dictionary["face"]
+        self.distance = dictionary["distance"]
+        self.barycentric = dictionary["barycentric"]
+
+@dataclass(slots = True)
+class FieldStatistics():
+    """
+    The geometry of a ProjectedField on its mesh, computed by the server
+    when the survey is saved, see geometry.measureField. Points are given as
+    {"x", "y", "z"} like a hotSpot, and are empty for a field with no area
+    """
+    area: float = 0.0
+    centroid: dict = field(default_factory = dict)
+    normal: dict = field(default_factory = dict)
+    components: int = 0
+    hotSpotDistance: float | None = None
+
+    def toDict(self) -> dict:
+        """
+        Return the FieldStatistics' properties as a dictionary.
+
+        Returns: A dictionary of the FieldStatistics' properties
+        """
+        return {
+            "area": self.area,
+            "centroid": self.centroid,
+            "normal": self.normal,
+            "components": self.components,
+            "hotSpotDistance": self.hotSpotDistance
+        }
+
+    def fromDict(self, dictionary: dict) -> None:
+        """
+        Take a dictionary and use its fields to populate the fields of the
+        FieldStatistics object.
+
+        Args:
+            dictionary: a dictionary with keys named for each property of a
+            FieldStatistics
+        """
+        self.area = dictionary["area"]
+        self.centroid = dictionary["centroid"]
+        self.normal = dictionary["normal"]
+        self.components = dictionary["components"]
+        self.hotSpotDistance = dictionary["hotSpotDistance"]
+
+@dataclass(slots = True)
 class ProjectedField():
     model: str = ""
     name: str = ""
-    vertices: list[int] = field(default_factory = list)
+    vertices: VertexSet = field(default_factory = VertexSet)
     hotSpot: dict = field(default_factory = dict)
-    naturalness: float = -1.0
-    pain: float = -1.0
-    intensity: float = -1.0
+    naturalness: float | None = -1.0
+    pain: float | None = -1.0
+    intensity: float | None = -1.0
     qualities: list[Quality] = field(default_factory = list)
+    # Only set on saved surveys
+    statistics: FieldStatistics | None = None
+    hotSpotSnap: SurfacePoint | None = None
+
+    # Properties which may be overwritten by an "updateField" patch
+    PATCHABLE_PROPERTIES = frozenset({
+        "model", "name", "hotSpot", "naturalness", "pain", "intensity"
+    })
 
     def toDict(self) -> dict:
         """
@@ -113,12 +386,16 @@ class ProjectedField():
         return {
             "model": self.model,
             "name": self.name,
-            "vertices": self.vertices,
+            "vertices": self.vertices.toJSON(),
             "hotSpot": self.hotSpot,
             "naturalness": self.naturalness,
             "pain": self.pain,
             "intensity": self.intensity,
-            "qualities": qualitiesDict
+            "qualities": qualitiesDict,
+            "statistics": (self.statistics.toDict() 
+                           if self.statistics is not None else None),
+            "hotSpotSnap": (self.hotSpotSnap.toDict() 
+                            if self.hotSpotSnap is not None else None)
         }
     
     def fromDict(self, dictionary: dict) -> None:
@@ -132,7 +409,7 @@ class ProjectedField():
         """
         self.model = dictionary["model"]
         self.name = dictionary["name"]
-        self.vertices = dictionary["vertices"]
+        self.vertices = VertexSet.fromJSON(dictionary["vertices"])
         self.hotSpot = dictionary["hotSpot"]
         self.naturalness = dictionary["naturalness"]
         self.pain = dictionary["pain"]
@@ -141,8 +418,108 @@ class ProjectedField():
         for quality in dictionary["qualities"]:
             self.qualities.append(Quality())
             self.qualities[-1].fromDict(quality)
+        self.statistics = None
+        if dictionary.get("statistics") is not None:
+            self.statistics = FieldStatistics()
+            self.statistics.fromDict(dictionary["statistics"])
+        self.hotSpotSnap = None
+        if dictionary.get("hotSpotSnap") is not None:
+            self.hotSpotSnap = SurfacePoint()
+            self.hotSpotSnap.fromDict(dictionary["hotSpotSnap"])
+
+    @classmethod
+    def checkProperties(cls, dictionary: dict) -> dict:
+        """
+        Validate a partial dictionary of scalar properties against their
+        annotations, as updateFromDict takes it
+
+        Args:
+            dictionary: a dictionary with keys named for some of the scalar
+            properties of a ProjectedField
+
+        Returns: The properties, converted to their types
+
+        Raises: ValueError if a property cannot be patched or has the wrong
+            type, TypeError if the dictionary is not one
+        """
+        if not isinstance(dictionary, dict):
+            raise TypeError("ProjectedField properties must be a dictionary")
+        properties = {}
+        for key, value in dictionary.items():
+            if key not in cls.PATCHABLE_PROPERTIES:
+                raise ValueError(f"Cannot patch ProjectedField property {key}")
+            properties[key] = convert(value, cls.__annotations__[key])
+        return properties
+
+    def updateFromDict(self, dictionary: dict) -> None:
+        """
+        Take a partial dictionary and use the fields it contains to overwrite
+        the scalar properties of the ProjectedField. Vertices and qualities
+        are edited through their own methods.
+
+        Args:
+            dictionary: a dictionary with keys named for some of the scalar
+            properties of a ProjectedField
+
+        Raises: ValueError or TypeError as checkProperties, in which case no
+            property is changed
+        """
+        for key, value in self.checkProperties(dictionary).items():
+            setattr(self, key, value)
+
+    def addVertexRanges(self, ranges: list[Sequence[int]]) -> None:
+        """
+        Add every vertex in the given half-open [start, stop) ranges to the
+        ProjectedField's vertices.
+
+        Args:
+            ranges: a list of [start, stop) pairs of vertex indices
+        """
+        self.vertices.addRanges(ranges)
+
+    def removeVertexRanges(self, ranges: list[Sequence[int]]) -> None:
+        """
+        Remove every vertex in the given half-open [start, stop) ranges from
+        the ProjectedField's vertices.
+
+        Args:
+            ranges: a list of [start, stop) pairs of vertex indices
+        """
+        self.vertices.removeRanges(ranges)
+
+    def setQuality(self, quality: Quality | dict) -> None:
+        """
+        Replace the Quality with the same type as the given one, or append
+        it if the field has none of that type.
+
+        Args:
+            quality: the Quality, or a dictionary with keys named for each 
+            property of a Quality
+        """
+        if isinstance(quality, dict):
+            dictionary = quality
+            quality = Quality()
+            quality.fromDict(dictionary)
+        for i, existing in enumerate(self.qualities):
+            if existing.type == quality.type:
+                self.qualities[i] = quality
+                return
+        self.qualities.append(quality)
 
-@dataclass
+    def removeQuality(self, qualityType: str) -> None:
+        """
+        Remove the Quality of the given type from the ProjectedField.
+
+        Args:
+            qualityType: the type of the Quality to be removed
+        """
+        for i, existing in enumerate(self.qualities):
+            if existing.type == qualityType:
+                del self.qualities[i]
+                return
+        raise KeyError(f"ProjectedField has no quality of type {qualityType}")
+
+@dataclass(slots = True)
 class Survey():
     """
     A class which handles saving and maintaining individual survey data
@@ -153,6 +530,7 @@ class Survey():
     startTime: str = ""
     endTime: str = ""
     projectedFields: list[ProjectedField] = field(default_factory=list)
+    meshes: dict[str, str] = field(default_factory=dict)
     
     def startDateTimeNow(self) -> None:
         """
@@ -169,9 +547,17 @@ class Survey():
         now = datetime.now()
         self.endTime = now.strftime("%H-%M-%S")
 
+    @property
+    def filename(self) -> str:
+        """
+        The name of the .json file the survey is saved to
+        """
+        return f"Survey3D_{self.participant}_{self.date}_{self.startTime}.json"
+
     def saveSurvey(self, path: str) -> bool:
         """
-        Save a .json file containing a dictionary of the current survey
+        Save a .json file containing a dictionary of the current survey. The
+        file is written atomically and is durable when this returns
 
         Args:
             path: The folder to which the .json file should be saved
@@ -180,10 +566,9 @@ class Survey():
         """
         if not self.projectedFields:
             print("Submitted survey has no projected fields.")
-        filename = f"Survey3D_{self.participant}_{self.date}_{self.startTime}.json"
-        print(f"Saving survey to {filename}...")
-        with open(os.path.join(path, filename), 'w') as file:
-            json.dump(self.toDict(), file, indent = 4)
+        print(f"Saving survey to {self.filename}...")
+        with atomicOpen(os.path.join(path, self.filename), 'wb') as file:
+            file.write(encodePretty(self))
         return True
         
     def toDict(self) -> dict:
@@ -205,7 +590,8 @@ class Survey():
             "date": self.date,
             "startTime": self.startTime,
             "endTime" : self.endTime,
-            "projectedFields": projectedFieldsDict
+            "projectedFields": projectedFieldsDict,
+            "meshes": self.meshes
         }
 
     def fromDict(self, dictionary: dict) -> None:
@@ -226,46 +612,507 @@ class Survey():
         for field in dictionary["projectedFields"]:
             self.projectedFields.append(ProjectedField())
             self.projectedFields[-1].fromDict(field)
+        self.meshes = dictionary.get("meshes", {})
+
+    def applyPatch(self, ops: list[dict], 
+                   vertexCounts: dict[str, int] | None = None) -> None:
+        """
+        Apply a list of patch operations to the Survey in place, in order.
+        Each operation is a dictionary whose "op" key is one of:
+
+            addField        insert op["field"] at op["index"]
+            replaceField    overwrite the field at op["index"] with op["field"]
+            removeField     delete the field at op["index"]
+            updateField     overwrite scalar properties of the field at 
+                            op["index"] with op["properties"]
+            addVertices     add op["ranges"] to the field at op["index"]
+            removeVertices  remove op["ranges"] from the field at op["index"]
+            setQuality      add or replace op["quality"] on the field at 
+                            op["index"], matching on quality type
+            removeQuality   remove the quality of op["qualityType"] from the
+                            field at op["index"]
+
+        Vertex ranges are lists of half-open [start, stop) pairs of 
+        non-negative indices.
+
+        Every operation is checked, its kind, index, ranges and values, 
+        before any is applied, so a malformed patch leaves the Survey as it
+        was.
+
+        Args:
+            ops: the list of patch operations to apply
+            vertexCounts: the number of vertices of each model by name, if
+            known; a patch which would leave a field with vertices beyond 
+            its model is refused
+
+        Raises: ValueError, IndexError, KeyError or TypeError if an
+            operation is malformed. Only removing a quality the field does
+            not have is found as it is applied; operations before it remain 
+            applied, so the caller should fall back to a full update.
+        """
+        checked = self._checkPatch(ops, vertexCounts or {})
+        for kind, index, argument in checked:
+            if kind == "addField":
+                self.projectedFields.insert(index, argument)
+            elif kind == "replaceField":
+                self.projectedFields[index] = argument
+            elif kind == "removeField":
+                del self.projectedFields[index]
+            elif kind == "updateField":
+                self.projectedFields[index].updateFromDict(argument)
+            elif kind == "addVertices":
+                self.projectedFields[index].addVertexRanges(argument)
+            elif kind == "removeVertices":
+                self.projectedFields[index].removeVertexRanges(argument)
+            elif kind == "setQuality":
+                self.projectedFields[index].setQuality(argument)
+            else:
+                self.projectedFields[index].removeQuality(argument)
+
+    def _checkPatch(self, ops: list[dict], 
+                    vertexCounts: dict[str, int]) -> list[tuple[str, int, Any]]:
+        """
+        Validate patch operations without applying them, following how each
+        changes the fields' models and the highest of their vertices
+
+        Returns: Each operation's kind, field index, and its field, 
+            properties, ranges, quality or quality type converted to the 
+            types applyPatch uses
+        """
+        if not isinstance(ops, list):
+            raise TypeError("A survey patch must be a list of operations")
+        models = [field.model for field in self.projectedFields]
+        stops = [field.vertices.stop() for field in self.projectedFields]
+        checked = []
+        for op in ops:
+            if not isinstance(op, dict):
+                raise TypeError("Survey patch operations must be objects")
+            kind = op.get("op")
+            index = op.get("index")
+            if type(index) is not int:
+                raise TypeError(f"Survey patch index {index!r} is not an "
+                                "integer")
+            if kind == "addField":
+                if not 0 <= index <= len(models):
+                    raise IndexError(f"Cannot add field at index {index}")
+            elif not 0 <= index < len(models):
+                raise IndexError(f"No projected field at index {index}")
+
+            if kind in ("addField", "replaceField"):
+                argument = convert(op["field"], ProjectedField)
+                if kind == "addField":
+                    models.insert(index, "")
+                    stops.insert(index, 0)
+                models[index] = argument.model
+                stops[index] = argument.vertices.stop()
+            elif kind == "removeField":
+                checked.append((kind, index, None))
+                del models[index]
+                del stops[index]
+                continue
+            elif kind == "updateField":
+                argument = ProjectedField.checkProperties(op["properties"])
+                models[index] = argument.get("model", models[index])
+            elif kind in ("addVertices", "removeVertices"):
+                argument = convert(op["ranges"], list[tuple[int, int]])
+                if any(start < 0 for start, _ in argument):
+                    raise ValueError("Vertex ranges must not start below 0")
+                if kind == "addVertices":
+                    stops[index] = max([stops[index]] + [
+                        stop for start, stop in argument if start < stop
+                    ])
+            elif kind == "setQuality":
+                argument = convert(op["quality"], Quality)
+            elif kind == "removeQuality":
+                argument = convert(op["qualityType"], str)
+            else:
+                raise ValueError(f"Unknown survey patch operation: {kind}")
+            # Removed vertices are not followed, so this is an upper bound
+            if stops[index] > vertexCounts.get(models[index], float("inf")):
+                raise ValueError(f"Field {index} would have vertices beyond "
+                                 f"the {vertexCounts[models[index]]} of "
+                                 f"{models[index]}")
+            checked.append((kind, index, argument))
+        return checked
+
         
         
+class SurveySession():
+    """
+    The live state of one in-progress survey: the survey itself, its version,
+    its journal, and a lock which serializes the edits and saves made to it
+    without holding up any other session. The journal is a SurveyJournal, or
+    another store's journal with the same interface, see sessionstore
+    """
+    __slots__ = ("survey", "version", "journal", "lock")
+
+    def __init__(self, survey: Survey, journal: SurveyJournal, 
+                 version: int = 0):
+        """
+        Class initialization function
+
+        Args:
+            survey: The survey being filled out
+            journal: The journal in which updates to the survey are recorded
+            version: The survey's current version
+        """
+        self.survey = survey
+        self.journal = journal
+        self.version = version
+        self.lock = asyncio.Lock()
+
+    @property
+    def id(self) -> str:
+        """
+        The key of the session in its manager, which is its participant
+        """
+        return self.survey.participant
+
+    async def updateSurvey(self, survey: Survey | dict, 
+                           writer: PersistenceWriter) -> bool:
+        """
+        Replace the survey with a newer copy sent by its participant.
+
+        Args:
+            survey: the new Survey, or a dictionary of survey parameters, 
+            which is validated and converted to one
+            writer: The persistence writer, on which the journal checkpoint
+            is written
+
+        Returns: True if success, False if failure
+        """
+        if isinstance(survey, dict):
+            survey = convert(survey, Survey)
+        if self.survey.startTime != survey.startTime:
+            print("Cannot update survey with mismatched start time")
+            return False
+        self.survey = survey
+        self.version += 1
+        # A full update already costs O(survey), so it doubles as a journal
+        # checkpoint
+        await writer.run(self.journal.checkpoint, survey, self.version)
+        return True
+
+    async def patchSurvey(self, startTime: str, baseVersion: int, 
+                          ops: list[dict], writer: PersistenceWriter,
+                          vertexCounts: dict[str, int] | None = None) -> bool:
+        """
+        Apply a list of patch operations to the survey in place. The patch is
+        only applied if it was made against the survey's current version; 
+        otherwise the sender must resend the full survey with updateSurvey.
+
+        Args:
+            startTime: the start time of the survey the patch was made for
+            baseVersion: the survey version the patch was made against
+            ops: the patch operations, see Survey.applyPatch
+            writer: The persistence writer, on which journal checkpoints, 
+            and appends to a shared store, are written
+            vertexCounts: The number of vertices of the survey's models, 
+            see Survey.applyPatch
+
+        Returns: True if success, False if the sender must resync
+        """
+        if self.survey.startTime != startTime:
+            print("Cannot patch survey with mismatched start time")
+            return False
+        if baseVersion != self.version:
+            print(f"Cannot patch survey version {self.version} with a "
+                  f"patch made against version {baseVersion}")
+            return False
+        try:
+            self.survey.applyPatch(ops, vertexCounts)
+        except (ValueError, IndexError, KeyError, TypeError) as e:
+            print(f"Could not apply survey patch: {e}")
+            # The survey may be partially patched, so invalidate the version
+            # the sender holds and force it to resync
+            self.version += 1
+            return False
+        self.version += 1
+        # An append to a journal file is a single small write and flush, so 
+        # it is made inline, but a shared store's append may wait for other
+        # processes' writes, so it is handed to the writer like checkpoints
+        if self.journal.shared:
+            await writer.run(self.journal.appendPatch, self.version, ops)
+        else:
+            self.journal.appendPatch(self.version, ops)
+        if self.journal.needsCheckpoint:
+            await writer.run(self.journal.checkpoint, self.survey, 
+                             self.version)
+        return True
+
 class SurveyManager():
     """
     An object which handles survey creation, deletion, and editing. Has 
-    knowledge of paths which the survey object itself does not need access to
+    knowledge of paths which the survey object itself does not need access to.
+    Any number of surveys may be in progress at once, one session per 
+    participant. The sessions are kept in a session store, see sessionstore;
+    with a shared store, several server processes may serve the same 
+    sessions, each keeping a copy which it brings up to date from the store
     """
-    survey: Survey | None
-    config: dict = {}
+    sessions: dict[str, SurveySession]
+    store: LocalSessionStore
+    configCache: ParticipantConfig
     dataPath: str = ""
+    meshStore: MeshStore
+    geometry: GeometryCache | None = None
+    writer: PersistenceWriter
+    compute: ComputePool
+    startLock: asyncio.Lock
+    lods = None
+    meshTables = None
+    spatial = None
+    exporter = None
+    heatmaps = None
+    catalog = None
+    hub: SurveyHub
 
-    def __init__(self, configPath: str, dataPath: str):
+    def __init__(self, configPath: str, dataPath: str, 
+                 modelsPath: str | None = None, store = None):
         """
         Class initialization function
 
         Args:
             _config_path: The path in which the participant_config.json file 
-            lives
+            lives, which is reloaded whenever it changes
             _data_path: The path in which surveys should be saved
+            modelsPath: The path holding the model files served to clients, 
+            from which the server can produce mesh data itself
+            store: The session store, by default journal files in the data
+            path's journal folder, see sessionstore.openSessionStore
+
+        Raises: participantconfig.ConfigError if the participant config 
+            cannot be read or is invalid
         """
-        try:
-            with open(os.path.join(configPath, "participant_config.json"), 
-                    'r') as data:
-                self.config = json.load(data)
-        except json.JSONDecodeError as e:
-            raise json.JSONDecodeError(
-                f"Participant config cannot be parsed",
-                e.doc,
-                e.pos
-            )
-        except Exception as e:
-            raise Exception(f"Participant config cannot be read: {e}")
-        
         self.dataPath = os.path.join(dataPath)
-        self.survey = None
+        self.meshStore = MeshStore(os.path.join(dataPath, "meshes"))
+        modelExists = None
+        if modelsPath is not None:
+            self.geometry = GeometryCache(modelsPath)
+            modelExists = lambda filename: (self.geometry.pathFor(filename) 
+                                            is not None)
+        self.configCache = ParticipantConfig(
+            os.path.join(configPath, CONFIG_FILENAME), 
+            modelExists
+        )
+        self.writer = PersistenceWriter()
+        self.compute = ComputePool()
+        self.hub = SurveyHub()
+        self.sessions = {}
+        self.startLock = asyncio.Lock()
+        if store is None:
+            store = LocalSessionStore(os.path.join(dataPath, "journal"))
+        self.store = store
+        self.restoreSessions()
+        self.hub.publish(DEFAULT_TOPIC, 
+                         lambda: self.surveyMessage(self.defaultSessionId()))
+
+    @property
+    def config(self) -> dict:
+        """
+        The current participant config, see participantconfig
+        """
+        return self.configCache.config
+
+    @staticmethod
+    def _replay(records: list[dict]) -> Survey:
+        """
+        Rebuild a survey from its records, a snapshot and the patches after 
+        it, as a session store gives them
+        """
+        survey = Survey()
+        survey.fromDict(records[0]["survey"])
+        for record in records[1:]:
+            survey.applyPatch(record["ops"])
+        return survey
+
+    def restoreSessions(self) -> int:
+        """
+        Rebuild the in-progress surveys from the session store, as after a 
+        crash or reload, replaying each session's last snapshot and every 
+        patch after it. If a participant has more than one journal, the most
+        recent wins
+
+        Returns: The number of surveys restored
+        """
+        for records, journal in self.store.restore():
+            try:
+                survey = self._replay(records)
+            except (ValueError, IndexError, KeyError, TypeError) as e:
+                print(f"Could not restore survey from its journal: {e}")
+                continue
+            session = SurveySession(survey, journal, records[-1]["version"])
+            try:
+                session.journal.checkpoint(survey, session.version)
+            except SessionConflict:
+                # Another process has changed the session since it was read,
+                # and will be caught up on with its other changes
+                pass
+            if survey.participant in self.sessions:
+                print(f"Replacing older journaled survey for "
+                      f"{survey.participant}")
+            self.sessions[survey.participant] = session
+            self.publish(survey.participant, sessionsChanged = True)
+            print(f"Restored survey for {survey.participant} at version "
+                  f"{session.version} from its journal")
+        return len(self.sessions)
+
+    async def _readStore(self, function, *args):
+        """
+        Run a read of the session store. A shared store's reads may wait for
+        other processes' writes, so they are run on the compute pool; the 
+        local store's return at once, so they are run inline
+        """
+        if not self.store.shared:
+            return function(*args)
+        return await self.compute.run(function, *args)
+
+    async def catchUp(self, session: SurveySession) -> bool:
+        """
+        Apply to a session's survey the changes other processes have made
+        to it through a shared store. Called holding the session's lock
+
+        Returns: True if the session is current, False if it has ended, in
+            which case it is dropped
+        """
+        records = await self._readStore(self.store.catchUp, session.id, 
+                                        session.journal, session.version)
+        try:
+            if records and records[0]["type"] == "patch":
+                for record in records:
+                    session.survey.applyPatch(record["ops"])
+                    session.version = record["version"]
+                return True
+        except (ValueError, IndexError, KeyError, TypeError) as e:
+            print(f"Could not catch up on survey patches, rereading: {e}")
+            records = await self._readStore(self.store.catchUp, session.id,
+                                            session.journal, None)
+        if records is None:
+            if self.sessions.get(session.id) is session:
+                del self.sessions[session.id]
+                self.publish(session.id, sessionsChanged = True)
+            return False
+        if records:
+            session.survey = self._replay(records)
+            session.version = records[-1]["version"]
+        return True
+
+    async def followStore(self) -> int:
+        """
+        Catch up on the sessions other processes have started, changed and
+        ended through a shared store, and push the changes to this process's
+        clients. Sessions being edited or saved here are left to the edit, 
+        which catches up first
+
+        Returns: The number of sessions changed
+        """
+        versions = await self._readStore(self.store.changes)
+        if versions is None:
+            return 0
+        changed = 0
+        for sessionId, session in list(self.sessions.items()):
+            if sessionId in versions or session.lock.locked():
+                continue
+            del self.sessions[sessionId]
+            self.publish(sessionId, sessionsChanged = True)
+            changed += 1
+        for sessionId, version in versions.items():
+            session = self.sessions.get(sessionId)
+            if session is None:
+                session = await self._loadSession(sessionId)
+                if session is not None:
+                    self.publish(sessionId, sessionsChanged = True)
+                    changed += 1
+            elif version != session.version and not session.lock.locked():
+                async with session.lock:
+                    if (self.sessions.get(sessionId) is session
+                            and await self.catchUp(session)):
+                        self.publish(sessionId)
+                changed += 1
+        return changed
+
+    async def _loadSession(self, sessionId: str) -> SurveySession | None:
+        """
+        Add a session another process started to this process's sessions,
+        unless it has been started or loaded here meanwhile
+        """
+        async with self.startLock:
+            if sessionId in self.sessions:
+                return None
+            loaded = await self._readStore(self.store.load, sessionId)
+            if loaded is None:
+                return None
+            records, journal = loaded
+            try:
+                survey = self._replay(records)
+            except (ValueError, IndexError, KeyError, TypeError) as e:
+                print(f"Could not load survey for {sessionId}: {e}")
+                return None
+            session = SurveySession(survey, journal, records[-1]["version"])
+            self.sessions[sessionId] = session
+            return session
+
+    async def watchStore(self) -> None:
+        """
+        Follow a shared store for as long as the server runs, see 
+        followStore
+        """
+        while True:
+            await asyncio.sleep(self.store.pollInterval)
+            try:
+                await self.followStore()
+            except Exception as e:
+                print(f"Could not follow the session store: {e}")
+
+    def getSession(self, sessionId: str | None) -> SurveySession | None:
+        """
+        Return the session with the given id, or None if there is none
+        """
+        return self.sessions.get(sessionId)
 
-    def newSurvey(self, participant: str) -> bool:
+    def defaultSessionId(self) -> str | None:
+        """
+        Return the id of the only session in progress, for clients which do
+        not name a session. If there are several sessions, or none, clients 
+        must name one, so None is returned
+        """
+        if len(self.sessions) == 1:
+            return next(iter(self.sessions))
+        return None
+
+    def surveyMessage(self, sessionId: str | None) -> dict:
+        """
+        Return the message which shows a session's survey to a client, or 
+        tells it there is no survey
+        """
+        session = self.getSession(sessionId)
+        if session is None:
+            return {"type": "noSurvey"}
+        return {"type": "survey", "survey": session.survey}
+
+    def publish(self, sessionId: str, sessionsChanged: bool = False) -> None:
+        """
+        Push a session's survey to the clients watching it through the hub.
+        Clients which have not named a session follow the only session in 
+        progress, so they are also sent its changes, and are sent the new 
+        state whenever a session starts or ends
+
+        Args:
+            sessionId: The session which changed
+            sessionsChanged: True if the session has just started or ended
+        """
+        self.hub.publish(sessionId, lambda: self.surveyMessage(sessionId))
+        defaultId = self.defaultSessionId()
+        if sessionsChanged or defaultId == sessionId:
+            self.hub.publish(DEFAULT_TOPIC, 
+                             lambda: self.surveyMessage(defaultId))
+
+    async def newSurvey(self, participant: str) -> bool:
         """
         Create a new survey for a given participant if one does not already
-        exist
+        exist. The participant's models are resolved to their levels of 
+        detail on the compute pool, and the session's first journal record is
+        written on the persistence writer's threads, under the start lock, so
+        no other session for the participant can start or be loaded meanwhile
 
         Args:
             participant: The participant for which the survey is created, must 
@@ -273,74 +1120,486 @@ class SurveyManager():
         
         Returns: True if success, False if failure
         """
-        if self.survey:
+        if participant in self.sessions:
             print("Cannot begin new survey; there is already an ongoing "
-                  "survey.")
+                  f"survey for {participant}.")
             return False
-        else:
-            if participant in self.config:
-                self.survey = Survey(participant, self.config[participant])
-                self.survey.startDateTimeNow()
-                return True
-            else:
-                print("Cannot begin new survey; given participant is not in " 
-                      "participant config.")
+        if participant not in self.config:
+            print("Cannot begin new survey; given participant is not in " 
+                  "participant config.")
+            return False
+        config = self.config[participant]
+        if self.lods is not None:
+            # A config reloaded since the server started may ask for a 
+            # variant which has not been built, and building one takes a while
+            config = await self.compute.run(self.lods.resolveConfig, config)
+        async with self.startLock:
+            # Another start for the participant may have finished meanwhile
+            if participant in self.sessions:
+                print("Cannot begin new survey; there is already an ongoing "
+                      f"survey for {participant}.")
                 return False
-                
-    def updateSurvey(self, survey: dict) -> bool:
+            survey = Survey(participant, config)
+            survey.startDateTimeNow()
+            journal = await self.writer.run(self.store.create, participant, 
+                                            survey)
+            if journal is None:
+                print("Cannot begin new survey; another server process "
+                      f"has an ongoing survey for {participant}.")
+                return False
+            session = SurveySession(survey, journal)
+            self.sessions[participant] = session
+            self.publish(participant, sessionsChanged = True)
+            return True
+
+    async def updateSurvey(self, sessionId: str, 
+                           survey: Survey | dict) -> bool:
         """
-        Update the survey with data from a given dictionary.
+        Replace a session's survey with a newer copy, see 
+        SurveySession.updateSurvey
 
         Args:
-            survey: a dictionary of survey parameters from which the object
-            will be updated
+            sessionId: the session whose survey is updated
+            survey: the new Survey, or a dictionary of survey parameters
 
         Returns: True if success, False if failure
         """
-        if isinstance(self.survey, Survey):
-            if self.survey.startTime == survey["startTime"]:
-                self.survey.fromDict(survey)
-                return True
-            else:
-                print("Cannot update survey with mismatched start time")
-        else:
-            print("Cannot update survey; there is no current survey")
-        return False
+        session = self.getSession(sessionId)
+        if session is None:
+            print("Cannot update survey; there is no such session")
+            return False
+        if isinstance(survey, dict):
+            survey = convert(survey, Survey)
+        errors = await self.compute.run(self.fieldErrors, survey)
+        if errors:
+            print(f"Cannot update survey; {'; '.join(errors)}")
+            return False
+        async with session.lock:
+            if (self.sessions.get(sessionId) is not session 
+                    or not await self.catchUp(session)):
+                print("Cannot update survey; it has already been saved")
+                return False
+            try:
+                if not await session.updateSurvey(survey, self.writer):
+                    return False
+            except SessionConflict as e:
+                print(f"Cannot update survey; {e}")
+                await self.catchUp(session)
+                return False
+        self.publish(sessionId)
+        return True
+
+    async def patchSurvey(self, sessionId: str, startTime: str, 
+                          baseVersion: int, ops: list[dict]) -> bool:
+        """
+        Apply a list of patch operations to a session's survey in place, see 
+        SurveySession.patchSurvey. The vertex counts of the survey's models
+        are read on the compute pool, so a patch adding vertices beyond its
+        field's model is refused
+
+        Returns: True if success, False if the sender must resync
+        """
+        session = self.getSession(sessionId)
+        if session is None:
+            print("Cannot patch survey; there is no such session")
+            return False
+        vertexCounts = await self.compute.run(self.modelVertexCounts,
+                                              session.survey.config)
+        async with session.lock:
+            if (self.sessions.get(sessionId) is not session 
+                    or not await self.catchUp(session)):
+                print("Cannot patch survey; it has already been saved")
+                return False
+            try:
+                if not await session.patchSurvey(startTime, baseVersion, ops,
+                                                 self.writer, vertexCounts):
+                    return False
+            except SessionConflict as e:
+                print(f"Cannot patch survey; {e}")
+                await self.catchUp(session)
+                return False
+        self.publish(sessionId)
+        return True
     
-    def saveMeshData(self, meshData: dict) -> bool:
+    async def missingMeshes(self, meshHashes: dict[str, str]) -> list[str]:
         """
-        Take a dictionary with mesh data fields, create a Mesh object, then save
-        it to the data path.
+        Take a dictionary of mesh filenames to content hashes and return the
+        filenames whose geometry the mesh store does not yet hold and the 
+        server cannot produce from its own model files.
 
         Args:
-            meshData: a dictionary of mesh parameters which will be saved as a
-            Mesh
+            meshHashes: a dictionary of mesh filenames to content hashes, 
+            which may be None for meshes the client could not hash
+
+        Returns: The filenames whose meshes must be uploaded
+        """
+        missing = self.meshStore.missing(meshHashes)
+        if missing and self.geometry is not None:
+            missing = await self.compute.run(self._unproducible, missing)
+        return missing
+
+    def _unproducible(self, filenames: list[str]) -> list[str]:
+        """
+        Blocking part of missingMeshes: return the filenames whose model 
+        files the server cannot parse
+        """
+        return [
+            filename for filename in filenames 
+            if not self.geometry.has(filename)
+        ]
+
+    async def storeModel(self, filename: str) -> str | None:
+        """
+        Produce the mesh data of a model from the server's copy of its file
+        and put it in the mesh store, if the store does not hold it yet. The
+        model is parsed on the compute pool, and only a mesh the store lacks
+        is written on the persistence writer
+
+        Args:
+            filename: The model's filename, as under /3dmodels
+
+        Returns: The content hash of the model's geometry, or None if the 
+            server cannot produce it
+        """
+        meshHash = await self.compute.run(self.modelMeshHash, filename)
+        if meshHash is None or self._modelMeshStored(filename, meshHash):
+            return meshHash
+        return await self.writer.run(self.storeModelMesh, filename)
+
+    def modelMeshHash(self, filename: str) -> str | None:
+        """
+        Return the content hash of a model's geometry, as the server reads
+        it from its copy of the model's file, or None if the server cannot
+        produce it. This parses the model, so it should be run on the 
+        compute pool
+        """
+        if self.geometry is None:
+            return None
+        try:
+            arrays = self.geometry.get(filename)
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            print(f"Could not load geometry of {filename}: {e}")
+            return None
+        if arrays is None:
+            return None
+        return arrays.contentHash()
+
+    def modelVertexCount(self, filename: str) -> int | None:
+        """
+        Return the number of vertices of a model, as the server reads it from
+        its copy of the model's file, or None if the server cannot produce
+        it. This parses the model, so it should be run on the compute pool
+        """
+        if self.geometry is None:
+            return None
+        try:
+            arrays = self.geometry.get(filename)
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            print(f"Could not load geometry of {filename}: {e}")
+            return None
+        if arrays is None:
+            return None
+        return len(arrays.vertices)
+
+    def _modelMeshStored(self, filename: str, meshHash: str) -> bool:
+        """
+        Return True if a model's mesh is in the mesh store and has its legacy
+        per-filename copy
+        """
+        legacyPath = os.path.join(self.dataPath, f"{filename}.json")
+        return self.meshStore.has(meshHash) and os.path.isfile(legacyPath)
+
+    def storeModelMesh(self, filename: str) -> str | None:
+        """
+        Blocking part of storeModel, which parses the model too, for callers
+        already on the persistence writer
+
+        Returns: The content hash of the model's geometry, or None if the 
+            server cannot produce it
+        """
+        if self.geometry is None:
+            return None
+        try:
+            arrays = self.geometry.get(filename)
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            print(f"Could not load geometry of {filename}: {e}")
+            return None
+        if arrays is None:
+            return None
+        meshHash = arrays.contentHash()
+        if not self._modelMeshStored(filename, meshHash):
+            mesh = Mesh(filename, arrays.vertices.tolist(), 
+                        arrays.faces.tolist())
+            self.meshStore.put(mesh, meshHash)
+            mesh.saveMesh(self.dataPath)
+        return meshHash
+
+    def _usedModelFiles(self, survey: Survey) -> set[str]:
+        """
+        Return the filenames of the models the survey's fields were drawn on
+        """
+        models = survey.config.get("models", {})
+        return {
+            models[field.model]["file"] for field in survey.projectedFields
+            if field.model in models and "file" in models[field.model]
+        }
+
+    def fieldErrors(self, survey: Survey) -> list[str]:
+        """
+        Check the vertices of the survey's fields against the models they
+        were drawn on, so that ranges past the end of a mesh are refused
+        before anything expands them. Fields on models the server cannot
+        produce are not checked. This parses models, so it should be run on
+        the compute pool
+
+        Args:
+            survey: The survey to be checked
+
+        Returns: A description of each field with vertices outside its model
+        """
+        counts = self.modelVertexCounts(survey.config)
+        return [
+            f"Field {i} has vertices up to {field.vertices.stop() - 1}, but "
+            f"{field.model} has {counts[field.model]} vertices"
+            for i, field in enumerate(survey.projectedFields)
+            if field.vertices.stop() > counts.get(field.model, float("inf"))
+        ]
+
+    def modelVertexCounts(self, config: dict) -> dict[str, int]:
+        """
+        Return the number of vertices of each model of a participant's 
+        config which the server can produce, by model name. This parses 
+        models, so it should be run on the compute pool
+        """
+        counts = {}
+        for name, model in config.get("models", {}).items():
+            if isinstance(model, dict) and isinstance(model.get("file"), str):
+                count = self.modelVertexCount(model["file"])
+                if count is not None:
+                    counts[name] = count
+        return counts
+
+    async def saveMeshData(self, sessionId: str, meshData: dict, 
+                           meshHashes: dict[str, str] | None = None) -> bool:
+        """
+        Store uploaded meshes in the mesh store, then record the hashes of 
+        every mesh the session's survey used on the survey. Meshes which were
+        not uploaded are found in the store by the hash the client gave, or
+        else produced from the server's own model files, so a client may 
+        submit without uploading any geometry. Models are parsed on the
+        compute pool, hashing and writing happen on the persistence writer's
+        threads, and this returns once the meshes are durable.
+
+        Args:
+            sessionId: the session whose survey used the meshes
+            meshData: a dictionary of mesh filenames to the uploaded Meshes,
+            or to mesh parameters which are converted to Meshes
+            meshHashes: a dictionary of mesh filenames to content hashes, 
+            covering meshes the client did not upload
 
         Returns: True if success, False if failure
         """
+        meshHashes = meshHashes or {}
+        session = self.getSession(sessionId)
+        needed = set(meshHashes)
+        if session is not None:
+            needed |= self._usedModelFiles(session.survey)
         try:
-            for mesh in meshData:
-                obj = Mesh()
-                obj.fromDict(meshData[mesh])
-                obj.saveMesh(self.dataPath)
-        except:
-            print("Could not save mesh data")
+            meshes = [
+                mesh if isinstance(mesh, Mesh) else convert(mesh, Mesh)
+                for mesh in meshData.values()
+            ]
+            hashes = await self.writer.run(self._storeMeshes, meshes, 
+                                           meshHashes)
+            for filename in needed - hashes.keys():
+                meshHash = meshHashes.get(filename)
+                if not self.meshStore.has(meshHash):
+                    meshHash = await self.storeModel(filename)
+                if meshHash is None:
+                    print(f"Mesh {filename} was neither uploaded, stored, "
+                          "nor found among the models")
+                    return False
+                hashes[filename] = meshHash
+        except Exception as e:
+            print(f"Could not save mesh data: {e}")
             return False
+        if session is not None:
+            session.survey.meshes = hashes
         return True
+
+    def _storeMeshes(self, meshes: list[Mesh], 
+                     meshHashes: dict[str, str]) -> dict[str, str]:
+        """
+        Blocking part of saveMeshData: put each Mesh in the mesh store and
+        save its legacy per-filename copy
+
+        Returns: A dictionary of mesh filenames to content hashes
+
+        Raises: ValueError if a Mesh is not one of the served models, when 
+            the manager knows them
+        """
+        hashes = {}
+        for mesh in meshes:
+            if (self.geometry is not None 
+                    and self.geometry.pathFor(mesh.filename) is None):
+                raise ValueError(f"Mesh {mesh.filename!r} is not one of the "
+                                 "served models")
+            hashes[mesh.filename] = self.meshStore.put(
+                mesh, 
+                meshHashes.get(mesh.filename)
+            )
+            mesh.saveMesh(self.dataPath)
+        return hashes
     
-    def saveSurvey(self) -> bool:
+    async def remapSurvey(self, survey: Survey) -> None:
+        """
+        Map the fields of a survey drawn on lower levels of detail of its
+        models back to the full models, if the manager has LOD variants, see
+        lod.LodLibrary.remapSurvey. A failure is reported and leaves the 
+        fields on the variants, whose meshes the survey records, so the 
+        survey is saved as it was drawn
+        """
+        if self.lods is None:
+            return
+        try:
+            remapped = await self.compute.run(self.lods.remapSurvey, survey)
+            # The full models' meshes are recorded in place of the variants'
+            for lodFile, filename in remapped.items():
+                survey.meshes.pop(lodFile, None)
+                meshHash = await self.storeModel(filename)
+                if meshHash is not None:
+                    survey.meshes[filename] = meshHash
+        except Exception as e:
+            print(f"Could not map the fields of {survey.filename} to full "
+                  f"resolution: {e}")
+
+    async def measureSurvey(self, survey: Survey) -> None:
+        """
+        Compute the geometry statistics of a survey's fields on their meshes,
+        if the manager has mesh tables, so that they are saved with it. A
+        failure is reported and leaves the statistics unset, but does not 
+        fail the save; running geometry.py measures the survey later
         """
-        Set the end time to the current time, then saves the survey to a file 
-        in the Manager's data path
+        if self.meshTables is None:
+            return
+        try:
+            await self.compute.run(self.meshTables.measureSurvey, survey)
+        except Exception as e:
+            print(f"Could not measure the fields of {survey.filename}: {e}")
+
+    async def snapSurvey(self, survey: Survey) -> None:
+        """
+        Find where the hotspots of a survey's fields lie on their meshes, if
+        the manager has spatial indexes, so that they are saved with it. A
+        failure is reported and leaves the hotspots unsnapped, but does not
+        fail the save
+        """
+        if self.spatial is None:
+            return
+        try:
+            await self.compute.run(self.spatial.snapSurvey, survey)
+        except Exception as e:
+            print(f"Could not snap the hotspots of {survey.filename}: {e}")
+
+    async def snapLandmarks(self, meshHash: str, 
+                            landmarks: list["Landmark"]) -> None:
+        """
+        Find where landmarks lie on their mesh, if the manager has spatial 
+        indexes, so that they are saved with their set. A failure is 
+        reported but does not fail the save
+        """
+        if self.spatial is None:
+            return
+        try:
+            await self.compute.run(self.spatial.snapLandmarks, meshHash, 
+                                   landmarks)
+        except Exception as e:
+            print(f"Could not snap landmarks: {e}")
+
+    async def exportSurvey(self, survey: Survey) -> None:
+        """
+        Add a saved survey to the columnar export, if the manager has an
+        exporter. The survey file is already durable, so a failed export is
+        reported but does not fail the save; the survey can be exported 
+        later by running export.py
+        """
+        if self.exporter is None:
+            return
+        try:
+            await self.writer.run(self.exporter.add, [survey])
+        except Exception as e:
+            print(f"Could not export survey {survey.filename}: {e}")
+
+    async def aggregateSurvey(self, survey: Survey) -> None:
+        """
+        Add a saved survey's fields to the running heatmaps, if the manager 
+        has a heatmap aggregator. As with the export, a failure is reported 
+        but does not fail the save; running heatmap.py adds the survey later
+        """
+        if self.heatmaps is None:
+            return
+        try:
+            await self.writer.run(self.heatmaps.add, [survey])
+        except Exception as e:
+            print(f"Could not add survey {survey.filename} to heatmaps: {e}")
+
+    async def catalogSurvey(self, survey: Survey) -> None:
+        """
+        Add a saved survey to the catalog, if the manager has one. A failure
+        is reported but does not fail the save; running catalog.py rebuilds 
+        the catalog from the data folder
+        """
+        if self.catalog is None:
+            return
+        try:
+            await self.writer.run(self.catalog.add, [survey])
+        except Exception as e:
+            print(f"Could not catalog survey {survey.filename}: {e}")
+
+    async def saveSurvey(self, sessionId: str) -> bool:
+        """
+        Set the end time of a session's survey to the current time, then save
+        the survey to a file in the Manager's data path and end the session. 
+        The file is written from a snapshot of the survey on the persistence 
+        writer's threads, and this returns once it is durable
+
+        Args:
+            sessionId: the session whose survey is saved
 
         Returns: True if success, False if failure
         """
         print("Saving survey...")
-        if isinstance(self.survey, Survey) and self.dataPath:
-            self.survey.endTimeNow()
+        session = self.getSession(sessionId)
+        if session is None or not self.dataPath:
+            print("Cannot save when there is no such session in manager")
+            return False
+        async with session.lock:
+            if (self.sessions.get(sessionId) is not session 
+                    or not await self.catchUp(session)):
+                print("Cannot save survey; it has already been saved")
+                return False
+            session.survey.endTimeNow()
+            snapshot = decode(encode(session.survey), Survey)
+            errors = await self.compute.run(self.fieldErrors, snapshot)
+            if errors:
+                print(f"Cannot save survey; {'; '.join(errors)}")
+                return False
+            await self.remapSurvey(snapshot)
+            await self.measureSurvey(snapshot)
+            await self.snapSurvey(snapshot)
             try:
-                if self.survey.saveSurvey(self.dataPath):
-                    self.survey = None
+                if await self.writer.run(snapshot.saveSurvey, self.dataPath):
+                    del self.sessions[sessionId]
+                    ended = await self.writer.run(self.store.end, sessionId,
+                                                  session.journal)
+                    self.publish(sessionId, sessionsChanged = True)
+                    if not ended:
+                        # Another process saved the survey at the same time,
+                        # and adds it to the export and the rest
+                        return True
+                    await self.exportSurvey(snapshot)
+                    await self.aggregateSurvey(snapshot)
+                    await self.catalogSurvey(snapshot)
                     return True
                 else:
                     print("Survey failed to save")
@@ -348,11 +1607,8 @@ class SurveyManager():
             except Exception as e:
                 print(e)
                 return False
-        else:
-            print("Cannot save when there is no survey in manager")
-            return False
 
-@dataclass
+@dataclass(slots = True)
 class Landmark():
     """
     A class which represents an annotated point in 3D space
@@ -361,6 +1617,8 @@ class Landmark():
     x: float
     y: float
     z: float
+    # Only set on saved landmark sets
+    snap: SurfacePoint | None = None
 
     def toDict(self):
         """
@@ -373,6 +1631,7 @@ class Landmark():
             "x": self.x,
             "y": self.y,
             "z": self.z,
+            "snap": self.snap.toDict() if self.snap is not None else None
         }
 
 @dataclass  
@@ -383,15 +1642,23 @@ class LandmarkSet():
     name: str
     mesh: Mesh
     landmarks: list[Landmark] = field(default_factory=list)
+    meshHash: str = ""
 
     def toDict(self) -> dict:
         """
-        Return a dictionary of the LandmarkSet's properties
+        Return a dictionary of the LandmarkSet's properties. The mesh is 
+        referred to by its filename and content hash; its geometry lives in
+        the mesh store
         
         Returns: a dictionary of the LandmarkSet's properties
         """
+        if not self.meshHash:
+            self.meshHash = self.mesh.contentHash()
         return {
-            "mesh": self.mesh.toDict(),
+            "mesh": {
+                "filename": self.mesh.filename,
+                "hash": self.meshHash
+            },
             "landmarks": [p.toDict() for p in self.landmarks], 
         }
     
@@ -414,6 +1681,6 @@ class LandmarkSet():
         
         filename = f"Survey3DLandmarks_{no_slash_mesh_filename}_{self.name}.json"
         print(f"Saving landmarks to {filename}...")
-        with open(os.path.join(path, filename), 'w') as file:
-            json.dump(self.toDict(), file, indent = 4)
+        with atomicOpen(os.path.join(path, filename), 'wb') as file:
+            file.write(encodePretty(self.toDict()))
         return True
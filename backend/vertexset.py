@@ -0,0 +1,245 @@
+from bisect import bisect_right
+from typing import Iterable, Iterator, Sequence
+
+class VertexSet():
+    """
+    A set of vertex indices stored as sorted, disjoint, non-adjacent
+    half-open [start, stop) runs. Painted regions are spatially coherent, so
+    a field of tens of thousands of vertices is usually a few hundred runs,
+    and set algebra costs O(runs) rather than O(vertices).
+
+    On the wire and on disk a VertexSet is {"runs": [...]}, a flat list of
+    alternating gaps and lengths: the first run starts at the first gap, and
+    every later run starts that many indices after the previous run stops.
+    The legacy plain list of indices is accepted wherever a VertexSet is
+    read.
+    """
+    __slots__ = ("_starts", "_stops", "_count")
+
+    def __init__(self, indices: Iterable[int] = ()):
+        """
+        Class initialization function
+
+        Args:
+            indices: The vertex indices in the set, in any order
+        """
+        self._starts = []
+        self._stops = []
+        for index in sorted(set(indices)):
+            if self._stops and self._stops[-1] == index:
+                self._stops[-1] += 1
+            else:
+                self._starts.append(index)
+                self._stops.append(index + 1)
+        self._count = sum(self._stops) - sum(self._starts)
+
+    @classmethod
+    def fromRanges(cls, ranges: Iterable[Sequence[int]]) -> "VertexSet":
+        """
+        Create a VertexSet from half-open [start, stop) ranges, which may be
+        unsorted, overlapping or empty
+
+        Args:
+            ranges: An iterable of [start, stop) pairs
+
+        Returns: The VertexSet covering every range
+
+        Raises: ValueError if a range starts below 0
+        """
+        result = cls()
+        for start, stop in sorted((int(r[0]), int(r[1])) for r in ranges):
+            if start < 0:
+                raise ValueError(f"Vertex range starts at {start}")
+            if start >= stop:
+                continue
+            if result._stops and start <= result._stops[-1]:
+                result._stops[-1] = max(result._stops[-1], stop)
+            else:
+                result._starts.append(start)
+                result._stops.append(stop)
+        result._count = sum(result._stops) - sum(result._starts)
+        return result
+
+    @classmethod
+    def fromJSON(cls, value: dict | list) -> "VertexSet":
+        """
+        Create a VertexSet from its run encoding or from a legacy list of
+        vertex indices
+
+        Args:
+            value: {"runs": [...]} or a list of vertex indices
+
+        Returns: The decoded VertexSet
+
+        Raises: ValueError if a gap, length or index is negative
+        """
+        if isinstance(value, VertexSet):
+            return value.copy()
+        if isinstance(value, dict):
+            runs = value["runs"]
+            if len(runs) % 2:
+                raise ValueError("Vertex runs must come in gap/length pairs")
+            ranges = []
+            stop = 0
+            for i in range(0, len(runs), 2):
+                if runs[i] < 0 or runs[i + 1] < 0:
+                    raise ValueError("Vertex runs must not be negative")
+                start = stop + runs[i]
+                stop = start + runs[i + 1]
+                ranges.append((start, stop))
+            return cls.fromRanges(ranges)
+        if any(index < 0 for index in value):
+            raise ValueError("Vertex indices must not be negative")
+        return cls(value)
+
+    def toJSON(self) -> dict:
+        """
+        Return the run encoding of the VertexSet
+
+        Returns: {"runs": [...]}, see the class description
+        """
+        runs = []
+        stop = 0
+        for start, nextStop in zip(self._starts, self._stops):
+            runs.append(start - stop)
+            runs.append(nextStop - start)
+            stop = nextStop
+        return {"runs": runs}
+
+    def ranges(self) -> list[tuple[int, int]]:
+        """
+        Return the VertexSet's runs as half-open [start, stop) pairs
+        """
+        return list(zip(self._starts, self._stops))
+
+    def stop(self) -> int:
+        """
+        Return one past the highest vertex index in the VertexSet, or 0 if
+        it is empty
+        """
+        return self._stops[-1] if self._stops else 0
+
+    def toList(self) -> list[int]:
+        """
+        Return every vertex index in the VertexSet, in ascending order
+        """
+        return list(self)
+
+    def copy(self) -> "VertexSet":
+        result = VertexSet()
+        result._starts = list(self._starts)
+        result._stops = list(self._stops)
+        result._count = self._count
+        return result
+
+    def union(self, other: "VertexSet") -> "VertexSet":
+        """
+        Return the vertices in either VertexSet
+        """
+        return VertexSet.fromRanges(self.ranges() + other.ranges())
+
+    def intersection(self, other: "VertexSet") -> "VertexSet":
+        """
+        Return the vertices in both VertexSets
+        """
+        result = VertexSet()
+        i = j = 0
+        while i < len(self._starts) and j < len(other._starts):
+            start = max(self._starts[i], other._starts[j])
+            stop = min(self._stops[i], other._stops[j])
+            if start < stop:
+                result._starts.append(start)
+                result._stops.append(stop)
+            if self._stops[i] < other._stops[j]:
+                i += 1
+            else:
+                j += 1
+        result._count = sum(result._stops) - sum(result._starts)
+        return result
+
+    def difference(self, other: "VertexSet") -> "VertexSet":
+        """
+        Return the vertices in this VertexSet but not the other
+        """
+        result = VertexSet()
+        j = 0
+        for start, stop in zip(self._starts, self._stops):
+            while j < len(other._starts) and other._stops[j] <= start:
+                j += 1
+            k = j
+            while k < len(other._starts) and other._starts[k] < stop:
+                if other._starts[k] > start:
+                    result._starts.append(start)
+                    result._stops.append(other._starts[k])
+                start = max(start, other._stops[k])
+                k += 1
+            if start < stop:
+                result._starts.append(start)
+                result._stops.append(stop)
+        result._count = sum(result._stops) - sum(result._starts)
+        return result
+
+    def intersectionCount(self, other: "VertexSet") -> int:
+        """
+        Return the number of vertices in both VertexSets without building
+        their intersection
+        """
+        count = 0
+        i = j = 0
+        while i < len(self._starts) and j < len(other._starts):
+            overlap = (min(self._stops[i], other._stops[j])
+                       - max(self._starts[i], other._starts[j]))
+            if overlap > 0:
+                count += overlap
+            if self._stops[i] < other._stops[j]:
+                i += 1
+            else:
+                j += 1
+        return count
+
+    def addRanges(self, ranges: Iterable[Sequence[int]]) -> None:
+        """
+        Add every vertex in the given half-open [start, stop) ranges
+        """
+        merged = self.union(VertexSet.fromRanges(ranges))
+        self._starts, self._stops = merged._starts, merged._stops
+        self._count = merged._count
+
+    def removeRanges(self, ranges: Iterable[Sequence[int]]) -> None:
+        """
+        Remove every vertex in the given half-open [start, stop) ranges
+        """
+        remaining = self.difference(VertexSet.fromRanges(ranges))
+        self._starts, self._stops = remaining._starts, remaining._stops
+        self._count = remaining._count
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __bool__(self) -> bool:
+        return self._count > 0
+
+    def __iter__(self) -> Iterator[int]:
+        for start, stop in zip(self._starts, self._stops):
+            yield from range(start, stop)
+
+    def __contains__(self, index: int) -> bool:
+        i = bisect_right(self._starts, index) - 1
+        return i >= 0 and index < self._stops[i]
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, VertexSet):
+            return NotImplemented
+        return self._starts == other._starts and self._stops == other._stops
+
+    def __or__(self, other: "VertexSet") -> "VertexSet":
+        return self.union(other)
+
+    def __and__(self, other: "VertexSet") -> "VertexSet":
+        return self.intersection(other)
+
+    def __sub__(self, other: "VertexSet") -> "VertexSet":
+        return self.difference(other)
+
+    def __repr__(self) -> str:
+        return f"VertexSet({self.ranges()!r})"
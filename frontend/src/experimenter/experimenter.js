@@ -8,13 +8,14 @@ var cameraController;
 var surveyManager;
 var surveyTable;
 
-var updateSurveyInterval;
-
 var lastClickedView = null;
+// The ETag of the participant config the dropdown was filled from
+var configEtag = null;
 
 /* WEBSOCKET */
 
-const socketURL = "/experimenter-ws";
+// Pass the page's ?session= on to the server, which may hold several surveys
+const socketURL = "/experimenter-ws" + window.location.search;
 var socket;
 
 /**
@@ -27,13 +28,9 @@ function socketConnect() {
 
 	socket.onopen = function() {
         console.log("Socket connected!");
-        socket.send(JSON.stringify({"type" : "requestConfig"}));
-		if (!updateSurveyInterval) {
-			updateSurveyInterval = setInterval(function() {
-				const msg = { type: "requestSurvey" }
-				socket.send(JSON.stringify(msg));
-			}, 1000);
-		}
+        requestConfig();
+		// The server pushes the survey whenever it changes, so there is no
+		// need to poll for it
     }
 
 	socket.onmessage = function(event) {
@@ -55,7 +52,12 @@ function socketConnect() {
 				break;
             case "config":
                 const dropdown = document.getElementById("participantSelect");
+				const selected = dropdown.value;
 				dropdown.innerHTML = "";
+				configEtag = msg.etag;
+				for (const warning of msg.warnings || []) {
+					console.warn("Participant config: " + warning);
+				}
 
                 for (var p in msg.config) {
 					const newOption = document.createElement("option");
@@ -64,7 +66,12 @@ function socketConnect() {
 
 					dropdown.appendChild(newOption);
 				}
+				if (selected in msg.config) {
+					dropdown.value = selected;
+				}
                 break;
+			case "configNotModified":
+				break;
 			case "noSurvey":
 				surveyManager.clearSurvey();
 				surveyTable.clear();
@@ -78,7 +85,6 @@ function socketConnect() {
 	socket.onclose = function() {
 		console.log("Connection to websocket @ ", socketURL, 
 			" closed. Attempting reconnect in 1 second.");
-		clearInterval(updateSurveyInterval);
 		setTimeout(function() {
 			socketConnect();
 		}, 1000);
@@ -90,6 +96,19 @@ function socketConnect() {
 	}
 }
 
+/**
+ * Ask the server for the participant config, which it only sends if it has
+ * changed since the copy the dropdown was filled from
+ */
+function requestConfig() {
+	if (socket.readyState === WebSocket.OPEN) {
+		socket.send(JSON.stringify({
+			"type" : "requestConfig", 
+			"etag" : configEtag
+		}));
+	}
+}
+
 /* BUTTON CALLBACKS */
 
 /**
@@ -180,6 +199,8 @@ window.onload = function() {
     /* EVENT LISTENERS */
     const newSurvey = document.getElementById("newSurvey");
     newSurvey.onpointerup = newSurveyCallback;
+	// The config may have been edited since it was last sent
+	document.getElementById("participantSelect").onfocus = requestConfig;
 
 	viewport.animate();
 }
\ No newline at end of file
@@ -141,6 +141,41 @@ function newLandmarkInSet() {
     }
 }
 
+/**
+ * Hash the current mesh and ask the server whether it already holds that 
+ * geometry or can read it from its own copy of the model. If so, return a 
+ * reference to the mesh; otherwise return the full mesh data along with its
+ * hash
+ * @param {Object} meshParameters - the mesh data of the landmark set
+ * @returns {Promise}
+ */
+async function meshReferenceOrData(meshParameters) {
+    // Without a hash the mesh is offered by filename alone, as the server 
+    // may be able to read it from its own copy of the model
+    const hash = await viewport.getMeshHash(viewport.currentMesh);
+
+    const meshes = {};
+    meshes[meshParameters.filename] = hash;
+    const response = await fetch(
+        "/mesh-query",
+        {
+            method: "POST",
+            headers: {
+                "Content-Type": "application/json",
+            },
+            body: JSON.stringify({meshes: meshes}),
+            signal: AbortSignal.timeout(5000)
+        }
+    );
+    if (response.ok) {
+        const result = await response.json();
+        if (result.missing.length == 0) {
+            return {filename: meshParameters.filename, hash: hash};
+        }
+    }
+    return {...meshParameters, hash: hash};
+}
+
 /**
  * Check the validity of the landmark set, POST it to the save-landmark-set
  * endpoint, then show a message explaining the result of that request
@@ -165,6 +200,9 @@ async function saveLandmarkSet() {
             landmarkSet.landmarks[i].z = viewport.orbs[i].position.z;
         }
         try {
+            const body = landmarkSet.toJSON();
+            body.mesh = await meshReferenceOrData(landmarkSet.mesh);
+
             const response = await fetch(
                 "/save-landmark-set",
                 {
@@ -172,7 +210,7 @@ async function saveLandmarkSet() {
                     headers: {
                         "Content-Type": "application/json",
                     },
-                    body: JSON.stringify(landmarkSet.toJSON()),
+                    body: JSON.stringify(body),
                     signal: AbortSignal.timeout(5000)
                 }
             );
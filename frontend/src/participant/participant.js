@@ -11,10 +11,12 @@ var cameraController;
 var waitingInterval;
 var submissionTimeoutInterval;
 var updateServerInterval;
+var meshQueryResolver = null;
 
 /* WEBSOCKET */
 
-const socketURL = "/participant-ws";
+// Pass the page's ?session= on to the server, which may hold several surveys
+const socketURL = "/participant-ws" + window.location.search;
 var socket;
 
 /**
@@ -39,6 +41,18 @@ function socketConnect() {
 			case "survey":
 				prepSurvey(msg.survey);
 				break;
+			case "updateAck":
+			case "patchAck":
+				surveyManager.acknowledgeServerUpdate(msg.version);
+				break;
+			case "resync":
+				surveyManager.resetServerState();
+				break;
+			case "meshQueryResponse":
+				if (meshQueryResolver) {
+					meshQueryResolver(new Set(msg.missing));
+				}
+				break;
 			case "submitResponse":
 				if (msg.success) {
 					surveyManager.clearSurvey();
@@ -63,6 +77,7 @@ function socketConnect() {
 		console.log("Connection to websocket @ ", socketURL, 
 					" closed. Attempting reconnection in 1 second.");
 		clearInterval(updateServerInterval);
+		surveyManager.resetServerState();
 		setTimeout(function() {
 			socketConnect();
 		}, 1000);
@@ -74,6 +89,38 @@ function socketConnect() {
 	}
 }
 
+/**
+ * Ask the server which of the given meshes it does not already hold
+ * @param {Object} meshHashes - mesh filenames mapped to content hashes, or 
+ * 		to null where a mesh could not be hashed
+ * @returns {Promise} resolves to a Set of the filenames the server is 
+ * 		missing, or null if the server did not answer in time
+ */
+function queryMissingMeshes(meshHashes) {
+	return new Promise(function(resolve) {
+		if (
+			Object.keys(meshHashes).length == 0 
+			|| socket.readyState != WebSocket.OPEN
+		) {
+			resolve(null);
+			return;
+		}
+
+		const timeout = setTimeout(function() {
+			meshQueryResolver = null;
+			resolve(null);
+		}, 2000);
+
+		meshQueryResolver = function(missing) {
+			clearTimeout(timeout);
+			meshQueryResolver = null;
+			resolve(missing);
+		};
+
+		socket.send(JSON.stringify({type: "meshQuery", meshes: meshHashes}));
+	});
+}
+
 /* USER INTERFACE */
 
 /**
@@ -636,9 +683,28 @@ function submitCallback() {
 				}
 			}
 
-			Promise.all(promises).then(function(values) {
-				const meshParams = viewport.getStoredMeshParameters(usedMeshes);
-				const meshParamsObject = {meshes: meshParams};
+			Promise.all(promises).then(async function(values) {
+				// Only upload meshes whose geometry the server neither holds 
+				// nor can read from its own copy of the model. Meshes which
+				// could not be hashed are offered by filename alone
+				const storedHashes = await viewport.getStoredMeshHashes(usedMeshes);
+				const meshHashes = {};
+				for (const file of usedMeshes) {
+					meshHashes[file] = storedHashes[file] ?? null;
+				}
+				const missing = await queryMissingMeshes(meshHashes);
+				var uploadMeshes = usedMeshes;
+				if (missing) {
+					uploadMeshes = new Set(Array.from(usedMeshes).filter(
+						file => missing.has(file)
+					));
+				}
+
+				const meshParams = viewport.getStoredMeshParameters(uploadMeshes);
+				const meshParamsObject = {
+					meshes: meshParams, 
+					meshHashes: meshHashes
+				};
 
 				if (surveyManager.submitSurveyToServer(socket, meshParamsObject)) {
 					startSubmissionTimeout();
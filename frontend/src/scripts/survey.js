@@ -1,3 +1,50 @@
+/**
+ * Encode a collection of vertex indices in the compact form the backend's 
+ * VertexSet uses: {runs: [...]}, alternating gaps and lengths of the sorted
+ * runs of consecutive indices, each gap measured from the end of the 
+ * previous run
+ * @param {Iterable} vertices - the vertex indices
+ * @returns {Object}
+ */
+export function encodeVertexRuns(vertices) {
+    const sorted = Array.from(vertices).sort((a, b) => a - b);
+    var runs = [];
+    var stop = 0;
+    for (let i = 0; i < sorted.length; i++) {
+        if (i > 0 && sorted[i] == stop) {
+            runs[runs.length - 1] += 1;
+            stop += 1;
+        }
+        else if (i == 0 || sorted[i] > stop) {
+            runs.push(sorted[i] - stop, 1);
+            stop = sorted[i] + 1;
+        }
+    }
+    return {runs: runs};
+}
+
+/**
+ * Decode vertices sent by the backend, either in the {runs: [...]} form or 
+ * as a plain array of indices
+ * @param {Object|number[]} json - the encoded vertices
+ * @returns {Set}
+ */
+export function decodeVertices(json) {
+    if (!json || Array.isArray(json)) {
+        return new Set(json);
+    }
+    var vertices = new Set();
+    var stop = 0;
+    for (let i = 0; i < json.runs.length; i += 2) {
+        const start = stop + json.runs[i];
+        stop = start + json.runs[i + 1];
+        for (let v = start; v < stop; v++) {
+            vertices.add(v);
+        }
+    }
+    return vertices;
+}
+
 /** Contains qualitative data reported by a participant, to be assigned to a 
  *  projected field */
 export class Quality {
@@ -156,7 +203,7 @@ export class ProjectedField {
         var output = {
             model       : this.model, 
             name        : this.name,
-            vertices    : Array.from(this._vertices),
+            vertices    : encodeVertexRuns(this._vertices),
             hotSpot     : this.hotSpot,
             naturalness : this.naturalness,
             pain        : this.pain,
@@ -175,7 +222,7 @@ export class ProjectedField {
     fromJSON(json) {
         this.model = json.model;
         this.name = json.name;
-        this._vertices = new Set(json.vertices);
+        this._vertices = decodeVertices(json.vertices);
         this.hotSpot = json.hotSpot;
         this.naturalness = json.naturalness;
         this.pain = json.pain;
@@ -353,6 +400,7 @@ export class SurveyManager {
         this.survey = null;
         this.currentField = null;
         this.currentQuality = null;
+        this.resetServerState();
     }
 
     /**
@@ -362,6 +410,30 @@ export class SurveyManager {
         this.survey = null;
         this.currentField = null;
         this.currentQuality = null;
+        this.resetServerState();
+    }
+
+    /**
+     * Forget what the server is known to hold, so that the next update sends
+     * the full survey
+     */
+    resetServerState() {
+        this.serverVersion = null;
+        this._serverSurvey = null;
+        this._serverSnapshot = null;
+        this._pendingSnapshot = null;
+    }
+
+    /**
+     * Record that the server has applied the last update or patch sent to it
+     * @param {number} version - the survey version reported by the server
+     */
+    acknowledgeServerUpdate(version) {
+        if (this._pendingSnapshot) {
+            this.serverVersion = version;
+            this._serverSnapshot = this._pendingSnapshot;
+            this._pendingSnapshot = null;
+        }
     }
 
     /**
@@ -437,29 +509,225 @@ export class SurveyManager {
     }
 
     /**
-     * Pass the currentSurvey to the server via websocket
+     * Pass changes to the currentSurvey to the server via websocket. Once the
+     * server has acknowledged a version of the survey, only a patch against 
+     * that version is sent; otherwise the full survey is sent. Nothing is 
+     * sent while a previous message awaits acknowledgement
      * @param {WebSocket} socket - the socket the survey is to be sent over
      * @returns {boolean}
      */
     updateSurveyOnServer(socket) {
         if (this.survey) {
-            var msg = {
-                type: "update",
-                survey: this.survey.toJSON()
+            if (socket.readyState != WebSocket.OPEN) {
+                console.error("Socket is not OPEN, cannot submit survey.")
+                return false;
             }
-    
-            if (socket.readyState == WebSocket.OPEN) {
-                socket.send(JSON.stringify(msg));
-                return true;
+
+            if (this._serverSurvey !== this.survey) {
+                this.resetServerState();
+                this._serverSurvey = this.survey;
             }
-            else {
-                console.error("Socket is not OPEN, cannot submit survey.")
+
+            if (this._pendingSnapshot) {
                 return false;
             }
+
+            var msg;
+            const snapshot = snapshotSurvey(this.survey);
+            if (this.serverVersion === null) {
+                msg = {
+                    type: "update",
+                    survey: this.survey.toJSON()
+                }
+            }
+            else {
+                const ops = diffSurveySnapshots(this._serverSnapshot, snapshot);
+                if (ops.length == 0) {
+                    return false;
+                }
+                msg = {
+                    type: "patch",
+                    startTime: this.survey.startTime,
+                    baseVersion: this.serverVersion,
+                    ops: ops
+                }
+            }
+
+            this._pendingSnapshot = snapshot;
+            socket.send(JSON.stringify(msg));
+            return true;
         }
     }
 }
 
+/**
+ * Capture the state of a ProjectedField so that later edits can be diffed
+ * against it
+ * @param {ProjectedField} field - the field to be captured
+ * @returns {Object}
+ */
+function snapshotField(field) {
+    var qualities = new Map();
+    for (let i = 0; i < field.qualities.length; i++) {
+        qualities.set(
+            field.qualities[i].type, 
+            JSON.stringify(field.qualities[i].toJSON())
+        );
+    }
+
+    return {
+        field       : field,
+        model       : field.model,
+        name        : field.name,
+        hotSpot     : JSON.stringify(field.hotSpot),
+        naturalness : field.naturalness,
+        pain        : field.pain,
+        intensity   : field.intensity,
+        vertices    : new Set(field.vertices),
+        qualities   : qualities,
+        duplicateQualities : qualities.size != field.qualities.length
+    }
+}
+
+/**
+ * Capture the state of every ProjectedField in a Survey
+ * @param {Survey} survey - the survey to be captured
+ * @returns {Object[]}
+ */
+function snapshotSurvey(survey) {
+    return survey.projectedFields.map(snapshotField);
+}
+
+/**
+ * Collapse a collection of vertex indices into sorted, half-open 
+ * [start, stop) ranges
+ * @param {Iterable} vertices - the vertex indices
+ * @returns {number[][]}
+ */
+function toVertexRanges(vertices) {
+    const sorted = Array.from(vertices).sort((a, b) => a - b);
+    var ranges = [];
+    for (let i = 0; i < sorted.length; i++) {
+        const last = ranges[ranges.length - 1];
+        if (last && last[1] == sorted[i]) {
+            last[1] += 1;
+        }
+        else {
+            ranges.push([sorted[i], sorted[i] + 1]);
+        }
+    }
+    return ranges;
+}
+
+/**
+ * Produce the patch operations which turn one field snapshot into another
+ * @param {Object} before - the snapshot the server holds
+ * @param {Object} after - the current snapshot
+ * @param {number} index - the index of the field in the survey
+ * @returns {Object[]}
+ */
+function diffFieldSnapshots(before, after, index) {
+    if (before.duplicateQualities || after.duplicateQualities) {
+        return [{
+            op: "replaceField", 
+            index: index, 
+            field: after.field.toJSON()
+        }];
+    }
+
+    var ops = [];
+
+    var properties = {};
+    var changed = false;
+    for (const key of ["model", "name", "naturalness", "pain", "intensity"]) {
+        if (before[key] !== after[key]) {
+            properties[key] = after[key];
+            changed = true;
+        }
+    }
+    if (before.hotSpot !== after.hotSpot) {
+        properties.hotSpot = JSON.parse(after.hotSpot);
+        changed = true;
+    }
+    if (changed) {
+        ops.push({op: "updateField", index: index, properties: properties});
+    }
+
+    const removed = before.vertices.difference(after.vertices);
+    if (removed.size > 0) {
+        ops.push({
+            op: "removeVertices", 
+            index: index, 
+            ranges: toVertexRanges(removed)
+        });
+    }
+    const added = after.vertices.difference(before.vertices);
+    if (added.size > 0) {
+        ops.push({
+            op: "addVertices", 
+            index: index, 
+            ranges: toVertexRanges(added)
+        });
+    }
+
+    for (const [type, quality] of before.qualities) {
+        if (!after.qualities.has(type)) {
+            ops.push({op: "removeQuality", index: index, qualityType: type});
+        }
+    }
+    for (const [type, quality] of after.qualities) {
+        if (before.qualities.get(type) !== quality) {
+            ops.push({
+                op: "setQuality", 
+                index: index, 
+                quality: JSON.parse(quality)
+            });
+        }
+    }
+
+    return ops;
+}
+
+/**
+ * Produce the patch operations which turn one survey snapshot into another.
+ * Fields are matched by identity, so deleting a field does not disturb the
+ * fields after it
+ * @param {Object[]} before - the snapshot the server holds
+ * @param {Object[]} after - the current snapshot
+ * @returns {Object[]}
+ */
+function diffSurveySnapshots(before, after) {
+    var ops = [];
+
+    const afterFields = new Set(after.map(snapshot => snapshot.field));
+    var kept = [];
+    for (let i = before.length - 1; i >= 0; i--) {
+        if (!afterFields.has(before[i].field)) {
+            ops.push({op: "removeField", index: i});
+        }
+        else {
+            kept.unshift(before[i]);
+        }
+    }
+
+    const keptByField = new Map(kept.map(snapshot => [snapshot.field, snapshot]));
+    for (let i = 0; i < after.length; i++) {
+        const previous = keptByField.get(after[i].field);
+        if (previous) {
+            ops.push(...diffFieldSnapshots(previous, after[i], i));
+        }
+        else {
+            ops.push({
+                op: "addField", 
+                index: i, 
+                field: after[i].field.toJSON()
+            });
+        }
+    }
+
+    return ops;
+}
+
 /** Class which manages UI elements reflecting data in ProjectedFields */
 export class SurveyTable {
     /**
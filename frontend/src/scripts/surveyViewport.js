@@ -1018,6 +1018,66 @@ export class SurveyViewport {
         return result;
     }
 
+    /**
+     * Compute the content hash of a mesh's geometry, matching the backend's
+     * Mesh.contentHash: the SHA-256 of the vertex and face counts as uint32,
+     * then the vertices as float32 and the faces as int32, all little-endian.
+     * Resolves to null where the browser provides no SubtleCrypto, which is
+     * the case for pages not served over https or from localhost
+     * @param {THREE.Mesh} mesh - the mesh whose geometry will be hashed
+     * @returns {Promise}
+     */
+    async getMeshHash(mesh) {
+        if (!globalThis.crypto || !globalThis.crypto.subtle) {
+            return null;
+        }
+
+        const position = mesh.geometry.getAttribute("position").array;
+        const index = mesh.geometry.index.array;
+
+        const bytes = new ArrayBuffer(8 + 4 * (position.length + index.length));
+        const view = new DataView(bytes);
+        view.setUint32(0, position.length / 3, true);
+        view.setUint32(4, index.length / 3, true);
+        var offset = 8;
+        for (let i = 0; i < position.length; i++, offset += 4) {
+            view.setFloat32(offset, position[i], true);
+        }
+        for (let i = 0; i < index.length; i++, offset += 4) {
+            view.setInt32(offset, index[i], true);
+        }
+
+        const digest = await globalThis.crypto.subtle.digest("SHA-256", bytes);
+        return Array.from(
+            new Uint8Array(digest), 
+            b => b.toString(16).padStart(2, "0")
+        ).join("");
+    }
+
+    /**
+     * Return content hashes for each mesh in meshStorage. Meshes which could
+     * not be hashed are left out
+     * @param {Set} [meshes] - the meshes whose hashes should be computed
+     * @returns {Promise}
+     */
+    async getStoredMeshHashes(meshes = null) {
+        var result = {};
+
+        for (let prop in this.meshStorage) {
+            if (
+                Object.prototype.hasOwnProperty.call(this.meshStorage, prop)
+                && (!meshes || meshes.has(prop))
+            ) {
+                const hash = await this.getMeshHash(this.meshStorage[prop]);
+                if (hash) {
+                    result[prop] = hash;
+                }
+            }
+        }
+
+        return result;
+    }
+
     /**
      * Draws a sphere with the given parameter then uses the given mesh's
      * bounds tree to quickly find what vertex indices exist within the